@@ -23,6 +23,13 @@ num_filters = 6
 global_depth = 7 # dRA = 2.8125 (deg), dDEC = 1.40625 (deg)
 zone_depth = 3 # dRA = 0.35 (deg), dDEC = 0.175 (deg)
 
+# Zone trees are subdivided until each leaf holds at most zone_max_leaf_data
+# measurements, but no deeper than zone_max_depth. Sparse zones therefore
+# consist of a single leaf. Set zone_max_leaf_data to 0 to split every zone
+# to zone_depth instead.
+zone_max_leaf_data = 10000
+zone_max_depth = 8 # dRA = 0.011 (deg), dDEC = 0.0055 (deg)
+
 # Left padding to be used when naming zone files. Calculate by counting
 # the characters in the maximum zone ID (i.e. 2**(2*global_depth) + 2)
 zone_file_padding = 5
@@ -75,6 +82,78 @@ def get_coords(datum):
     ra  = datum['ra']
     return [ra, dec]
 
+def _grid_index(values, v_min, step, num_cells):
+    """Returns the index of the grid cell containing each of values on a
+    regular grid of num_cells cells of size step starting at v_min. Cells
+    include their lower and exclude their upper boundary, see Rect.contains.
+    Values outside of the grid are assigned -1."""
+
+    valid = np.isfinite(values)
+    index = np.floor(np.where(valid, (values - v_min) / step, -1)).astype('int64')
+
+    # correct for rounding in the division, the cell boundaries are exact
+    index -= values < v_min + index * step
+    index += values >= v_min + (index + 1) * step
+
+    index[(index < 0) | (index >= num_cells) | np.logical_not(valid)] = -1
+    return index
+
+_zone_grid = None
+
+def zone_grid():
+    """Returns a (2**global_depth, 2**global_depth) array containing the ID of
+    the zone which covers each cell of the global grid, indexed as
+    [dec index, ra index]. The zones follow the numbering of make_zones.py:
+    leaves are numbered in quadtree order, then the rows of cells at the poles
+    are merged into the polar zones."""
+
+    global _zone_grid
+    if _zone_grid is not None:
+        return _zone_grid
+
+    num_cells = 2**global_depth
+    dy = 180.0 / num_cells
+
+    # quadtree children are ordered (x_min, y_min), (x_max, y_min), ...
+    # so leaves are numbered by interleaving the bits of the cell indexes
+    index = np.arange(num_cells)
+    spread = np.zeros(num_cells, dtype='int32')
+    for bit in range(0, global_depth):
+        spread |= ((index >> bit) & 1) << (2 * bit)
+
+    first_zone_id = max(north_zone_id, south_zone_id) + 1
+    grid = first_zone_id + spread[np.newaxis, :] + 2 * spread[:, np.newaxis]
+
+    # apply the rules of make_zones.merge_polar_zones
+    y_min = -90 + index * dy
+    y_max = -90 + (index + 1) * dy
+    north = polar_zone_cutoff
+    south = -1 * north
+    grid[(y_min == -90) | (y_max < south), :] = south_zone_id
+    grid[(y_max == 90) | (y_min > north), :] = north_zone_id
+
+    _zone_grid = grid
+    return _zone_grid
+
+def zone_ids_from_coords(ra, dec):
+    """Returns the IDs of the zones which contain each of the (ra, dec)
+    points. This is equivalent to inserting the points into the global tree
+    created by make_zones.py one at a time."""
+
+    ra  = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+
+    num_cells = 2**global_depth
+    i = _grid_index(ra, 0, 360.0 / num_cells, num_cells)
+    j = _grid_index(dec, -90, 180.0 / num_cells, num_cells)
+
+    invalid = np.flatnonzero((i < 0) | (j < 0))
+    if len(invalid) > 0:
+        k = invalid[0]
+        raise RuntimeError("Could not find a node containing the point (%f, %f)" % (ra[k], dec[k]))
+
+    return zone_grid()[j, i]
+
 def get_num_zones():
     """Computes the maximum number of zones used by the tree. Depending if any
     zones are merged, the real number of zones can be lower than this."""
@@ -97,10 +176,18 @@ def name_zone_file(zone_id):
     """Produce a name from a zone file given a zone ID"""
     return name_zone(zone_id) + "-raw.fredbin"
 
+def name_zone_hash_file(zone_id):
+    """Produces the name of the row hash file of a zone given a zone ID"""
+    return name_zone(zone_id) + "-raw-hashes.bin"
+
 def name_zone_container_file(zone_id):
     """Produces the name for a zone's container given a zone ID"""
     return name_zone(zone_id) + '-container.fredbin'
 
+def name_zone_columns_dir(zone_id):
+    """Produces the name of a zone's column store given a zone ID"""
+    return name_zone(zone_id) + '-columns'
+
 def name_zone_border_file(zone_id):
     """Produces the name of a zone border file given a zone ID"""
     return name_zone(zone_id) + '-border-rects.json'
@@ -109,10 +196,6 @@ def name_zone(zone_id):
     """Produces the name of a zone given a zone ID"""
     return "z" + str(zone_id).zfill(5)
 
-def name_zone_contrib_file(zone_id):
-    """Produces the name of a 'zone contribution' file given a zone ID"""
-    return name_zone(zone_id) + "-contrib.txt"
-
 def name_zone_json_file(zone_id):
     """Produces the name of a zone's JSON file given a zone ID"""
     return name_zone(zone_id) + "-zone.json"
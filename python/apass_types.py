@@ -1,16 +1,32 @@
 from quadtree import *
 from quadtree_types import *
-from math import cos, pi
+from math import cos, pi, floor
+from bisect import bisect_left
 import apass
+import fred
 import os
 
+# RectLeaf indexes its containers in a uniform grid of cells, see ContainerIndex
+container_index_cell_size = 2. / (60 * 60) # 2 arcseconds in degrees
+container_index_max_cells = 16
+
 class RectContainer(dict):
     """A class which implements a storage container with rectangular boundaries."""
 
+    # The data of a container is either kept in a list of numpy.void records
+    # (records) or in a slot of a ContainerTable shared by the containers of a
+    # zone (table, slot), see container_table.py. These are not dictionary
+    # entries, so they are never written to the zone's JSON file.
+    __slots__ = ('__dict__', 'records', 'table', 'slot')
+
     def __init__(self, x, y, data, zone_id=-1, node_id=-1, container_id=-1):
         dict.__init__(self)
         self.__dict__ = self
 
+        self.records = []
+        self.table = None
+        self.slot = -1
+
         self.zone_id = zone_id
         self.node_id = node_id
         self.container_id = container_id
@@ -20,8 +36,6 @@ class RectContainer(dict):
         dx = dr / cos(y * pi /  180)
         dy = dr
         self.rect = Rect(x - dx, x + dx, y - dy, y + dy)
-        # self.data is a list of numpy.ndarray objects
-        self.data = []
         if data is not None:
             self.append_data(data)
 
@@ -52,67 +66,331 @@ class RectContainer(dict):
         container.rect = Rect.from_dict(dict_['rect'])
         return container
 
+    @property
+    def data(self):
+        """The data of this container, a list of numpy.void records or, for
+        containers in a ContainerTable, a numpy structured array"""
+        if self.table is not None:
+            return self.table.get_data(self.slot)
+        return self.records
+
+    @data.setter
+    def data(self, data):
+        self.detach()
+        self.records = data
+        self.num_data = len(data)
+
+    def attach(self, table, slot):
+        """Stores this container's data in the slot of a ContainerTable"""
+        self.table = table
+        self.slot = slot
+        self.records = []
+        self.num_data = int(table.count[slot])
+
+    def detach(self):
+        """Releases this container's slot in its ContainerTable (if any)"""
+        if self.table is not None:
+            self.table.clear(self.slot)
+        self.table = None
+        self.slot = -1
+
     def append_data(self, data):
         """Appends the specified data to this object"""
-        self.data.append(data)
-        self.num_data = len(self.data)
+        if self.table is not None:
+            self.table.add_records(self.slot, data)
+            self.num_data = int(self.table.count[self.table.find(self.slot)])
+        else:
+            self.records.append(data)
+            self.num_data = len(self.records)
 
     def merge(self, other):
         """Merges two RectContainer Instances, growing their bounding rectangles
         other -- another RectContainer instance"""
 
-        # conditionally reflect the data about RA 0 <-> 360
-        rect, data = apass.reflect_rect_and_data(other.rect, other.data)
+        if other is self:
+            return
+
+        if self.table is not None and self.table is other.table:
+            # join the containers' sets, the data is regrouped when the table
+            # is packed. Reflect the data about RA 0 <-> 360 (if necessary).
+            shift = 360.0 if other.rect.x_min < 0 else 0.0
+            self.rect.expand(apass.reflect_rect(other.rect))
+            self.table.union(self.slot, other.slot, shift)
+            self.num_data = int(self.table.count[self.table.find(self.slot)])
+            other.table = None
+            other.slot = -1
+            return
+
+        if other.table is not None:
+            # copy the data and reflect it about RA 0 <-> 360 (if necessary)
+            data = other.data.copy()
+            if other.rect.x_min < 0:
+                data['ra'] += 360.0
+            rect = apass.reflect_rect(other.rect)
+            other.clear_data()
+        else:
+            # conditionally reflect the data about RA 0 <-> 360
+            rect, data = apass.reflect_rect_and_data(other.rect, other.records)
+            other.records = []
 
         # grow the rectangle
         self.rect.expand(rect)
 
+        if self.table is not None:
+            # the IDs of the data are set when the table is packed
+            self.table.add_records(self.slot, fred.to_fredbin(data))
+            self.num_data = int(self.table.count[self.table.find(self.slot)])
+            return
+
         # re-number the other container's data IDs and append it to this node's data
         for i in range(0, len(data)):
             data[i]['node_id'] = self.node_id
             data[i]['container_id'] = self.container_id
 
-        self.data.extend(data)
-        other.data = []
-
-        self.num_data = len(self.data)
+        self.records.extend(data)
+        self.num_data = len(self.records)
 
     def overlaps(self, other):
         """Determines if this RectContainer overlaps with another RectContainer
 
         other -- another RectContainer instance"""
-        overlaps = False
+        s_rect = self.rect
+        o_rect = other.rect
 
         # If both nodes span the north or south pole, they automatically overlap
-        if self.rect.y_max > 90 and other.rect.y_max > 90:
-            overlaps = True
-        elif self.rect.y_min < -90 and other.rect.y_min < -90:
-            overlaps = True
-        else:
-            s_rect = apass.reflect_rect(self.rect)
-            o_rect = apass.reflect_rect(other.rect)
-            overlaps = s_rect.overlaps(o_rect)
-
-        return overlaps
+        if s_rect.y_max > 90 and o_rect.y_max > 90:
+            return True
+        elif s_rect.y_min < -90 and o_rect.y_min < -90:
+            return True
+
+        # conditionally reflect about RA 0 <-> 360, see apass.reflect_rect
+        s_dx = 360.0 if s_rect.x_min < 0 else 0.0
+        o_dx = 360.0 if o_rect.x_min < 0 else 0.0
+
+        # see Rect.overlaps
+        if (o_rect.y_max < s_rect.y_min or
+            o_rect.x_max + o_dx < s_rect.x_min + s_dx or
+            o_rect.x_min + o_dx > s_rect.x_max + s_dx or
+            o_rect.y_min > s_rect.y_max):
+            return False
+        return True
 
     def get_data(self):
-        """Returns this container's data as a list."""
+        """Returns this container's data as a list (or, for containers in a
+        ContainerTable, as a numpy structured array)."""
 
         # ensure the data is marked as belonging to this container.
-        for datum in self.data:
+        if self.table is not None:
+            data = self.table.get_data(self.slot)
+            data['zone_id'] = self.zone_id
+            data['node_id'] = self.node_id
+            data['container_id'] = self.container_id
+            return data
+
+        for datum in self.records:
             datum['zone_id'] = self.zone_id
             datum['node_id'] = self.node_id
             datum['container_id'] = self.container_id
 
-        return self.data
+        return self.records
 
     def clear_data(self):
         """Erases all data contained in this node"""
-        self.data = []
+        self.detach()
+        self.records = []
 
     def get_corners(self):
         return self.rect.get_corners()
 
+class ContainerIndex(list):
+    """A list of RectContainers which indexes the containers by the cell of a
+    uniform grid containing the center of their bounds (reflected about
+    RA 0 <-> 360, see apass.reflect_rect), so the containers overlapping a
+    container or containing a point are found without checking every
+    container in the list. Queries check the cells within the largest half
+    width and height of the indexed containers.
+
+    Containers must be added with append (or extend, +=) and removed with
+    remove (or pop). Other ways of modifying the list (insert, item and slice
+    assignment, del, sort, ...) would bypass the index and raise
+    NotImplementedError. After the bounds of a container change (e.g.
+    RectContainer.merge), call update. Containers which are more than container_index_max_cells cells wide
+    or high are checked in every query. Containers are compared by identity."""
+
+    def __init__(self, containers=[]):
+        list.__init__(self)
+
+        self.cells = dict()     # (i,j) -> ids of the containers centered in the cell
+        self.entries = dict()   # id -> [sequence number, container, cell]
+        self.sequence = []      # the sequence number of each container in the list
+        self.unbounded = set()  # ids of containers which are in every query
+        self.north = set()      # ids of containers extending past the poles
+        self.south = set()
+        self.half_width = 0.0   # the largest half width and height of the
+        self.half_height = 0.0  # containers in self.cells
+        self.next_sequence = 0
+
+        self.extend(containers)
+
+    def __reduce__(self):
+        # the index is keyed by object IDs, rebuild it when copying
+        return (ContainerIndex, (list(self),))
+
+    def _add(self, key):
+        """Adds the container to the cell containing its center"""
+        entry = self.entries[key]
+        rect = entry[1].rect
+
+        x_min = rect.x_min
+        if x_min < 0:
+            x_min += 360.0
+        half_width = (rect.x_max - rect.x_min) / 2
+        half_height = (rect.y_max - rect.y_min) / 2
+
+        size = container_index_cell_size
+        max_size = container_index_max_cells * size
+        cell = None
+        if 2 * half_width > max_size or 2 * half_height > max_size:
+            self.unbounded.add(key)
+        else:
+            cell = (int(floor((x_min + half_width) / size)),
+                    int(floor((rect.y_min + half_height) / size)))
+            self.cells.setdefault(cell, []).append(key)
+            self.half_width = max(self.half_width, half_width)
+            self.half_height = max(self.half_height, half_height)
+
+        if rect.y_max > 90:
+            self.north.add(key)
+        if rect.y_min < -90:
+            self.south.add(key)
+
+        entry[2] = cell
+
+    def _discard(self, key):
+        """Removes the container from its cell"""
+        cell = self.entries[key][2]
+        if cell is None:
+            self.unbounded.discard(key)
+        else:
+            keys = self.cells[cell]
+            keys.remove(key)
+            if len(keys) == 0:
+                del self.cells[cell]
+
+        self.north.discard(key)
+        self.south.discard(key)
+
+    def _window(self, x_min, x_max, y_min, y_max):
+        """Returns the ids of the containers which may overlap the (reflected)
+        rectangle"""
+        # allow for rounding in the centers of the containers
+        margin = 1e-9
+        size = container_index_cell_size
+        i_min = int(floor((x_min - self.half_width - margin) / size))
+        i_max = int(floor((x_max + self.half_width + margin) / size))
+        j_min = int(floor((y_min - self.half_height - margin) / size))
+        j_max = int(floor((y_max + self.half_height + margin) / size))
+
+        if (i_max - i_min + 1) * (j_max - j_min + 1) > len(self.entries):
+            return set(self.entries.keys())
+
+        keys = set(self.unbounded)
+        for i in range(i_min, i_max + 1):
+            for j in range(j_min, j_max + 1):
+                keys.update(self.cells.get((i, j), ()))
+
+        return keys
+
+    def _in_order(self, keys):
+        """Returns the containers with the specified ids in list order"""
+        entries = [self.entries[key] for key in keys]
+        entries.sort(key=lambda entry: entry[0])
+        return [entry[1] for entry in entries]
+
+    def append(self, container):
+        key = id(container)
+        if key in self.entries:
+            raise ValueError("The container is already in the list")
+
+        list.append(self, container)
+        self.entries[key] = [self.next_sequence, container, None]
+        self.sequence.append(self.next_sequence)
+        self.next_sequence += 1
+        self._add(key)
+
+    def extend(self, containers):
+        for container in containers:
+            self.append(container)
+
+    def remove(self, container):
+        key = id(container)
+        if key not in self.entries:
+            raise ValueError("The container is not in the list")
+
+        self._discard(key)
+        entry = self.entries.pop(key)
+
+        # the list is in sequence order
+        i = bisect_left(self.sequence, entry[0])
+        del self.sequence[i]
+        list.__delitem__(self, i)
+
+    def __iadd__(self, containers):
+        self.extend(containers)
+        return self
+
+    def pop(self, i=-1):
+        container = self[i]
+        self.remove(container)
+        return container
+
+    def _unsupported(self, *args, **kwargs):
+        raise NotImplementedError("ContainerIndex only supports append, extend, remove and pop")
+
+    # modifications which would bypass the index
+    insert = _unsupported
+    sort = _unsupported
+    reverse = _unsupported
+    clear = _unsupported
+    __setitem__ = _unsupported
+    __delitem__ = _unsupported
+    __setslice__ = _unsupported
+    __delslice__ = _unsupported
+    __imul__ = _unsupported
+
+    def update(self, container):
+        """Re-indexes a container after its bounds changed"""
+        key = id(container)
+        self._discard(key)
+        self._add(key)
+
+    def overlapping(self, other_container):
+        """Returns the containers which overlap other_container (see
+        RectContainer.overlaps) in list order"""
+        rect = other_container.rect
+        dx = 360.0 if rect.x_min < 0 else 0.0
+        keys = self._window(rect.x_min + dx, rect.x_max + dx, rect.y_min, rect.y_max)
+        if rect.y_max > 90:
+            keys.update(self.north)
+        if rect.y_min < -90:
+            keys.update(self.south)
+
+        return [container for container in self._in_order(keys)
+                if container.overlaps(other_container)]
+
+    def containing(self, x, y):
+        """Returns the first container which contains (x,y) or None"""
+
+        # containers with x_min < 0 are indexed 360 degrees away
+        keys = self._window(x, x, y, y)
+        keys.update(self._window(x + 360.0, x + 360.0, y, y))
+
+        for container in self._in_order(keys):
+            if container.contains(x,y):
+                return container
+
+        return None
+
 class RectLeaf(QuadTreeNode):
     """A class for a QuadTree leaf that contains a list of rectangles with
     data."""
@@ -122,7 +400,7 @@ class RectLeaf(QuadTreeNode):
 
         self.zone_id = zone_id
         self.node_id = node_id
-        self.containers = []
+        self.containers = ContainerIndex()
 
     @staticmethod
     def from_dict(rect, depth, dict_):
@@ -138,28 +416,30 @@ class RectLeaf(QuadTreeNode):
 
         return leaf
 
+    def get_container_index(self):
+        """Returns the containers of this leaf as a ContainerIndex, converting
+        them if they were replaced by a plain list"""
+        if not isinstance(self.containers, ContainerIndex):
+            self.containers = ContainerIndex(self.containers)
+        return self.containers
+
     def get_container(self, x, y):
         """Returns a reference to the container which contains (x,y) or None if
         no such container exists"""
-        for container in self.containers:
-            if container.contains(x,y):
-                return container
-
-        return None
+        return self.get_container_index().containing(x,y)
 
     def get_overlapping_containers(self, other_container):
         """Returns a list of containers that overlaps with other_container.
-        If remove=True (default), any overlapping containers will be removed from
-        this container, otherwise they will be left intact."""
-        containers = []
-        for container in self.containers:
-            if container.overlaps(other_container):
-                containers.append(container)
-
-        return containers
+        The containers are left intact."""
+        return self.get_container_index().overlapping(other_container)
 
     def remove_container(self, container):
-        self.containers.remove(container)
+        self.get_container_index().remove(container)
+
+    def update_container(self, container):
+        """Updates the index after the bounds of a container in this leaf
+        changed, e.g. by RectContainer.merge"""
+        self.get_container_index().update(container)
 
     def remove_containers(self, containers):
         for container in containers:
@@ -169,7 +449,11 @@ class RectLeaf(QuadTreeNode):
         """Stores the data inside of a container encapsulated by this node."""
 
         # create a container to store this data
-        container = RectContainer(x, y, data)
+        self.insert_container(RectContainer(x, y, data))
+
+    def insert_container(self, container):
+        """Stores a container in this node, merging it with any overlapping
+        containers."""
 
         # find any overlapping containers, sort by number of contained data in
         # descending order
@@ -188,6 +472,7 @@ class RectLeaf(QuadTreeNode):
                 bigger_cont.merge(other)
 
             self.remove_containers(other_conts)
+            self.update_container(bigger_cont)
 
     def insert_or_drop(self, x, y, data, distance=1):
         """Stores data inside of a container encapsulated by this node if a suitable
@@ -212,6 +497,7 @@ class RectLeaf(QuadTreeNode):
                 bigger_cont.merge(other)
 
             self.remove_containers(other_conts)
+            self.update_container(bigger_cont)
 
     def load_data(self, data):
         """Restores the specified data to the container. Used in object restoration."""
@@ -0,0 +1,315 @@
+# Storage for the data of the containers of a zone.
+#
+# A ContainerTable keeps the records of all containers of a zone in a single
+# numpy structured array. Records are added in segments, that is runs of
+# consecutive records, each of which belongs to a container (a slot in the
+# table):
+#
+#  * seg_start, seg_length, seg_slot: the first record, the number of records
+#    and the slot of each segment
+#
+# Merging containers does not move any records. The slots form a disjoint-set
+# forest (union-find with path compression) and a merge only joins the two
+# sets:
+#
+#  * parent: the parent of each slot, the root of a set holds the data of all
+#    slots in the set
+#  * shift: the amount added to the RA of the records of a slot relative to
+#    its parent, used when containers are reflected about RA 0 <-> 360
+#  * count, num_segments, single: the number of records and segments of the
+#    set of each root and, for sets with one segment, that segment
+#
+# The records are regrouped by container, once, when the table is packed (see
+# pack). Within a container, the records are kept in table order. Container
+# files are sorted by container, so after loading every container holds a
+# single segment and its data is a view into the table (CSR layout).
+#
+# Tables made from fredbin files with encoded columns (see fred.encode_fredbin)
+# keep the records encoded. get_data decodes the records of one container, pack
+# returns them encoded.
+
+# system includes
+import numpy as np
+
+# local includes
+import fred
+
+def _grow(array, size):
+    """Returns array or, if it holds less than size entries, a copy of array
+    with room for (at least) size entries"""
+    if size <= len(array):
+        return array
+
+    output = np.zeros(max(size, 2 * len(array), 16), dtype=array.dtype)
+    output[0:len(array)] = array
+    return output
+
+def segment_indices(starts, lengths):
+    """Returns the indices of the records in the segments (starts[k],
+    lengths[k]), in order"""
+    starts = np.asarray(starts, dtype='int64')
+    lengths = np.asarray(lengths, dtype='int64')
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths), dtype='int64')
+
+class ContainerTable(object):
+    """The data of the containers of a zone, stored in one numpy structured
+    array. See the top of container_table.py"""
+
+    def __init__(self, data, encoding=dict()):
+        """Creates a table for the records in data (which may be a memory map).
+        Records are assigned to containers with new_slot or add_segment. If
+        data has encoded columns, give their encoding (it is extended as
+        records are added)."""
+        self.data = data
+        self.num_records = len(data)
+        self.encoding = encoding
+        self.decode = fred.fredbin_decoder(encoding)
+
+        self.seg_start = np.zeros(0, dtype='int64')
+        self.seg_length = np.zeros(0, dtype='int64')
+        self.seg_slot = np.zeros(0, dtype='int64')
+        self.num_segs = 0
+
+        self.parent = np.zeros(0, dtype='int64')
+        self.shift = np.zeros(0, dtype='float64')
+        self.count = np.zeros(0, dtype='int64')
+        self.num_segments = np.zeros(0, dtype='int64')
+        self.single = np.zeros(0, dtype='int64')
+        self.num_slots = 0
+
+        # segments of each root, see _groups
+        self.groups = None
+
+    def new_slot(self, start=0, length=0):
+        """Returns a new slot which holds the length records starting at start"""
+        slot = self.num_slots
+        self.num_slots += 1
+
+        self.parent = _grow(self.parent, self.num_slots)
+        self.shift = _grow(self.shift, self.num_slots)
+        self.count = _grow(self.count, self.num_slots)
+        self.num_segments = _grow(self.num_segments, self.num_slots)
+        self.single = _grow(self.single, self.num_slots)
+        self.parent[slot] = slot
+        self.shift[slot] = 0
+        self.count[slot] = 0
+        self.num_segments[slot] = 0
+        self.single[slot] = -1
+
+        if length > 0:
+            self.add_segment(slot, start, length)
+
+        return slot
+
+    def find(self, slot):
+        """Returns the root of the set containing slot, compressing the path"""
+        path = []
+        while self.parent[slot] != slot:
+            path.append(slot)
+            slot = self.parent[slot]
+        root = slot
+
+        # point the slots on the path directly to the root, accumulating the
+        # shifts of their former parents
+        shift = 0.0
+        for slot in reversed(path):
+            shift += self.shift[slot]
+            self.shift[slot] = shift
+            self.parent[slot] = root
+
+        return root
+
+    def add_segment(self, slot, start, length):
+        """Appends the length records starting at start to the slot"""
+        segment = self.num_segs
+        self.num_segs += 1
+
+        self.seg_start = _grow(self.seg_start, self.num_segs)
+        self.seg_length = _grow(self.seg_length, self.num_segs)
+        self.seg_slot = _grow(self.seg_slot, self.num_segs)
+        self.seg_start[segment] = start
+        self.seg_length[segment] = length
+        self.seg_slot[segment] = slot
+
+        root = self.find(slot)
+        self.count[root] += length
+        self.num_segments[root] += 1
+        self.single[root] = segment if self.num_segments[root] == 1 else -1
+        self.groups = None
+
+    def add_records(self, slot, records):
+        """Copies records (a numpy.void or structured array) to the end of the
+        table and appends them to the slot"""
+        if isinstance(records, np.void):
+            records = np.array([records], dtype=records.dtype)
+
+        length = len(records)
+        if length == 0:
+            return
+
+        if len(self.encoding) > 0:
+            records = fred.encode_fredbin(records, self.encoding)[0]
+            self.decode = fred.fredbin_decoder(self.encoding)
+
+        start = self.num_records
+        self.num_records += length
+        self.data = _grow(self.data, self.num_records)
+        self.data[start:self.num_records] = records
+
+        self.add_segment(slot, start, length)
+
+    def union(self, slot, other, shift=0.0):
+        """Moves the records of the other slot to the slot, adding shift to
+        their RA. Only the sets of the slots are joined, no records are
+        moved."""
+        root = self.find(slot)
+        other = self.find(other)
+        if root == other:
+            return
+
+        self.parent[other] = root
+        self.shift[other] = shift
+        self.count[root] += self.count[other]
+        self.num_segments[root] += self.num_segments[other]
+        if self.num_segments[root] == 1:
+            self.single[root] = max(self.single[root], self.single[other])
+        else:
+            self.single[root] = -1
+        self.groups = None
+
+    def clear(self, slot):
+        """Removes all records from the slot. The records stay in the table,
+        the slot must not be used (or packed) afterwards."""
+        root = self.find(slot)
+        self.count[root] = 0
+        self.num_segments[root] = 0
+        self.single[root] = -1
+
+    def resolve(self):
+        """Returns the root of every slot and the shift of its records relative
+        to the root, compressing all paths (pointer jumping)"""
+        n = self.num_slots
+        parent = self.parent[0:n]
+        shift = self.shift[0:n]
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            shift = shift + shift[parent]
+            parent = grandparent
+
+        self.parent[0:n] = parent
+        self.shift[0:n] = shift
+        return parent, shift
+
+    def _groups(self):
+        """Returns the segments sorted by (root, start), the root of each of
+        them and the shift of their records"""
+        if self.groups is None:
+            roots, shifts = self.resolve()
+            n = self.num_segs
+            seg_roots = roots[self.seg_slot[0:n]]
+            order = np.lexsort((self.seg_start[0:n], seg_roots))
+            self.groups = (order, seg_roots[order], shifts[self.seg_slot[0:n]][order])
+        return self.groups
+
+    def get_data(self, slot):
+        """Returns the (decoded) records of the slot as a structured array.
+        Containers consisting of a single segment of a table without encoded
+        columns return a view into the table."""
+        root = self.find(slot)
+        if self.num_segments[root] == 0:
+            return self.decode(self.data[0:0])
+
+        segment = self.single[root]
+        if segment >= 0:
+            owner = self.seg_slot[segment]
+            if owner == root or (self.find(owner) == root and self.shift[owner] == 0):
+                start = self.seg_start[segment]
+                return self.decode(self.data[start:start + self.seg_length[segment]])
+
+        order, seg_roots, seg_shifts = self._groups()
+        first = np.searchsorted(seg_roots, root, side='left')
+        last = np.searchsorted(seg_roots, root, side='right')
+        segments = order[first:last]
+
+        lengths = self.seg_length[segments]
+        data = self.data[segment_indices(self.seg_start[segments], lengths)]
+        shifts = np.repeat(seg_shifts[first:last], lengths)
+        if (shifts != 0).any():
+            data['ra'] += shifts
+        return self.decode(data)
+
+    def pack(self, slots):
+        """Returns the (encoded) records of the slots, in order, as one
+        contiguous structured array along with the number of records of each
+        slot."""
+        roots, shifts = self.resolve()
+        slots = roots[np.asarray(slots, dtype='int64')]
+
+        # the position of each segment's container in the output
+        rank = -np.ones(self.num_slots, dtype='int64')
+        rank[slots] = np.arange(len(slots))
+        n = self.num_segs
+        seg_rank = rank[roots[self.seg_slot[0:n]]]
+        segments = np.flatnonzero(seg_rank >= 0)
+        segments = segments[np.lexsort((self.seg_start[segments], seg_rank[segments]))]
+
+        lengths = self.seg_length[segments]
+        data = self.data[segment_indices(self.seg_start[segments], lengths)]
+        seg_shifts = np.repeat(shifts[self.seg_slot[segments]], lengths)
+        if (seg_shifts != 0).any():
+            data['ra'] += seg_shifts
+
+        return data, self.count[slots]
+
+def pack_containers(containers):
+    """Returns the data of the containers (RectContainer), in order, as one
+    structured array with the zone_id, node_id and container_id columns set to
+    those of the containers, along with its encoding. The data stays encoded
+    if all containers are in tables sharing one encoding, otherwise it is
+    decoded and the encoding is None."""
+
+    pieces = []
+    counts = []
+    tables = []
+
+    # pack runs of containers sharing a table at once
+    k = 0
+    while k < len(containers):
+        table = containers[k].table
+        end = k + 1
+        while end < len(containers) and containers[end].table is table:
+            end += 1
+
+        if table is None:
+            for container in containers[k:end]:
+                pieces.append(fred.to_fredbin(container.data))
+                counts.append(len(container.data))
+        else:
+            data, num_data = table.pack([c.slot for c in containers[k:end]])
+            pieces.append(data)
+            counts.extend(num_data.tolist())
+        tables.append(table)
+
+        k = end
+
+    encoding = None
+    if len(tables) > 0 and tables[0] is not None and len(tables[0].encoding) > 0 and \
+        all([table is not None and table.encoding is tables[0].encoding for table in tables]):
+        encoding = tables[0].encoding
+    else:
+        pieces = [piece if table is None else table.decode(piece)
+                  for piece, table in zip(pieces, tables)]
+
+    if len(pieces) == 0:
+        return fred.to_fredbin([]), encoding
+    data = np.concatenate(pieces)
+
+    # mark the data as belonging to their containers
+    for column in ['zone_id', 'node_id', 'container_id']:
+        values = [container[column] for container in containers]
+        data[column] = np.repeat(np.asarray(values, dtype='int64'), counts)
+
+    return data, encoding
@@ -3,9 +3,13 @@
 # Filename: dat.py
 # Purpose: Functions that enable read/write operations or other interactions on .dat files.
 
+import io
+import os
 import numpy as np
 from math import pi
 
+import fred
+
 valid_formats = ['apass', 'sro']
 
 # data format for output data.
@@ -117,14 +121,42 @@ def select_format(dat_type = "apass"):
 
     return dat_col_names, dat_col_types, dat_col_fmt
 
+def name_datbin(filename):
+    """Returns the name of the binary companion of a .dat file."""
+    return os.path.splitext(filename)[0] + ".datbin"
+
+def read_datbin(filename, dat_type="apass"):
+    """Reads the binary companion of a .dat file, filename. Returns None if
+    the companion does not exist, is older than the .dat file, or does not
+    match the specified format. Values are in the units of the .dat file and
+    rounded to its precision."""
+
+    dat_col_names, dat_col_types, dat_col_fmt = select_format(dat_type)
+
+    datbin_filename = name_datbin(filename)
+    if not os.path.isfile(datbin_filename):
+        return None
+    if os.path.isfile(filename) and \
+        os.path.getmtime(datbin_filename) < os.path.getmtime(filename):
+        return None
+
+    data = fred.read_fredbin(datbin_filename)
+    if data is None or list(data.dtype.names) != dat_col_names:
+        return None
+
+    return data
+
 def read_dat(filename, dat_type="apass"):
-    """Reads in a .dat file, returns it as a Numpy structured array"""
+    """Reads in a .dat file, returns it as a Numpy structured array. The
+    binary companion written by write_dat is used when it is available, it
+    holds the same (rounded) values as the text."""
 
     dat_col_names, dat_col_types, dat_col_fmt = select_format(dat_type)
 
-    """Reads in an output data file (e.g. a .dat file)"""
-    dtype={'names': dat_col_names, 'formats': dat_col_types}
-    data = np.loadtxt(filename, dtype=dtype)
+    data = read_datbin(filename, dat_type=dat_type)
+    if data is None:
+        dtype={'names': dat_col_names, 'formats': dat_col_types}
+        data = np.loadtxt(filename, dtype=dtype)
 
     # convert ra/dec errors from arcseconds to deg
     data['ra_sig']  /= 3600
@@ -140,8 +172,43 @@ def read_dat(filename, dat_type="apass"):
 
     return data
 
+def format_dat_lines(data, dat_col_fmt):
+    """Formats the rows of data as lines of text using one format per column.
+    The array is converted to native Python values in a single operation and
+    each row is formatted with one combined format string, which is much
+    faster than numpy.savetxt while producing identical output."""
+
+    # string columns are formatted as text (not bytes) under Python 3
+    dtype = []
+    for name in data.dtype.names:
+        col_type = data.dtype[name]
+        if col_type.kind == 'S':
+            col_type = np.dtype('U%i' % (col_type.itemsize))
+        dtype.append((name, col_type))
+
+    line_fmt = ' '.join(dat_col_fmt)
+    return [line_fmt % row for row in data.astype(dtype).tolist()]
+
+def round_to_format(values, fmt):
+    """Rounds floating point values to the number of decimals of a printf
+    style format (e.g. '%9.3f'), giving the values which are read back from
+    text written with the format."""
+
+    decimals = int(fmt.split('.')[1].rstrip('f'))
+    x = np.asarray(values, dtype='float64')
+    scaled = x * 10**decimals
+    output = np.round(scaled) / 10**decimals
+
+    # values (almost) halfway between two decimals are rounded by the formatting
+    near = np.abs(scaled - np.floor(scaled) - 0.5) < np.maximum(1e-6, 8 * np.spacing(scaled))
+    output[near] = [float(fmt % value) for value in x[near]]
+
+    return output.astype(values.dtype)
+
 def write_dat(filename, data, dat_type="apass"):
-    """Writes a numpy structured array to disk following the specified format"""
+    """Writes a numpy structured array to disk following the specified format.
+    A binary companion file (see name_datbin) containing the same values, as
+    they are read back from the text file, is written alongside it."""
 
     dat_col_names, dat_col_types, dat_col_fmt = select_format(dat_type)
 
@@ -170,8 +237,18 @@ def write_dat(filename, data, dat_type="apass"):
     indices = np.where((data['good_obs'] == True))
     data = data[indices]
 
-    # save to text
-    np.savetxt(filename, data, fmt=dat_col_fmt, header=header)
+    # save to text, formatting each row with one combined format string
+    lines = ["# " + line for line in header.split("\n")]
+    lines.extend(format_dat_lines(data, dat_col_fmt))
+    with io.open(filename, 'w') as outfile:
+        outfile.write(u"\n".join(lines) + u"\n")
+
+    # and save the binary companion, rounded like the text
+    data = data.copy()
+    for name, fmt in zip(dat_col_names, dat_col_fmt):
+        if fmt.endswith('f'):
+            data[name] = round_to_format(data[name], fmt)
+    fred.write_fredbin(name_datbin(filename), data)
 
 def dicts_to_ndarray(dicts, dat_type="apass"):
     """Converts a dictionary to a structured numpy array in a .dat-friendly format"""
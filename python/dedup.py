@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# Duplicate detection for the zone data.
+#
+# Every row written to a zone's -raw.fredbin file is identified by a hash of
+# its FRED columns (see fred.fred_row_hashes). The hashes of the rows in a
+# zone are kept in an append-only file next to the zone file. Before data is
+# appended to a zone, rows whose hash occurs earlier in the data or in the
+# zone are dropped, so re-ingesting a FRED file (or a re-reduction of the same
+# night containing identical measurements) does not add the same measurement
+# twice. Dropped rows are recorded in the duplicates report, one line of
+# (filename, zone_id, num_within, num_existing) per file and zone where
+# num_within counts duplicates within the appended data and num_existing
+# duplicates of rows already in the zone.
+
+# system includes
+import argparse
+import datetime
+import os
+import sys
+import numpy as np
+
+# custom modules
+sys.path.append(os.path.join(sys.path[0],'modules', 'FileLock', 'filelock'))
+from filelock import FileLock
+
+# local includes
+import apass
+import fred
+
+duplicates_report_name = 'duplicates.log'
+
+hash_dtype = np.dtype('<u8')
+
+def name_hash_file(save_dir, zone_id):
+    """Returns the name of the row hash file of a zone in save_dir"""
+    return save_dir + '/' + apass.name_zone_hash_file(zone_id)
+
+def name_report_file(save_dir):
+    """Returns the name of the duplicates report in save_dir"""
+    return save_dir + '/' + duplicates_report_name
+
+def _zone_num_rows(zone_filename):
+    """Returns the number of rows in a zone file (None for legacy files)"""
+    if not os.path.isfile(zone_filename) or os.path.getsize(zone_filename) == 0:
+        return 0
+    if fred.is_legacy_fredbin(zone_filename):
+        return None
+    return fred.read_fredbin_info(zone_filename)['num_rows']
+
+def read_zone_hashes(save_dir, zone_id):
+    """Returns the hashes of the rows in a zone. If the hash file does not
+    match the zone file (e.g. the zone was written by an older version of the
+    pipeline or rows were purged from it) the hashes are computed from the
+    zone file and the hash file is rewritten."""
+
+    hash_filename = name_hash_file(save_dir, zone_id)
+    zone_filename = save_dir + '/' + apass.name_zone_file(zone_id)
+    num_rows = _zone_num_rows(zone_filename)
+
+    if os.path.isfile(hash_filename) and num_rows is not None and \
+       os.path.getsize(hash_filename) == num_rows * hash_dtype.itemsize:
+        return np.fromfile(hash_filename, dtype=hash_dtype, count=num_rows)
+
+    hashes = [np.zeros(0, dtype=hash_dtype)]
+    if num_rows != 0:
+        for data in fred.iter_fredbin(zone_filename):
+            hashes.append(fred.fred_row_hashes(data))
+    hashes = np.concatenate(hashes)
+
+    with open(hash_filename, 'wb') as outfile:
+        outfile.write(hashes.tobytes())
+
+    return hashes
+
+def remove_duplicates(save_dir, zone_id, data, sources):
+    """Drops rows from data which are duplicates of earlier rows in data or of
+    rows in the zone. sources is a list of (filename, num_rows) entries giving
+    the file each (consecutive) part of data was read from.
+
+    Returns the remaining data, their hashes and a dictionary with the
+    (num_within, num_existing) rows dropped from each file that had
+    duplicates."""
+
+    hashes = fred.fred_row_hashes(data)
+
+    # keep the first occurrence of each hash within data
+    unique = np.zeros(len(data), dtype='bool')
+    unique[np.unique(hashes, return_index=True)[1]] = True
+
+    existing = np.isin(hashes, read_zone_hashes(save_dir, zone_id))
+    keep = unique & np.logical_not(existing)
+
+    # attribute the duplicates to the files they were read from
+    duplicates = dict()
+    start = 0
+    for filename, num_rows in sources:
+        end = start + num_rows
+        num_existing = int(np.sum(existing[start:end]))
+        num_within = int(np.sum(np.logical_not(unique[start:end] | existing[start:end])))
+        if num_within + num_existing > 0:
+            within, existing_rows = duplicates.get(filename, (0, 0))
+            duplicates[filename] = (within + num_within, existing_rows + num_existing)
+        start = end
+
+    return data[keep], hashes[keep], duplicates
+
+def append_zone(save_dir, zone_id, data, sources):
+    """Appends data to the zone's -raw.fredbin file, dropping duplicate rows
+    (see remove_duplicates). The caller must hold the lock on the zone file
+    or otherwise ensure no other process writes to the zone. Returns a
+    dictionary with the (num_within, num_existing) rows dropped from each file
+    that had duplicates."""
+
+    data, hashes, duplicates = remove_duplicates(save_dir, zone_id, data, sources)
+
+    zone_filename = save_dir + '/' + apass.name_zone_file(zone_id)
+    if len(data) > 0:
+        fred.append_fredbin(zone_filename, data)
+
+    with open(name_hash_file(save_dir, zone_id), 'ab') as outfile:
+        outfile.write(hashes.tobytes())
+
+    if len(duplicates) > 0:
+        write_report(save_dir, zone_id, duplicates)
+
+    return duplicates
+
+def write_report(save_dir, zone_id, duplicates):
+    """Appends the duplicates dropped from a zone to the duplicates report"""
+
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    report_filename = name_report_file(save_dir)
+    with FileLock(report_filename, timeout=100, delay=0.05):
+        write_header = not os.path.isfile(report_filename)
+        with open(report_filename, 'a') as outfile:
+            if write_header:
+                outfile.write("date,filename,zone_id,num_within,num_existing\n")
+            for filename, (num_within, num_existing) in sorted(duplicates.items()):
+                outfile.write("%s,%s,%i,%i,%i\n" % (date, filename, zone_id,
+                                                    num_within, num_existing))
+
+def read_report(save_dir, offset=0):
+    """Reads the duplicates report starting at the specified byte offset.
+    Returns a list of (date, filename, zone_id, num_within, num_existing)
+    entries."""
+
+    report_filename = name_report_file(save_dir)
+    if not os.path.isfile(report_filename):
+        return []
+
+    entries = []
+    with open(report_filename, 'r') as infile:
+        infile.seek(offset)
+        for line in infile:
+            values = line.strip().split(',')
+            if len(values) != 5 or values[0] == 'date':
+                continue
+            date, filename, zone_id, num_within, num_existing = values
+            entries.append((date, filename, int(zone_id), int(num_within), int(num_existing)))
+
+    return entries
+
+def report_offset(save_dir):
+    """Returns the current size of the duplicates report, see read_report"""
+    report_filename = name_report_file(save_dir)
+    if not os.path.isfile(report_filename):
+        return 0
+    return os.path.getsize(report_filename)
+
+def summarize_report(entries):
+    """Returns a dictionary with the total (num_within, num_existing) rows
+    dropped from each file in the report entries"""
+    totals = dict()
+    for date, filename, zone_id, num_within, num_existing in entries:
+        within, existing = totals.get(filename, (0, 0))
+        totals[filename] = (within + num_within, existing + num_existing)
+    return totals
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Summarizes the duplicate rows dropped while importing FRED files')
+    parser.add_argument('save_dir', help="Directory containing the zone files")
+
+    args = parser.parse_args()
+
+    totals = summarize_report(read_report(args.save_dir))
+    for filename, (num_within, num_existing) in sorted(totals.items()):
+        print("%s %i %i" % (filename, num_within, num_existing))
+
+if __name__ == "__main__":
+    main()
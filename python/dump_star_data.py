@@ -12,6 +12,7 @@ from apass_types import IDLeaf, RectLeaf
 import apass
 import zone
 import fred
+import zone_index
 
 # import types from rect_to_dat
 from rect_to_dat import filter_config_data # class
@@ -22,11 +23,8 @@ from rect_to_dat import apass_min_num_observations
 
 def data_from_coordinate_pair(save_dir, x,y):
 
-    # load the global tree, find the zone_id to which this star belongs
-    global_tree_file = save_dir + "/global.json"
-    global_tree      = QuadTreeNode.from_file(global_tree_file, leafClass = IDLeaf)
-    leaf             = global_tree.find_leaf(x,y)
-    zone_id          = leaf.node_id
+    # find the zone_id to which this star belongs
+    zone_id = zone_index.zone_id(save_dir, x, y)
 
     # load the zone, extract the star's data
     zone_name = apass.name_zone(zone_id)
@@ -49,13 +47,15 @@ def data_from_coordinate_pair(save_dir, x,y):
 
 def data_from_unique_id(save_dir, zone_id, node_id, container_id):
 
-    zone_filename = save_dir + apass.name_zone(zone_id) + "-container.fredbin"
-    zone_data = fred.read_fredbin(zone_filename)
+    # locate the star using only the ID columns, then read its rows
+    ids = zone.read_zone_columns(save_dir, zone_id, ['node_id', 'container_id'])
+    indices = np.where((ids['node_id'] == node_id) &
+                       (ids['container_id'] == container_id))
 
-    indices = np.where((zone_data['node_id'] == node_id) &
-                       (zone_data['container_id'] == container_id))
-
-    data = zone_data[indices]
+    zone_filename = save_dir + apass.name_zone_container_file(zone_id)
+    zone_data = fred.open_fredbin(zone_filename, decode=False)
+    encoding = fred.read_fredbin_encoding(zone_filename)
+    data = fred.decode_fredbin(np.array(zone_data[indices]), encoding)
 
     return data
 
@@ -10,16 +10,30 @@ import os
 from quadtree import *
 from quadtree_types import *
 from apass import name_zone, north_zone_id, south_zone_id
+import fred
 
 # these are file extensions we expect to find in the save directory
 expected_extensions = [
     ".fredbin",              # stage 1
-    "-contrib.txt",          # stage 1
     "-container.fredbin",    # stage 2
     "-border-rects.json",    # stage 2
     ".dat"                   # stage 3
 ]
 
+def check_fredbin(filename):
+    """Reads the statistics of a fredbin file from its trailer. Returns a
+    description of the problem if the file is unreadable (e.g. truncated) or
+    empty, otherwise None."""
+    try:
+        stats = fred.read_fredbin_stats(filename)
+    except Exception as e:
+        return "unreadable (%s)" % (e)
+
+    if stats['num_rows'] == 0:
+        return "empty"
+
+    return None
+
 def main():
 
     parser = argparse.ArgumentParser(description='Identifies the state of the pipeline for each zone')
@@ -65,6 +79,14 @@ def main():
 
             if filename in saved_files:
                 saved_files.remove(filename)
+
+                # files that exist but cannot be used count as missing
+                if filename.endswith(".fredbin"):
+                    problem = check_fredbin(filename)
+                    if problem is not None:
+                        print("%s: %s" % (filename, problem))
+                        missing_extensions.append(extension)
+                        stages[extension].append(filename)
             else:
                 missing_extensions.append(extension)
                 stages[extension].append(filename)
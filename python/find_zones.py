@@ -5,10 +5,8 @@ import argparse
 import os
 
 # locals
-from quadtree import *
-from quadtree_types import *
-from apass_types import IDLeaf
 from apass import name_zone
+import zone_index
 
 def main():
 
@@ -27,20 +25,19 @@ def main():
         quit()
 
     save_dir = os.path.abspath(args.save_dir) + "/"
-    tree_file   = save_dir + "/global.json"
-
-    # load the zone quadtree
-    tree = QuadTreeNode.from_file(tree_file, leafClass=IDLeaf)
 
     # execute the search
     zone_ids = []
     if num_coords == 2:
         # simple (x,y) pair, simply find the leaf
         x,y = coords
-        leaf = tree.find_leaf(x,y)
-        zone_ids.append(leaf.node_id)
+        zone_id = zone_index.zone_id(save_dir, x, y)
+        if zone_id is not None:
+            zone_ids.append(zone_id)
     elif num_coords == 4:
-        print("Not implemented")
+        # (x_min, y_min, x_max, y_max) quad, find all overlapping zones
+        x_min, y_min, x_max, y_max = coords
+        zone_ids = zone_index.zone_ids_in_rect(save_dir, x_min, y_min, x_max, y_max)
 
     for zone_id in zone_ids:
         print(name_zone(zone_id))
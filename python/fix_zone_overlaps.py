@@ -17,9 +17,11 @@ import matplotlib.pyplot as plt
 
 # local includes
 import apass
-from quadtree import QuadTreeNode
 from quadtree_types import *
+import zone
 from zone import load_zone, save_zone
+import zone_index
+from fred import fredbin_codecs, set_fredbin_codec
 
 def get_active_indices(i, j, stride):
     """Returns list of indices selected from (i,j) in steps of stride in each direction."""
@@ -41,107 +43,12 @@ def get_active_indices(i, j, stride):
     return output
 
 
-def get_adjacent_zone_ids(i, j):
-    """Returns zones that should be regarded as adjacent to the specified zone.
-
-    This function behaves as follows:
-     * A polar zone: Returns the entire adjacent row
-     * First row before/after a polar zone: Six adjacent zones that are not the polar zone
-     * All others: The eight zones surrounding the zone of interest
-    """
-
-    global global_tree
-    global height
-    global width
-
-    #print("Finding adjacent nodes for %i %i" % (i, j))
-
-    adj_zone_indices = []
-
-    # North Polar Zone
-    if j == 0:
-        for k in range(0, width):
-            adj_zone_indices.append((k, j + 1))
-
-    # Southern Polar Zone
-    elif j == height - 1:
-        for k in range(0, width):
-            adj_zone_indices.append((k, j - 1))
-
-    # first row after a polar zone
-    elif j == 1:
-        for k in range(-1, 2):
-            for l in range(0, 2):
-                if k == 0 and l == 0:
-                    continue
-                adj_zone_indices.append((i + k, j + l))
-
-    # first row before a polar zone
-    elif j == height - 2:
-        for k in range(-1, 2):
-            for l in range(-1, 1):
-                if k == 0 and l == 0:
-                    continue
-                adj_zone_indices.append((i + k, j + l))
-
-    # all other cases
-    # return a the 3x3 block surrounding (i,j)
-    else:
-        for k in range(-1, 2):
-            for l in range(-1, 2):
-                if k == 0 and l == 0:
-                    continue
-
-                adj_zone_indices.append((i + k, j + l))
-
-    #print "Adjacent zones: "
-    #print adj_zone_indices
-
-    adj_zone_ids = []
-    for k,l in adj_zone_indices:
-        adj_zone_id = get_zone_id_from_indices(k, l)
-        adj_zone_ids.append(adj_zone_id)
-    return adj_zone_ids
-
-def get_zone_id_from_indices(i,j):
-    """Returns a reference to the zone in the global tree given
-    the (i,j) indices of the zone in the tree.
-
-    Requires that the width, height, and global_tree are loaded into
-    the global namespace.
-    """
-    global width
-    global height
-
-    i = i % width
-    j = j % height
-
-    # compute the center of the zone
-    dRA = float(360) / width
-    dDEC = float(180) / height
-    x = float(i) / width * 360 + dRA / 2
-    y = float(j) / height * 180 - 90 + dDEC / 2
-
-    #print i, j, x, y
-
-    zone_id = get_zone_id_from_coordinates(x,y)
-    return zone_id
-
-def get_zone_id_from_coordinates(x,y):
-    """Returns a reference to a zone in the global tree given the specified
-    (x,y) coordinates.
-
-    Requires the global_tree is loaded into the global namespace."""
-    global global_tree
-    leaf = global_tree.find_leaf(x,y)
-    return leaf.node_id
-
 def lookup_zone_ids(save_dir, zone_position):
 
     # Get this zone and its ID
     i,j = zone_position
-    zone_id      = get_zone_id_from_indices(i,j)
-    adj_zone_ids = get_adjacent_zone_ids(i, j)
+    zone_id      = zone_index.zone_id_from_indices(save_dir, i, j)
+    adj_zone_ids = zone_index.adjacent_zone_ids(save_dir, i, j)
 
     return zone_id, adj_zone_ids
 
@@ -153,18 +60,12 @@ def fix_overlaps_from_positions(save_dir, zone_position):
                     zone within the over-all problem space
     """
 
-    # load the global tree
-    global global_tree
-    global_tree_filename = save_dir + "/global.json"
-    global_tree = QuadTreeNode.from_file(global_tree_filename, leafClass=IDLeaf)
-
     zone_id, adjacent_zone_ids = lookup_zone_ids(save_dir, zone_position)
 
     fix_overlaps(save_dir, zone_id, adjacent_zone_ids)
 
 def fix_overlaps(save_dir, zone_id, adjacent_zone_ids):
     """Fixes overlapping containers between adjacent zones.
-    NOTE: Requires global_tree_filename to be loaded into the global namespace!
 
     save_dir - the directory containing zone files
     zone_id - ID (int) of primary zone of interest for overlap detection
@@ -173,10 +74,6 @@ def fix_overlaps(save_dir, zone_id, adjacent_zone_ids):
 
     print("Processing Zone: %i" % (zone_id))
 
-    global global_tree
-    global_tree_filename = save_dir + "/global.json"
-    global_tree = QuadTreeNode.from_file(global_tree_filename, leafClass=IDLeaf)
-
     # Load the zone
     zone_dict = load_zone(save_dir, zone_id)
     tree = zone_dict['tree']
@@ -221,8 +118,7 @@ def fix_overlaps(save_dir, zone_id, adjacent_zone_ids):
         for c_x, c_y in corners:
             c_x, c_y = apass.wrap_bounds(c_x, c_y)
 
-            adj_zone = global_tree.find_leaf(c_x, c_y)
-            adj_zone_id = adj_zone.node_id
+            adj_zone_id = zone_index.zone_id(save_dir, c_x, c_y)
 
             # skip corners that are within this zone
             if adj_zone_id == zone_id:
@@ -251,6 +147,7 @@ def fix_overlaps(save_dir, zone_id, adjacent_zone_ids):
                 print(" merging %s into %s" % (src_name, dest_name))
                 container.merge(adj_container)
                 adj_node.remove_container(adj_container)
+                node.update_container(container)
 
                 # remove the adjacent container from the border info file
                 if src_name in adj_border_infos.keys():
@@ -272,11 +169,17 @@ def main():
                         help="Run in debug mode")
     parser.add_argument('--zone', type=int, nargs='+',
                         help="Zone IDs for primary and ajacent zones to inspect.")
+    parser.add_argument('--codec', default='none', choices=fredbin_codecs,
+                        help="Compression used for new fredbin files")
+    parser.add_argument('--column-store', default=False, action='store_true',
+                        help="Also write a -columns directory for each container file")
     parser.set_defaults(jobs=1)
 
     # parse the command line arguments and start timing the script
     args = parser.parse_args()
     start = time.time()
+    set_fredbin_codec(args.codec)
+    zone.zone_column_stores = args.column_store
 
 
     # determine the size of the image
@@ -368,10 +271,6 @@ def main():
 
 def move_zero_edge_data(save_dir):
     """Moves any data whose containers have an edge with ra < 0 +360 degrees away"""
-    global global_tree
-    global_tree_filename = save_dir + "/global.json"
-    global_tree = QuadTreeNode.from_file(global_tree_filename, leafClass=IDLeaf)
-
     global height
 
     print("Processing zones on RA = 0 edge")
@@ -379,8 +278,8 @@ def move_zero_edge_data(save_dir):
     # first move data near RA ~ 0 to RA 360+
     for j in range(1, height - 2):
         # get the left and right edge zones
-        zone_id = get_zone_id_from_indices(width-1, j)
-        adj_zone_id = get_zone_id_from_indices(0, j)
+        zone_id = zone_index.zone_id_from_indices(save_dir, width-1, j)
+        adj_zone_id = zone_index.zone_id_from_indices(save_dir, 0, j)
 
         # run the fix-overlaps function, but flip the order of the zones
         # to ensure data gets moved from zone_id to adj_zone_id
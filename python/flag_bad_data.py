@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import argparse
 import numpy as np
+import numpy.lib.recfunctions as nprf
 import os
 import traceback
 import multiprocessing as mp
@@ -29,23 +30,25 @@ def flag_bad_data(bad_night_file, bad_field_file, filename):
         bad_night_names = badfiles.read_bad_nights(bad_night_file)
         bad_fields = badfiles.read_bad_night_fields(bad_field_file)
 
-        # read in the data and sort it by night
-        data = fred.read_fredbin(filename)
+        # read in the data, leaving the exposure-level columns encoded
+        data = fred.read_fredbin(filename, decode=False)
+        encoding = fred.read_fredbin_encoding(filename)
 
-        # Any given filter should ONLY set 'use_data' flags to False to avoid
-        # impacting other filters.
-        data = np.sort(data, order='night_name')
-        data = filter_bad_nights(data, bad_night_names)
-        data = np.sort(data, order='night')
-        data = filter_bad_night_fields(data, bad_fields)
-        data = filter_non_photometric_nights(data)
+        # Flag the bad exposures in the exposure table, then the data taken
+        # during those exposures. Any given filter should ONLY set 'use_data'
+        # flags to False to avoid impacting other filters.
+        exposures, exposure_ids = fred.exposure_table(data, encoding)
+        use_data = np.ones(len(exposures), dtype='bool')
+        exposures = nprf.append_fields(exposures, 'use_data', use_data, usemask=False)
+        exposures = filter_bad_nights(exposures, bad_night_names)
+        exposures = filter_bad_night_fields(exposures, bad_fields)
+        exposures = filter_non_photometric_nights(exposures)
 
-        # restore the original order of the data
-        data = np.sort(data, order=['zone_id', 'node_id', 'container_id'])
+        bad_data = np.logical_not(exposures['use_data'][exposure_ids])
+        data['use_data'][bad_data] = False
 
         # write the data
-        outfile = open(filename, 'w')
-        fred.write_fredbin(outfile, data)
+        fred.write_fredbin(filename, data, encoding=encoding)
 
     except:
         message = "ERROR: Failed to flag %s. Re-run in debug mode\n" % (filename)
@@ -67,50 +70,41 @@ def filter_non_photometric_nights(data):
     return data
 
 
-def filter_bad_nights(data, bad_night_names):
+def filter_bad_nights(data, bad_night_names, encoding=dict()):
     """Sets the 'use_data' flag to False for nights that are identified as
     bad nights.
     Input:
     data - numpy array loaded using fred.read_fredbin
     bad_nights - numpy array loaded using badfiles.read_bad_nights
+    encoding - encoding of data, if it was loaded with decode=False
 
     Returns:
     modified numpy array in fredbin format
     """
 
-    # iterate over the bad night entries, flagging data as required
-    for i in range(0, len(bad_night_names)):
-        # extract the bad (numeric) night and corresponding night name
-        night_name  = bad_night_names['night_name'][i]  # string
+    # compare the night name codes rather than the names
+    codes, bad_codes = fred.column_codes(data, encoding, 'night_name',
+                                         bad_night_names['night_name'])
+    bad_codes = bad_codes[bad_codes >= 0]
 
-        # find upper and lower bounds for the night
-        l = np.searchsorted(data['night_name'], night_name, side='left')
-        u = np.searchsorted(data['night_name'], night_name, side='right')
-
-        # iterate over each candidate and flag if the night name
-        for j in range(l, u):
-            data['use_data'][j] = False
+    indexes = np.isin(codes, bad_codes)
+    data['use_data'][indexes] = False
 
     return data
 
-def filter_bad_night_fields(data, bad_nights_fields):
+def filter_bad_night_fields(data, bad_nights_fields, encoding=dict()):
     """Sets the 'use_data' flag to False for fields on specific nights that
     have been identified as bad.  Returns the modified data array"""
 
-    for i in range(0, len(bad_nights_fields)):
-        # extract the bad (numeric) night and corresponding field name
-        night = bad_nights_fields['night'][i] # integer
-        field_id = bad_nights_fields['field_id'][i] # string
+    # combine the (numeric) night and field code into a single key
+    codes, bad_codes = fred.column_codes(data, encoding, 'field_id',
+                                         bad_nights_fields['field_id'])
+    keys = data['night'].astype('int64') * 2**32 + codes
+    bad_keys = bad_nights_fields['night'].astype('int64') * 2**32 + bad_codes
+    bad_keys = bad_keys[bad_codes >= 0]
 
-        # find upper and lower bounds for the night
-        l = np.searchsorted(data['night'], night, side='left')
-        u = np.searchsorted(data['night'], night, side='right')
-
-        # iterate over each candidate night and flag if the field
-        # name is a precise match.
-        for j in range(l, u):
-            if data['field_id'][j] == field_id:
-                data['use_data'][j] = False
+    indexes = np.isin(keys, bad_keys)
+    data['use_data'][indexes] = False
 
     return data
 
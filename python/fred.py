@@ -2,9 +2,29 @@
 
 # system includes
 import os
+import io
+import glob
+import json
+import struct
+import hashlib
+import zlib
+import gzip
+import bz2
+import threading
 import numpy as np
 import numpy.lib.recfunctions as nprf
-from copy import copy
+from copy import copy, deepcopy
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 # FRED files have the following format:
 # STANDARD MAGNITUDES ONLY
@@ -49,8 +69,110 @@ freddat_col_fmt = copy(fredbin_col_fmt)
 freddat_extra_col_fmt = ['%2.0f']
 freddat_col_fmt.extend(freddat_extra_col_fmt)
 
+# FREDBIN files are stored in a chunk-indexed (v2) container format:
+#
+#   [magic][version, header length][header JSON]   (padded to fredbin_align bytes)
+#   [block 0][block 1]...[block N-1]               (raw or compressed records)
+#   [trailer JSON][footer]
+#
+# The header JSON stores the dtype of the records and the codec used for the
+# blocks. The trailer JSON stores the block index as a list of
+# [offset, num_rows, num_bytes] entries and the dictionaries of any
+# dictionary-encoded columns (see below). The fixed-size footer
+# holds the offset and length of the trailer so it can be found from the end
+# of the file. Appended blocks are written directly after the last block, thus
+# the record blocks are always contiguous, and may be followed by unused space
+# ahead of the trailer. Appends never overwrite the trailer in use: if the new
+# block would, a copy of the trailer is first written past the end of the
+# file. If an append is interrupted, readers scan back from the end of the
+# file to the last complete footer, see _find_fredbin_trailer. Legacy files
+# (concatenated numpy.save chunks) can still be read and are upgraded the
+# first time they are appended to.
+fredbin_magic        = b'\x93FREDBIN'
+fredbin_version      = 2
+fredbin_align        = 64
+fredbin_header_fmt   = '<HI'   # version, header length
+fredbin_footer_fmt   = '<QQ8s' # trailer offset, trailer length, magic
+fredbin_footer_magic = b'FBINDEX2'
+
+# Appends are flushed to disk (os.fsync) before the new trailer is written
+fredbin_sync = True
+legacy_fredbin_magic = b'\x93NUMPY'
+
+# Blocks may be compressed with one of the following codecs. Compressed blocks
+# hold at most fredbin_block_rows records and are decompressed independently,
+# using up to fredbin_read_threads threads. Compressed files cannot be memory
+# mapped. New files are written with fredbin_codec, see set_fredbin_codec.
+fredbin_codecs = ['none', 'zlib']
+if lzma is not None:
+    fredbin_codecs.append('lzma')
+fredbin_codec        = 'none'
+fredbin_block_rows   = 65536
+fredbin_read_threads = 4
+
+# Columns that are identical for every star measured on the same frame are
+# stored once per exposure in a per-file exposure table, and each record holds
+# an exposure_id into that table instead. Other string columns with few
+# distinct values are stored as integer codes into a per-file dictionary.
+# Both are extended as blocks are appended. Readers decode these columns
+# unless asked not to, see encode_fredbin and decode_fredbin.
+fredbin_exposure_columns   = ['hjd', 'airmass', 'set', 'group', 'field_id',
+                              'filter_id', 'night', 'sys', 'exposure_time',
+                              'flag1', 'night_name']
+fredbin_exposure_id        = 'exposure_id'
+fredbin_exposure_min_rows  = 2 # minimum average number of records per exposure
+fredbin_dictionary_columns = ['field_id', 'night_name']
+fredbin_code_type          = 'int32'
+
+# The trailer also holds statistics of the records (see fredbin_stats) which
+# are updated whenever a block is appended, so that summaries of a file can be
+# obtained without reading its records: the number of rows, the [min, max]
+# range of the fredbin_stats_range_columns and the number of rows for each
+# value of the fredbin_stats_count_columns (keyed by the names in the trailer).
+fredbin_stats_range_columns = ['ra', 'dec', 'hjd']
+fredbin_stats_count_columns = [('filters', 'filter_id'), ('nights', 'night_name'),
+                               ('fields', 'field_id')]
+
+# Column stores hold the records of a fredbin file as a directory containing
+# one numpy .npy file per column and a JSON manifest, so individual columns
+# can be read (or memory mapped) without touching the others. The manifest
+# records the size and modification time of the fredbin file the columns were
+# made from so stale column stores can be detected.
+fredcols_manifest = 'manifest.json'
+fredcols_version  = 1
+
+# FRED files are parsed in blocks of this many bytes.
+fred_block_size = 16 * 1024 * 1024
+
+# FRED files may be compressed (e.g. n141024.fred.gz). These are recognized by
+# their extension and decompressed while they are read. Decompression runs in
+# a background thread, at most fred_read_ahead blocks ahead of the parser.
+fred_compression_extensions = ['.gz', '.bz2', '.xz']
+fred_decompressors = {'.gz': gzip.GzipFile, '.bz2': bz2.BZ2File}
+if lzma is not None:
+    fred_decompressors['.xz'] = lzma.LZMAFile
+fred_read_ahead = 4
+
+# default number of rows yielded by iter_fred and iter_fredbin
+fred_batch_rows = 100000
+
+# reasons for which lines in FRED files are skipped, see make_fred_report
+fred_bad_line_reasons = ['missing columns', 'extra columns', 'invalid values']
+
+# Optional cache of parsed FRED files, see enable_fred_cache. Increment the
+# version whenever a change to the parser invalidates previously cached data.
+fred_cache_dir       = None
+fred_cache_max_bytes = 100 * 1024**3
+fred_cache_version   = 1
+
 def night_from_filename(filename):
     filename = os.path.basename(filename)
+
+    # strip the compression extension of compressed FRED files
+    base, extension = os.path.splitext(filename)
+    if extension in fred_compression_extensions:
+        filename = base
+
     night = os.path.splitext(filename)[0]
 
     return night
@@ -67,132 +189,1387 @@ def compare_fred_data(A, B):
 
     return same_point
 
-def read_fred_manual(filename):
-    """Reads and tokenizes a FRED file using (simplistic) parsing methods.
-    Lines with errors will generate a warning message.
+def fred_row_hashes(data):
+    """Returns a 64-bit hash of the FRED columns (fred_col_names) of each
+    record in data. Records that were read from identical FRED lines have
+    the same hash regardless of the file they were read from. The records are
+    hashed as raw bytes, eight bytes at a time, for all records at once."""
+
+    data = project_fields(data, fred_col_names)
+    num_rows = len(data)
+    width = data.dtype.itemsize
+
+    # pad the records to a whole number of 64-bit words
+    num_words = (width + 7) // 8
+    buf = np.zeros((num_rows, num_words * 8), dtype=np.uint8)
+    buf[:, 0:width] = data.view(np.uint8).reshape(num_rows, width)
+    words = buf.view('<u8')
+
+    # FNV-1a over the words followed by the splitmix64 finalizer
+    hashes = np.empty(num_rows, dtype=np.uint64)
+    hashes[:] = np.uint64(0xcbf29ce484222325)
+    for k in range(0, num_words):
+        hashes ^= words[:, k]
+        hashes *= np.uint64(0x100000001b3)
+
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+
+    return hashes
+
+def make_fred_report(filename):
+    """Creates a report describing the outcome of parsing a FRED file. The
+    report is a dictionary with the following keys:
+     * filename
+     * num_lines - number of lines read, including comments
+     * num_rows  - number of rows successfully parsed
+     * bad_lines - list of (line_number, reason) tuples for skipped lines.
+                   Line numbers start at 1."""
+    report = dict()
+    report['filename']  = filename
+    report['num_lines'] = 0
+    report['num_rows']  = 0
+    report['bad_lines'] = []
+    return report
+
+def print_fred_report(report):
+    """Prints warning messages for any lines skipped while parsing a FRED file."""
+
+    for reason in fred_bad_line_reasons:
+        line_numbers = [str(n) for n, r in report['bad_lines'] if r == reason]
+        if len(line_numbers) > 0:
+            print("WARNING:%s has %s on lines %s" % (report['filename'], reason,
+                                                     ",".join(line_numbers)))
+
+def fred_compression(filename):
+    """Returns the compression extension of a FRED file (e.g. '.gz') or None
+    if the file is not compressed."""
+    extension = os.path.splitext(filename)[1]
+    if extension in fred_compression_extensions:
+        return extension
+    return None
+
+def open_fred(filename):
+    """Opens a (possibly compressed) FRED file for reading in binary mode.
+    Compressed files are decompressed as they are read."""
+
+    extension = fred_compression(filename)
+    if extension is None:
+        return io.open(filename, 'rb')
+    if extension not in fred_decompressors:
+        raise IOError("Cannot decompress %s, unsupported compression '%s'" % (filename, extension))
+
+    return fred_decompressors[extension](filename, 'rb')
+
+def _read_fred_blocks(filename):
+    """Yields the (decompressed) contents of a FRED file in blocks of
+    fred_block_size bytes. Compressed files are decompressed by a background
+    thread so decompression overlaps the processing of the blocks."""
+
+    if fred_compression(filename) is None:
+        with open_fred(filename) as infile:
+            while True:
+                buf = infile.read(fred_block_size)
+                if len(buf) == 0:
+                    break
+                yield buf
+        return
+
+    blocks = queue.Queue(fred_read_ahead)
+    stop = threading.Event()
+
+    def decompress():
+        try:
+            with open_fred(filename) as infile:
+                while not stop.is_set():
+                    buf = infile.read(fred_block_size)
+                    blocks.put(buf)
+                    if len(buf) == 0:
+                        break
+        except Exception as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            buf = blocks.get()
+            if isinstance(buf, Exception):
+                raise buf
+            if len(buf) == 0:
+                break
+            yield buf
+    finally:
+        # stop the thread, emptying the queue in case it is blocked on it
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+def _read_fred_lines(filename):
+    """Reads a FRED file in large blocks. Yields (line_number, lines) tuples
+    where line_number is the (1-based) number of the first line in the block."""
+
+    line_number = 1
+    remainder = b''
+    for buf in _read_fred_blocks(filename):
+        lines = (remainder + buf).split(b'\n')
+        remainder = lines.pop()
+
+        yield line_number, lines
+        line_number += len(lines)
 
-    This function handles errors in the FRED files more gracefully than
-    read_fred, but is significantly slower.
-    """
+    if len(remainder) > 0:
+        yield line_number, [remainder]
 
-    # define a flags
-    flag_missing_columns = False
-    missing_column_lines = []
-    flag_extra_columns   = False
-    extra_column_lines   = []
+def _convert_fred_columns(tokens, out):
+    """Converts a 2D array of FRED tokens (one row per line) into the FRED
+    columns of out. Raises ValueError if any token cannot be converted."""
+
+    for i in range(0, len(fred_col_names)):
+        name = fred_col_names[i]
+        col_type = fred_col_types[i]
+        column = tokens[:, i]
+
+        if col_type == 'bool':
+            out[name] = column.astype('int32') != 0
+        else:
+            out[name] = column.astype(col_type)
+
+def _parse_fred_lines(line_number, lines, out, report):
+    """Parses a block of FRED lines directly into the preallocated array out,
+    which must hold at least len(lines) rows. Malformed lines are skipped and
+    recorded in the report. Returns the number of rows written to out."""
 
-    data = []
     num_fred_cols = len(fred_col_names)
-    dtype={'names': fred_col_names,'formats': fred_col_types}
-
-    line_number = -1
-    with open(filename, 'r') as infile:
-        for line in infile:
-            # advance the line number
-            line_number += 1
-
-            # remove whitespace from the lines
-            line = line.strip()
-
-            # skip comment lines
-            if line[0] == "#":
-                continue
-
-            # tokenize the line
-            line = line.split()
-
-            # skip any lines that don't match our expected format
-            if len(line) < num_fred_cols:
-                flag_missing_columns = True
-                missing_column_lines.append(line_number)
-                continue
-
-            if len(line) > num_fred_cols:
-                flag_extra_columns = True
-                extra_column_lines.append(line_number)
-                continue
-
-            # initial checks are ok. Append the data.
-            data.append(line)
-    # print any error messages
-    if flag_missing_columns:
-        err_str = "WARNING:" + filename + " is missing required columns on lines " \
-                  + ",".join(map(str, missing_column_lines))
-        print(err_str)
-
-    if flag_extra_columns:
-        err_str = "WARNING:" + filename + " contains extra columns on lines " \
-                  + ",".join(map(str, extra_column_lines))
-        print(err_str)
-
-    # no data, return None
-    if len(data) == 0:
-        return None
 
-    # Convert the data into a numpy array:
-    data = np.asarray(data, dtype=dtype)
-    return data
+    # tokenize the lines, skipping comments and blank lines
+    rows = []
+    row_line_numbers = []
+    for line in lines:
+        if b'#' in line:
+            line = line[:line.index(b'#')]
+        tokens = line.split()
+
+        if len(tokens) == 0:
+            pass
+        elif len(tokens) < num_fred_cols:
+            report['bad_lines'].append((line_number, 'missing columns'))
+        elif len(tokens) > num_fred_cols:
+            report['bad_lines'].append((line_number, 'extra columns'))
+        else:
+            rows.append(tokens)
+            row_line_numbers.append(line_number)
+
+        line_number += 1
+
+    report['num_lines'] += len(lines)
+    num_rows = len(rows)
+    if num_rows == 0:
+        return 0
+
+    # convert the entire block at once. If a value cannot be converted, fall
+    # back to converting this block line by line to find the culprit(s).
+    tokens = np.array(rows)
+    try:
+        _convert_fred_columns(tokens, out[0:num_rows])
+    except ValueError:
+        num_rows = 0
+        for i in range(0, len(rows)):
+            try:
+                _convert_fred_columns(tokens[i:i+1], out[num_rows:num_rows+1])
+                num_rows += 1
+            except ValueError:
+                report['bad_lines'].append((row_line_numbers[i], 'invalid values'))
+
+    report['num_rows'] += num_rows
+    return num_rows
+
+def parse_fred(filename):
+    """Parses an APASS FRED file in a single pass. Returns a (data, report)
+    tuple where data is a numpy structured array in fredbin format (or None
+    if the file contained no valid rows) and report is described in
+    make_fred_report."""
+
+    report = make_fred_report(filename)
+    dtype={'names': fredbin_col_names,'formats': fredbin_col_types}
+
+    data = None
+    num_rows = 0
+    for line_number, lines in _read_fred_lines(filename):
+
+        # Size the output using the line length in the first block, then grow
+        # it geometrically if that estimate turns out to be too small (e.g.
+        # for compressed files).
+        if data is None:
+            block_size = sum([len(line) + 1 for line in lines])
+            capacity = int(os.path.getsize(filename) * len(lines) / max(block_size, 1))
+            data = np.zeros(max(capacity, len(lines)), dtype=dtype)
+        elif num_rows + len(lines) > len(data):
+            capacity = max(num_rows + len(lines), int(len(data) * 1.5))
+            temp = np.zeros(capacity, dtype=dtype)
+            temp[0:num_rows] = data[0:num_rows]
+            data = temp
+
+        num_rows += _parse_fred_lines(line_number, lines, data[num_rows:], report)
+
+    if num_rows == 0:
+        return None, report
+
+    # fill in the fredbin columns. zone_id, node_id, and container_id are zero.
+    data = data[0:num_rows]
+    data['night_name'] = night_from_filename(filename)
+    data['use_data'] = True
+
+    return data, report
+
+def _iter_fred_text(filename, batch_rows, report):
+    """Parses an APASS FRED file incrementally. See iter_fred."""
+
+    print_report = report is None
+    if report is None:
+        report = make_fred_report(filename)
+
+    dtype={'names': fredbin_col_names,'formats': fredbin_col_types}
+    night_name = night_from_filename(filename)
+
+    batch = np.zeros(batch_rows, dtype=dtype)
+    num_rows = 0
+    for line_number, lines in _read_fred_lines(filename):
+
+        # parse at most as many lines as there are free rows in the batch
+        start = 0
+        while start < len(lines):
+            stop = start + batch_rows - num_rows
+            num_rows += _parse_fred_lines(line_number + start, lines[start:stop],
+                                          batch[num_rows:], report)
+            start = stop
+
+            if num_rows == batch_rows:
+                batch['night_name'] = night_name
+                batch['use_data'] = True
+                yield batch
+
+                batch = np.zeros(batch_rows, dtype=dtype)
+                num_rows = 0
+
+    if num_rows > 0:
+        batch = batch[0:num_rows]
+        batch['night_name'] = night_name
+        batch['use_data'] = True
+        yield batch
+
+    if print_report:
+        print_fred_report(report)
+
+def iter_fred(filename, batch_rows=fred_batch_rows, report=None):
+    """Parses an APASS FRED file incrementally, yielding numpy structured arrays
+    in fredbin format with batch_rows rows each (the last batch may be
+    shorter). Memory use is bounded by the batch and parsing block sizes.
+
+    If a report (see make_fred_report) is supplied, skipped lines are recorded
+    in it, otherwise warnings are printed once the file has been read.
+
+    If the FRED cache is enabled (see enable_fred_cache), batches are read from
+    the cache when possible and newly parsed files are added to it."""
+
+    if fred_cache_dir is None:
+        for batch in _iter_fred_text(filename, batch_rows, report):
+            yield batch
+        return
+
+    cache_filename = fred_cache_lookup(filename)
+    if os.path.isfile(cache_filename):
+        for batch in iter_fredbin(cache_filename, batch_rows=batch_rows):
+            yield batch
+        return
+
+    # Copy the batches into a temporary cache file as they are parsed. The
+    # file is only moved into the cache if the whole FRED file was read.
+    temp_filename = _fred_cache_temp_filename(cache_filename)
+    if os.path.isfile(temp_filename):
+        os.remove(temp_filename)
+
+    try:
+        for batch in _iter_fred_text(filename, batch_rows, report):
+            append_fredbin(temp_filename, batch)
+            yield batch
+
+        if os.path.isfile(temp_filename):
+            fred_cache_store(temp_filename, cache_filename)
+    finally:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
 
 def read_fred(filename):
     """Reads in an APASS FRED file and returns the result as a numpy structured
     array with columns as specified in fred_col_names plus fredbin.fredbin_extra_cols.
-    In rare situations, this function can return None."""
-    dtype={'names': fred_col_names,'formats': fred_col_types}
-    data = []
+    Malformed lines are skipped with a warning. If the file contains no
+    valid data, this function returns None.
+
+    If the FRED cache is enabled (see enable_fred_cache), the parsed data are
+    read from (or added to) the cache."""
+
+    cache_filename = None
+    if fred_cache_dir is not None:
+        cache_filename = fred_cache_lookup(filename)
+        if os.path.isfile(cache_filename):
+            return read_fredbin(cache_filename)
+
+    data, report = parse_fred(filename)
+    print_fred_report(report)
+
+    if cache_filename is not None and data is not None:
+        temp_filename = _fred_cache_temp_filename(cache_filename)
+        write_fredbin(temp_filename, data)
+        fred_cache_store(temp_filename, cache_filename)
+
+    return data
+
+def _descr_to_dtype(descr):
+    """Converts a JSON-decoded dtype description back into a numpy dtype."""
+    fields = []
+    for name, fmt in descr:
+        fields.append((str(name), str(fmt)))
+
+    return np.dtype(fields)
+
+def _lookup_codes(values, lookup):
+    """Returns the index of each element of values in the array lookup, or -1
+    if the element is not present."""
+    codes = np.full(len(values), -1, dtype=fredbin_code_type)
+    if len(lookup) == 0 or len(values) == 0:
+        return codes
+
+    order = np.argsort(lookup)
+    pos = np.searchsorted(lookup[order], values)
+    pos[pos == len(lookup)] = 0
+    found = lookup[order][pos] == values
+    codes[found] = order[pos[found]]
+
+    return codes
+
+def _dictionary_values(encoding, name):
+    """Returns the dictionary of an encoded column as a numpy array."""
+    entry = encoding[name]
+    return np.array(entry['values'], dtype=entry['type']).reshape(-1)
+
+def _row_keys(data):
+    """Returns the rows of a packed structured array as opaque byte strings
+    which can be sorted and compared."""
+    return np.ascontiguousarray(data).view(np.dtype((np.void, data.dtype.itemsize)))
+
+def make_exposure_table(data, exposures=None):
+    """Splits the exposure-level columns (fredbin_exposure_columns) of data
+    into a table with one row per distinct exposure. Returns the table and
+    the index of each record's exposure in it. If exposures is given, new
+    exposures are appended to a copy of it."""
+
+    rows = project_fields(data, fredbin_exposure_columns)
+    if exposures is None:
+        exposures = rows[0:0]
+
+    # look up the distinct exposures, adding new ones to the table
+    uniques, inverse = np.unique(_row_keys(rows), return_inverse=True)
+    ids = _lookup_codes(uniques, _row_keys(exposures))
+    missing = ids < 0
+    ids[missing] = len(exposures) + np.arange(np.sum(missing))
+    exposures = np.concatenate([exposures, uniques[missing].view(rows.dtype)])
+
+    return exposures, ids[inverse]
+
+def _table_entry(encoding, name):
+    """Returns the code column and entry of the table holding the column name,
+    or (None, None) if name is not part of a table."""
+    for code_name, entry in encoding.items():
+        if 'columns' in entry and name in entry['values'].dtype.names:
+            return code_name, entry
+
+    return None, None
+
+def _decoded_dtype(dtype, encoding):
+    """Returns the dtype of records of the specified dtype after decoding."""
+    types = dict()
+    names = dtype.names
+    for name in dtype.names:
+        types[name] = dtype[name]
+
+    for code_name, entry in encoding.items():
+        if 'columns' in entry:
+            names = entry['names']
+            for name in entry['values'].dtype.names:
+                types[name] = entry['values'].dtype[name]
+        else:
+            types[code_name] = np.dtype(str(entry['type']))
+
+    return np.dtype([(str(name), types[name]) for name in names])
+
+def encode_fredbin(data, encoding=None):
+    """Replaces the exposure-level columns of data by an exposure_id and the
+    dictionary-encoded string columns by integer codes. Returns the encoded
+    data and the encoding, a dictionary keyed by code column name. Entries for
+    dictionary-encoded columns hold the original column 'type' and the
+    dictionary 'values'. The exposure table entry holds the original field
+    order in 'names' and the table itself (a structured array) in 'values'.
+
+    If encoding is None, the exposure table and the remaining
+    fredbin_dictionary_columns are encoded from scratch. The exposure table is
+    only used if data has all of the fredbin_exposure_columns and at least
+    fredbin_exposure_min_rows records per exposure on average. Otherwise the
+    columns in encoding are encoded, and values missing from their
+    dictionaries and tables are appended to them."""
+
+    if encoding is None:
+        encoding = dict()
+        names = data.dtype.names or []
+        use_table = all([name in names for name in fredbin_exposure_columns])
+        if use_table:
+            exposures, exposure_ids = make_exposure_table(data)
+            use_table = len(exposures) * fredbin_exposure_min_rows <= len(data)
+        if use_table:
+            entry = dict()
+            entry['names'] = list(names)
+            entry['values'] = project_fields(data[0:0], fredbin_exposure_columns)
+            entry['columns'] = entry['values'].dtype.descr
+            encoding[fredbin_exposure_id] = entry
+            names = [name for name in names if name not in fredbin_exposure_columns]
+
+        for name in fredbin_dictionary_columns:
+            if name in names and data.dtype[name].kind == 'S':
+                encoding[name] = {'type': data.dtype[name].str, 'values': []}
+
+    if len(encoding) == 0:
+        return data, encoding
+
+    # columns replaced by an exposure_id are dropped, the id is appended
+    table_names = []
+    for code_name, entry in encoding.items():
+        if 'columns' in entry:
+            table_names.extend(entry['values'].dtype.names)
+
+    dtype = []
+    for name in data.dtype.names:
+        if name in table_names:
+            continue
+        elif name in encoding:
+            dtype.append((name, fredbin_code_type))
+        else:
+            dtype.append((name, data.dtype[name]))
+    for code_name, entry in sorted(encoding.items()):
+        if 'columns' in entry:
+            dtype.append((code_name, fredbin_code_type))
+
+    output = np.empty(len(data), dtype=dtype)
+    for name in output.dtype.names:
+        entry = encoding.get(name)
+        if entry is None:
+            output[name] = data[name]
+        elif 'columns' in entry:
+            entry['values'], output[name] = \
+                make_exposure_table(data, entry['values'])
+        else:
+            # look up the distinct values, adding new ones to the dictionary
+            uniques, inverse = np.unique(data[name], return_inverse=True)
+            codes = _lookup_codes(uniques, _dictionary_values(encoding, name))
+            missing = codes < 0
+            codes[missing] = len(entry['values']) + np.arange(np.sum(missing))
+            entry['values'].extend(uniques[missing].astype('U').tolist())
+
+            output[name] = codes[inverse]
+
+    return output, encoding
+
+def decode_fredbin_column(data, encoding, name):
+    """Returns the decoded values of a single column of data."""
+    code_name, entry = _table_entry(encoding, name)
+    if entry is not None:
+        return entry['values'][name][data[code_name]]
+    if name not in encoding:
+        return data[name]
+
+    return _dictionary_values(encoding, name)[data[name]]
+
+def fredbin_decoder(encoding):
+    """Returns a function which restores the columns of data encoded by
+    encode_fredbin, see decode_fredbin. The dictionaries are converted to
+    arrays once, so the function is cheap to call on many small slices. Values
+    added to the encoding later are not seen by the function."""
+
+    if len(encoding) == 0:
+        return lambda data: data
+
+    # the code column and the decoded values of each encoded column
+    lookups = dict()
+    for code_name, entry in encoding.items():
+        if 'columns' in entry:
+            for name in entry['values'].dtype.names:
+                lookups[name] = (code_name, entry['values'][name])
+        else:
+            lookups[code_name] = (code_name, _dictionary_values(encoding, code_name))
+
+    dtypes = dict()
+    def decode(data):
+        if data.dtype not in dtypes:
+            dtypes[data.dtype] = _decoded_dtype(data.dtype, encoding)
+
+        output = np.empty(len(data), dtype=dtypes[data.dtype])
+        for name in output.dtype.names:
+            if name in lookups:
+                code_name, values = lookups[name]
+                output[name] = values[data[code_name]]
+            else:
+                output[name] = data[name]
+
+        return output
+
+    return decode
+
+def decode_fredbin(data, encoding):
+    """Restores the columns of data encoded by encode_fredbin. Returns a new
+    array, or data itself if nothing is encoded."""
+    return fredbin_decoder(encoding)(data)
+
+def exposure_table(data, encoding):
+    """Returns the exposure table of data and the exposure_id of each record,
+    see make_exposure_table. Encoded data uses its stored table, other data is
+    split on the fly."""
+
+    entry = encoding.get(fredbin_exposure_id)
+    if entry is not None:
+        return entry['values'], data[fredbin_exposure_id]
+
+    return make_exposure_table(decode_fredbin(data, encoding))
+
+def column_codes(data, encoding, name, values):
+    """Returns integer codes for the column name of data along with the codes
+    of values in the same dictionary (-1 for values that do not occur), so the
+    two can be compared without comparing strings. Encoded columns use their
+    stored codes, other columns are encoded on the fly."""
+
+    values = np.asarray(values)
+    code_name, entry = _table_entry(encoding, name)
+    if entry is not None:
+        # encode the (few) table rows, then map records through their exposure
+        lookup, codes = np.unique(entry['values'][name], return_inverse=True)
+        codes = codes[data[code_name]]
+    elif name in encoding:
+        lookup = _dictionary_values(encoding, name)
+        codes = data[name]
+    else:
+        lookup, codes = np.unique(data[name], return_inverse=True)
+
+    return codes, _lookup_codes(values.astype(lookup.dtype), lookup)
+
+def _stats_key(value):
+    """Converts a column value to a (string) key of the fredbin statistics."""
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    return str(value)
+
+def fredbin_stats(data, encoding=dict()):
+    """Computes the statistics stored in the trailer of fredbin files for the
+    (possibly encoded) records in data. Columns that data does not have are
+    left out. Returns a dictionary with the keys 'num_rows', the names of
+    fredbin_stats_range_columns and the names in fredbin_stats_count_columns."""
+
+    stats = dict()
+    stats['num_rows'] = len(data)
+    if len(data) == 0:
+        return stats
+
+    names = _decoded_dtype(data.dtype, encoding).names
+
+    for name in fredbin_stats_range_columns:
+        if name not in names:
+            continue
+        values = decode_fredbin_column(data, encoding, name)
+        values = values[np.isfinite(values)]
+        if len(values) > 0:
+            stats[name] = [float(values.min()), float(values.max())]
+
+    for key, name in fredbin_stats_count_columns:
+        if name not in names:
+            continue
+        values, counts = np.unique(decode_fredbin_column(data, encoding, name),
+                                   return_counts=True)
+        stats[key] = dict([(_stats_key(v), int(c)) for v, c in zip(values, counts)])
+
+    return stats
+
+def merge_fredbin_stats(A, B):
+    """Combines the statistics of two sets of records, see fredbin_stats"""
+
+    stats = dict()
+    stats['num_rows'] = A['num_rows'] + B['num_rows']
+
+    for name in fredbin_stats_range_columns:
+        ranges = [X[name] for X in [A, B] if name in X]
+        if len(ranges) > 0:
+            stats[name] = [min([r[0] for r in ranges]), max([r[1] for r in ranges])]
+
+    for key, name in fredbin_stats_count_columns:
+        if key not in A and key not in B:
+            continue
+        counts = dict(A.get(key, dict()))
+        for value, count in B.get(key, dict()).items():
+            counts[value] = counts.get(value, 0) + count
+        stats[key] = counts
+
+    return stats
+
+def read_fredbin_stats(filename):
+    """Returns the statistics of the records in a fredbin file (see
+    fredbin_stats). These are normally read from the trailer of the file. For
+    files written before statistics were kept they are computed from the
+    records."""
+
+    if not is_legacy_fredbin(filename):
+        stats = read_fredbin_info(filename)['stats']
+        if stats is not None:
+            return stats
+
+    stats = {'num_rows': 0}
+    for data in iter_fredbin(filename):
+        stats = merge_fredbin_stats(stats, fredbin_stats(data))
+
+    return stats
+
+def set_fredbin_codec(codec):
+    """Sets the codec used when writing new fredbin files."""
+    global fredbin_codec
 
-    # first attempt to load using numpy.loadtext
-    loadtxt_failed = False
+    if codec not in fredbin_codecs:
+        raise ValueError("Unsupported fredbin codec '%s'" % (codec))
+
+    fredbin_codec = codec
+
+def _compress_fredbin_block(codec, buf):
+    """Compresses the bytes in buf using the specified codec."""
+    if codec == 'zlib':
+        return zlib.compress(buf, 6)
+    elif codec == 'lzma':
+        return lzma.compress(buf)
+
+    raise ValueError("Unsupported fredbin codec '%s'" % (codec))
+
+def _decompress_fredbin_block(codec, buf):
+    """Decompresses the bytes in buf using the specified codec."""
+    if codec == 'zlib':
+        return zlib.decompress(buf)
+    elif codec == 'lzma':
+        return lzma.decompress(buf)
+
+    raise IOError("Unsupported fredbin codec '%s'" % (codec))
+
+def _write_fredbin_header(outfile, dtype, codec):
+    """Writes a v2 fredbin header to outfile. Returns the offset of the first
+    record block."""
+    header = json.dumps({'descr': dtype.descr, 'codec': codec})
+    header = header.encode('ascii')
+
+    # pad the header so that record blocks start on an aligned boundary
+    prefix_len = len(fredbin_magic) + struct.calcsize(fredbin_header_fmt)
+    data_offset = prefix_len + len(header)
+    data_offset += -data_offset % fredbin_align
+    header += b' ' * (data_offset - prefix_len - len(header))
+
+    outfile.write(fredbin_magic)
+    outfile.write(struct.pack(fredbin_header_fmt, fredbin_version, len(header)))
+    outfile.write(header)
+
+    return data_offset
+
+def _fredbin_trailer_bytes(info, offset):
+    """Returns the encoding tables, block index and footer of a fredbin file as
+    they are written at offset. Encoding tables are stored in binary form ahead
+    of the block index."""
+
+    parts = []
+    encoding = dict()
+    for name, entry in info['encoding'].items():
+        if 'columns' not in entry:
+            encoding[name] = entry
+            continue
+
+        values = np.ascontiguousarray(entry['values'])
+        encoding[name] = {'columns': values.dtype.descr, 'names': entry['names'],
+                          'offset': offset, 'num_rows': len(values)}
+        parts.append(values.view(np.uint8).tobytes())
+        offset += len(parts[-1])
+
+    trailer = {'blocks': info['blocks'], 'encoding': encoding}
+    if info.get('stats') is not None:
+        trailer['stats'] = info['stats']
+    trailer = json.dumps(trailer)
+    trailer = trailer.encode('ascii')
+
+    parts.append(trailer)
+    parts.append(struct.pack(fredbin_footer_fmt, offset, len(trailer),
+                             fredbin_footer_magic))
+    return b''.join(parts)
+
+def _write_fredbin_trailer(outfile, info):
+    """Writes the block index and footer at the current position of outfile."""
+    outfile.write(_fredbin_trailer_bytes(info, outfile.tell()))
+
+def _fredbin_blocks(codec, data):
+    """Returns data as a list of (num_rows, buffer) record blocks. Uncompressed
+    data is a single block, compressed data is split into blocks of at most
+    fredbin_block_rows records."""
+
+    if codec == 'none':
+        return [(len(data), data.view(np.uint8))]
+
+    blocks = []
+    for start in range(0, max(len(data), 1), fredbin_block_rows):
+        block = data[start:start + fredbin_block_rows]
+        blocks.append((len(block),
+                       _compress_fredbin_block(codec, block.view(np.uint8).tobytes())))
+
+    return blocks
+
+def _write_fredbin_block(outfile, info, data, blocks=None):
+    """Writes data as new record blocks (see _fredbin_blocks) at the current
+    position of outfile and records them in the block index stored in info."""
+
+    if blocks is None:
+        blocks = _fredbin_blocks(info['codec'], data)
+
+    for num_rows, buf in blocks:
+        offset = outfile.tell()
+        outfile.write(buf)
+
+        info['blocks'].append([offset, num_rows, len(buf)])
+        info['num_rows'] += num_rows
+
+def _sync_fredbin(outfile):
+    """Flushes outfile and, if fredbin_sync is set, forces it to disk."""
+    outfile.flush()
+    if fredbin_sync:
+        os.fsync(outfile.fileno())
+
+def _parse_fredbin_footer(infile, footer_offset):
+    """Returns (trailer_offset, trailer) for the footer at footer_offset, or
+    None if it is not a complete footer of a trailer which ends there."""
+
+    footer_len = struct.calcsize(fredbin_footer_fmt)
+    infile.seek(footer_offset)
+    footer = infile.read(footer_len)
+    if len(footer) != footer_len:
+        return None
+
+    trailer_offset, trailer_len, magic = struct.unpack(fredbin_footer_fmt, footer)
+    if magic != fredbin_footer_magic or trailer_offset + trailer_len != footer_offset:
+        return None
+
+    infile.seek(trailer_offset)
     try:
-        data = np.loadtxt(filename, dtype=dtype)
-    except (ValueError,IndexError):
-        print("Could not load %s using numpy.loadtxt, trying manual method" % (filename))
-        loadtxt_failed = True
+        trailer = json.loads(infile.read(trailer_len).decode('ascii'))
+    except ValueError:
+        return None
+    if not isinstance(trailer, dict) or 'blocks' not in trailer:
+        return None
+
+    return trailer_offset, trailer
+
+def _find_fredbin_trailer(infile, data_offset):
+    """Returns (trailer_offset, trailer, end) for the trailer of a v2 fredbin
+    file, where end is the offset just past its footer. Normally the footer is
+    at the end of the file. If an append was interrupted, the end of the file
+    holds a partial trailer and the last complete footer ahead of it is used
+    instead."""
+
+    footer_len = struct.calcsize(fredbin_footer_fmt)
+    infile.seek(0, os.SEEK_END)
+    file_size = infile.tell()
+
+    found = _parse_fredbin_footer(infile, file_size - footer_len)
+    if found is not None:
+        return found[0], found[1], file_size
+
+    # scan backwards for the magic of an earlier footer
+    chunk_size = 1024**2
+    magic_offset = footer_len - len(fredbin_footer_magic)
+    stop = file_size
+    while stop > data_offset:
+        start = max(data_offset, stop - chunk_size)
+        infile.seek(start)
+        buf = infile.read(stop - start + len(fredbin_footer_magic) - 1)
+
+        i = len(buf)
+        while True:
+            i = buf.rfind(fredbin_footer_magic, 0, i)
+            if i < 0:
+                break
+            footer_offset = start + i - magic_offset
+            found = _parse_fredbin_footer(infile, footer_offset)
+            if found is not None:
+                return found[0], found[1], footer_offset + footer_len
+            i += len(fredbin_footer_magic) - 1
+
+        stop = start
 
-    if loadtxt_failed:
+    raise IOError("%s has a missing or corrupt block index" % (infile.name))
+
+def _read_fredbin_info(infile):
+    """Reads the header and block index of a v2 fredbin file. Returns a
+    dictionary with the following keys:
+     * version
+     * dtype
+     * codec - codec used to compress the blocks, 'none' if uncompressed
+     * encoding - dictionaries and tables of the encoded columns, see encode_fredbin
+     * data_offset - offset of the first record block
+     * blocks_end - offset just past the last record block
+     * trailer_offset - offset of the trailer (including the encoding tables)
+     * trailer_end - offset just past the footer, normally the end of the file
+     * blocks - list of [offset, num_rows, num_bytes] entries, one per block
+     * num_rows - total number of records in the file
+     * stats - statistics of the records, see fredbin_stats. None for files
+               written before statistics were kept."""
+
+    infile.seek(0)
+    magic = infile.read(len(fredbin_magic))
+    if magic != fredbin_magic:
+        raise IOError("%s is not a v2 fredbin file" % (infile.name))
+
+    prefix = infile.read(struct.calcsize(fredbin_header_fmt))
+    version, header_len = struct.unpack(fredbin_header_fmt, prefix)
+    if version > fredbin_version:
+        raise IOError("%s has unsupported fredbin version %i" % (infile.name, version))
+
+    header = json.loads(infile.read(header_len).decode('ascii'))
+    data_offset = infile.tell()
+
+    # locate the trailer using the fixed-size footer at the end of the file
+    trailer_offset, trailer, trailer_end = _find_fredbin_trailer(infile, data_offset)
+
+    info = dict()
+    info['version']        = version
+    info['dtype']          = _descr_to_dtype(header['descr'])
+    info['codec']          = str(header.get('codec', 'none'))
+    info['data_offset']    = data_offset
+    info['trailer_offset'] = trailer_offset
+    info['trailer_end']    = trailer_end
+    info['blocks']         = trailer['blocks']
+    info['encoding']       = trailer.get('encoding', dict())
+    info['num_rows']       = sum([block[1] for block in info['blocks']])
+    info['stats']          = trailer.get('stats')
+
+    # encoding tables precede the block index
+    for name, entry in info['encoding'].items():
+        if 'columns' not in entry:
+            continue
+
+        dtype = _descr_to_dtype(entry['columns'])
+        infile.seek(entry['offset'])
+        buf = infile.read(entry['num_rows'] * dtype.itemsize)
+        entry['values'] = np.frombuffer(buf, dtype=dtype).copy()
+        entry['names'] = [str(name) for name in entry['names']]
+        info['trailer_offset'] = min(info['trailer_offset'], entry['offset'])
+
+    # early v2 files did not record the size of (uncompressed) blocks
+    itemsize = info['dtype'].itemsize
+    for block in info['blocks']:
+        if len(block) == 2:
+            block.append(block[1] * itemsize)
+
+    info['blocks_end'] = data_offset
+    if len(info['blocks']) > 0:
+        info['blocks_end'] = info['blocks'][-1][0] + info['blocks'][-1][2]
+
+    return info
+
+def is_legacy_fredbin(filename):
+    """Returns True if the file is a legacy fredbin, that is one or more
+    concatenated numpy.save chunks."""
+    with open(filename, 'rb') as infile:
+        magic = infile.read(len(legacy_fredbin_magic))
+
+    return magic == legacy_fredbin_magic
+
+def read_legacy_fredbin(filename):
+    """Reads in a legacy .fredbin file consisting of concatenated numpy.save
+    chunks. Returns it as a numpy structured array or None if the file is empty."""
+
+    chunks = []
+    file_size = os.path.getsize(filename)
+    with io.open(filename, 'rb') as infile:
+        while infile.tell() < file_size:
+            chunks.append(np.load(infile))
+
+    if len(chunks) == 0:
+        return None
+
+    return np.concatenate(chunks)
+
+def read_fredbin_info(filename):
+    """Returns the header and block index information for a v2 fredbin file.
+    See _read_fredbin_info for the keys in the returned dictionary."""
+    with io.open(filename, 'rb') as infile:
+        return _read_fredbin_info(infile)
+
+def read_fredbin_encoding(filename):
+    """Returns the encoding of the dictionary-encoded columns of a fredbin
+    file (empty for files without encoded columns)."""
+    if is_legacy_fredbin(filename):
+        return dict()
+
+    return read_fredbin_info(filename)['encoding']
+
+def _read_fredbin_block(filename, codec, block, buf):
+    """Reads a single record block into buf, a uint8 view of the output."""
+    offset, num_rows, num_bytes = block
+
+    with io.open(filename, 'rb') as infile:
+        infile.seek(offset)
+        if codec == 'none':
+            if infile.readinto(buf) != len(buf):
+                raise IOError("%s is truncated" % (filename))
+            return
+
+        temp = infile.read(num_bytes)
+        if len(temp) != num_bytes:
+            raise IOError("%s is truncated" % (filename))
+
+    temp = _decompress_fredbin_block(codec, temp)
+    if len(temp) != len(buf):
+        raise IOError("%s has a corrupt block at offset %i" % (filename, offset))
+    buf[:] = np.frombuffer(temp, dtype=np.uint8)
+
+def read_fredbin(filename, blocks=None, decode=True):
+    """Reads in an APASS .fredbin file. Returns it as a numpy structured array,
+    or None if the file contains no data.
+
+    blocks -- optional list of indices into the block index (see
+              read_fredbin_info) to read. Other blocks are skipped.
+    decode -- if False, dictionary-encoded columns are returned as codes,
+              see read_fredbin_encoding and decode_fredbin.
+
+    Both v2 (chunk-indexed) and legacy (concatenated numpy.save) files are
+    supported. Compressed blocks are decompressed in parallel."""
+
+    if is_legacy_fredbin(filename):
+        if blocks is not None:
+            raise ValueError("%s is a legacy fredbin file without blocks" % (filename))
+        return read_legacy_fredbin(filename)
+
+    info = read_fredbin_info(filename)
+    if len(info['blocks']) == 0:
+        return None
+    if blocks is None:
+        blocks = range(len(info['blocks']))
+    blocks = [info['blocks'][i] for i in blocks]
+
+    # allocate the output once, then read each block directly into it
+    data = np.empty(sum([block[1] for block in blocks]), dtype=info['dtype'])
+    buf = data.view(np.uint8)
+    itemsize = info['dtype'].itemsize
+
+    jobs = []
+    start = 0
+    for block in blocks:
+        stop = start + block[1] * itemsize
+        jobs.append((block, buf[start:stop]))
+        start = stop
+
+    def read_block(job):
+        _read_fredbin_block(filename, info['codec'], job[0], job[1])
+
+    if info['codec'] == 'none' or len(jobs) < 2 or fredbin_read_threads < 2:
+        for job in jobs:
+            read_block(job)
+    else:
+        pool = ThreadPool(min(fredbin_read_threads, len(jobs)))
         try:
-            data = read_fred_manual(filename)
-        except:
-            print("Could not load %s using read_fred_manual, bailing." % (filename))
+            pool.map(read_block, jobs)
+        finally:
+            pool.close()
+            pool.join()
 
-    num_rows = len(data)
+    if decode:
+        data = decode_fredbin(data, info['encoding'])
 
-    night_name = night_from_filename(filename)
-    night_names = [night_name] * num_rows
+    return data
+
+def open_fredbin(filename, mode='r', decode=True):
+    """Opens an APASS .fredbin file as a numpy.memmap-backed structured array so
+    that only the pages which are accessed are read from disk. Returns None if
+    the file contains no data.
 
-    # append extra type columns for zone_id, node_id, and container_id
-    tmp0 = np.zeros(num_rows)
-    tmp1 = np.ones(num_rows)
-    data = nprf.append_fields(data, fredbin_extra_col_names, [tmp0, tmp0, tmp0, night_names, tmp1],
-                              dtypes=fredbin_extra_col_types)
+    mode -- 'r' (read-only), 'r+' (read/write), or 'c' (copy-on-write), see
+            numpy.memmap
+    decode -- if False, dictionary-encoded columns are returned as codes.
+              Decoding produces an in-memory copy of the entire file, so
+              files with encoded columns are only mapped with decode=False.
+              Use read_fredbin_encoding with decode_fredbin_column,
+              column_codes or decode_fredbin to decode the columns or rows
+              which are needed. Files with encoded columns can only be
+              opened in 'r+' mode with decode=False.
+
+    Compressed files, and legacy files made of more than one numpy.save chunk,
+    cannot be mapped and are read into memory instead (only permitted in 'r'
+    and 'c' modes)."""
+
+    if mode not in ['r', 'r+', 'c']:
+        raise ValueError("Invalid mode '%s' for open_fredbin" % (mode))
+
+    if is_legacy_fredbin(filename):
+        data = np.load(filename, mmap_mode=mode)
+        if data.offset + data.nbytes == os.path.getsize(filename):
+            return data
+
+        if mode == 'r+':
+            raise ValueError("%s has multiple chunks, run upgrade_fredbin.py" % (filename))
+        return read_legacy_fredbin(filename)
+
+    info = read_fredbin_info(filename)
+    if len(info['blocks']) == 0:
+        return None
+    if info['codec'] != 'none':
+        if mode == 'r+':
+            raise ValueError("%s is compressed and cannot be opened in 'r+' mode" % (filename))
+        return read_fredbin(filename, decode=decode)
+    if decode and len(info['encoding']) > 0 and mode == 'r+':
+        raise ValueError("%s has encoded columns, open it with decode=False" % (filename))
+    if info['num_rows'] == 0:
+        data = np.empty(0, dtype=info['dtype'])
+    else:
+        # record blocks are contiguous, so the entire file maps to a single array
+        data = np.memmap(filename, dtype=info['dtype'], mode=mode,
+                         offset=info['data_offset'], shape=(info['num_rows'],))
+
+    if decode:
+        data = decode_fredbin(data, info['encoding'])
 
     return data
 
+def iter_fredbin(filename, batch_rows=fred_batch_rows, decode=True):
+    """Yields the contents of an APASS .fredbin file as numpy structured arrays
+    with batch_rows rows each (the last batch may be shorter). The file is
+    memory mapped, so only the current batch is resident in memory.
+    Dictionary-encoded columns are decoded one batch at a time.
 
-def read_fredbin(filename):
-    """Reads in an APASS .fredbin file. Returns it as a numpy structured array."""
+    Compressed files are decompressed one block at a time, in which case
+    batches do not span blocks and may be shorter than batch_rows."""
 
-    # Depending on their origin, numpy arrays may contains multiple
-    # concatenated numpy structured arrays. As such, we need to repeatedly call
-    # numpy.load to ensure we get all of the data.
-    infile = open(filename, 'rb')
-    data = None
-    while(True):
+    encoding = read_fredbin_encoding(filename)
+    if not decode:
+        encoding = dict()
 
-        try:
-            temp = np.load(infile)
-        except IOError:
-            break
+    if not is_legacy_fredbin(filename):
+        info = read_fredbin_info(filename)
+        if info['codec'] != 'none':
+            for i in range(len(info['blocks'])):
+                data = read_fredbin(filename, blocks=[i], decode=False)
+                for start in range(0, len(data), batch_rows):
+                    yield decode_fredbin(data[start:start + batch_rows], encoding)
+            return
 
-        if data is None:
-            data = temp
+    data = open_fredbin(filename, decode=False)
+    if data is None:
+        return
+
+    for start in range(0, len(data), batch_rows):
+        batch = np.array(data[start:start + batch_rows])
+        yield decode_fredbin(batch, encoding)
+
+def write_fredbin(filename_or_handle, data, codec=None, encoding=None):
+    """Writes a APASS-formatted numpy array, data, to the specified file
+    using the v2 fredbin format. File handles must be opened in binary mode
+    and positioned at the start of an empty file.
+
+    codec -- one of fredbin_codecs, defaults to fredbin_codec
+    encoding -- if given, data has already been encoded using this encoding
+                (e.g. it was read with decode=False). Otherwise the columns
+                in fredbin_dictionary_columns are encoded."""
+
+    data = np.asanyarray(data)
+    if codec is None:
+        codec = fredbin_codec
+    if codec not in fredbin_codecs:
+        raise ValueError("Unsupported fredbin codec '%s'" % (codec))
+
+    if encoding is None:
+        data, encoding = encode_fredbin(data)
+    data = np.ascontiguousarray(data)
+
+    if hasattr(filename_or_handle, 'write'):
+        outfile = filename_or_handle
+        info = dict(codec=codec, encoding=encoding, blocks=[], num_rows=0,
+                    stats=fredbin_stats(data, encoding))
+        _write_fredbin_header(outfile, data.dtype, codec)
+        _write_fredbin_block(outfile, info, data)
+        _write_fredbin_trailer(outfile, info)
+    else:
+        with io.open(filename_or_handle, 'wb') as outfile:
+            write_fredbin(outfile, data, codec, encoding)
+
+def append_fredbin(filename, data):
+    """Appends data to the specified fredbin file as a new record block,
+    creating the file if it does not exist. Legacy fredbin files are converted
+    to the v2 format in the process. Appended blocks use the codec and the
+    (extended) dictionaries of the existing file."""
+
+    data = np.asanyarray(data)
+
+    # new files, and legacy files that need to be upgraded, are rewritten in full
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        write_fredbin(filename, data)
+        return
+    if is_legacy_fredbin(filename):
+        old_data = read_legacy_fredbin(filename)
+        if old_data is not None:
+            data = np.concatenate([old_data, data])
+
+        # replace the legacy file only once the new one is complete
+        temp_filename = filename + '.tmp'
+        write_fredbin(temp_filename, data)
+        os.rename(temp_filename, filename)
+        return
+
+    with io.open(filename, 'r+b') as outfile:
+        info = _read_fredbin_info(outfile)
+        if _decoded_dtype(info['dtype'], info['encoding']) != data.dtype:
+            raise ValueError("Cannot append data of type %s to %s" % (data.dtype, filename))
+
+        old_info = dict(info, blocks=list(info['blocks']),
+                        encoding=deepcopy(info['encoding']))
+        data, info['encoding'] = encode_fredbin(data, info['encoding'])
+        data = np.ascontiguousarray(data)
+        if info['dtype'] != data.dtype:
+            raise ValueError("Cannot append data of type %s to %s" % (data.dtype, filename))
+
+        # statistics are only kept if the existing file has them
+        if info['stats'] is not None:
+            info['stats'] = merge_fredbin_stats(info['stats'],
+                                                fredbin_stats(data, info['encoding']))
+
+        # The file stays readable at every step: the trailer in use is never
+        # overwritten, and the footer at the end of the file (or the last
+        # complete one, see _find_fredbin_trailer) points to a valid trailer.
+        blocks = _fredbin_blocks(info['codec'], data)
+        blocks_end = info['blocks_end'] + sum([len(buf) for num_rows, buf in blocks])
+        trailer_offset = info['trailer_offset']
+        trailer_end = info['trailer_end']
+
+        # move a copy of the old trailer out of the way of the new block
+        if blocks_end > trailer_offset:
+            trailer_offset = max(trailer_end, blocks_end)
+            outfile.seek(trailer_offset)
+            _write_fredbin_trailer(outfile, old_info)
+            outfile.truncate()
+            _sync_fredbin(outfile)
+            trailer_end = outfile.tell()
+
+        outfile.seek(info['blocks_end'])
+        _write_fredbin_block(outfile, info, data, blocks)
+        _sync_fredbin(outfile)
+
+        # write the new trailer in the unused space after the new block if it
+        # fits, and drop the old trailer, otherwise past the end of the file
+        trailer = _fredbin_trailer_bytes(info, blocks_end)
+        if blocks_end + len(trailer) <= trailer_offset:
+            outfile.seek(blocks_end)
+            outfile.write(trailer)
+            _sync_fredbin(outfile)
+            outfile.truncate()
         else:
-            data = np.append(data, temp)
+            trailer = _fredbin_trailer_bytes(info, trailer_end)
+            outfile.seek(trailer_end)
+            outfile.write(trailer)
+            outfile.truncate()
+            _sync_fredbin(outfile)
 
-    return data
+def project_fields(data, columns, encoding=dict()):
+    """Returns a packed copy of the structured array data containing only the
+    specified columns. If data has encoded columns (see encode_fredbin), only
+    the projected columns are decoded using encoding."""
+    dtype = _decoded_dtype(data.dtype, encoding)
+    output = np.empty(len(data), dtype=[(name, dtype[name]) for name in columns])
+    for name in columns:
+        output[name] = decode_fredbin_column(data, encoding, name)
+
+    return output
+
+def _fredcols_source_stat(source_filename):
+    """Returns the [size, mtime] of the fredbin file a column store is made
+    from."""
+    st = os.stat(source_filename)
+    return [st.st_size, st.st_mtime]
+
+def write_fredcols(dirname, data, source_filename=None, encoding=dict()):
+    """Writes the structured array data as a column store in dirname. If
+    source_filename is given, the store is tied to that (fredbin) file and is
+    considered stale once it changes, see read_fredcols. Encoded columns (see
+    encode_fredbin) are decoded one at a time using encoding."""
+
+    data = np.asanyarray(data)
+    dtype = _decoded_dtype(data.dtype, encoding)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    # remove the manifest first so readers never see a partial store
+    manifest_filename = os.path.join(dirname, fredcols_manifest)
+    if os.path.isfile(manifest_filename):
+        os.remove(manifest_filename)
+
+    for name in dtype.names:
+        column = decode_fredbin_column(data, encoding, name)
+        np.save(os.path.join(dirname, name + '.npy'), np.ascontiguousarray(column))
+
+    manifest = dict()
+    manifest['version'] = fredcols_version
+    manifest['num_rows'] = len(data)
+    manifest['descr'] = dtype.descr
+    manifest['source'] = None
+    if source_filename is not None:
+        manifest['source'] = _fredcols_source_stat(source_filename)
+
+    with open(manifest_filename, 'w') as outfile:
+        json.dump(manifest, outfile)
+
+def read_fredcols_manifest(dirname, source_filename=None):
+    """Reads the manifest of the column store in dirname. Returns None if the
+    store does not exist or is stale with respect to source_filename."""
 
-def write_fredbin(filename_or_handle, data):
-    """Writes a APASS-formatted numpy array, data, to the specified file."""
-    np.save(filename_or_handle, data)
+    manifest_filename = os.path.join(dirname, fredcols_manifest)
+    if not os.path.isfile(manifest_filename):
+        return None
+
+    with open(manifest_filename, 'r') as infile:
+        manifest = json.load(infile)
+
+    if manifest['version'] > fredcols_version:
+        return None
+    if source_filename is not None and \
+        manifest['source'] != _fredcols_source_stat(source_filename):
+        return None
+
+    return manifest
+
+def read_fredcols(dirname, columns=None, source_filename=None):
+    """Reads the specified columns (default: all) from the column store in
+    dirname. Returns them as a packed numpy structured array, or None if the
+    store does not exist or is stale (see read_fredcols_manifest)."""
+
+    manifest = read_fredcols_manifest(dirname, source_filename)
+    if manifest is None:
+        return None
+
+    dtype = _descr_to_dtype(manifest['descr'])
+    if columns is None:
+        columns = dtype.names
+
+    output = np.empty(manifest['num_rows'], dtype=[(name, dtype[name]) for name in columns])
+    for name in columns:
+        output[name] = np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+
+    return output
+
+def enable_fred_cache(cache_dir, max_bytes=fred_cache_max_bytes):
+    """Enables the cache of parsed FRED files. Parsed files are stored as
+    fredbin files in cache_dir, which is kept below max_bytes by evicting the
+    least recently used entries."""
+
+    global fred_cache_dir
+    global fred_cache_max_bytes
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fred_cache_dir = cache_dir
+    fred_cache_max_bytes = max_bytes
+
+def content_hash(filename):
+    """Computes the SHA-1 hash of a file's contents. Returns a hex string."""
+
+    sha = hashlib.sha1()
+    with io.open(filename, 'rb') as infile:
+        while True:
+            buf = infile.read(fred_block_size)
+            if len(buf) == 0:
+                break
+            sha.update(buf)
+
+    return sha.hexdigest()
+
+def _fred_cache_temp_filename(cache_filename):
+    """Returns a unique temporary filename for building a cache entry."""
+    return "%s.%i.tmp" % (cache_filename, os.getpid())
+
+def fred_cache_lookup(filename):
+    """Returns the name of the cache entry for the specified FRED file. The
+    entry need not exist yet.
+
+    Entries are named after the file's content hash (and night name). As
+    hashing requires reading the entire file, the content hash is remembered
+    in a key file named after the file's path, size, and modification time."""
+
+    stat = os.stat(filename)
+    key = "%s|%i|%i|%i" % (os.path.abspath(filename), stat.st_size,
+                           int(stat.st_mtime * 1e6), fred_cache_version)
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    key_filename = os.path.join(fred_cache_dir, key + '.key')
+
+    entry = None
+    if os.path.isfile(key_filename):
+        with open(key_filename, 'r') as infile:
+            entry = infile.read().strip()
+
+    if not entry:
+        entry = "%s|%s|%i" % (content_hash(filename), night_from_filename(filename),
+                              fred_cache_version)
+        entry = hashlib.sha1(entry.encode('utf-8')).hexdigest()
+
+        temp_filename = _fred_cache_temp_filename(key_filename)
+        with open(temp_filename, 'w') as outfile:
+            outfile.write(entry + "\n")
+        os.rename(temp_filename, key_filename)
+
+    cache_filename = os.path.join(fred_cache_dir, entry + '.fredbin')
+
+    # mark the entry as recently used
+    if os.path.isfile(cache_filename):
+        try:
+            os.utime(cache_filename, None)
+        except OSError:
+            pass
+
+    return cache_filename
+
+def fred_cache_store(temp_filename, cache_filename):
+    """Moves a completed fredbin into the cache, then evicts least recently
+    used entries until the cache is below fred_cache_max_bytes."""
+
+    os.rename(temp_filename, cache_filename)
+
+    entries = []
+    total_bytes = 0
+    for filename in glob.glob(os.path.join(fred_cache_dir, '*.fredbin')):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+        total_bytes += stat.st_size
+
+    entries.sort()
+    for mtime, size, filename in entries:
+        if total_bytes <= fred_cache_max_bytes or filename == cache_filename:
+            break
+
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total_bytes -= size
 
 def to_fredbin(list_data):
     """Converts a list nested list of fredbin values to a structured numpy array."""
@@ -0,0 +1,93 @@
+#!/bin/python
+# Stand-in producer for fred_stream.py. Replays FRED files from disk as FRED
+# streams over a local TCP or Unix socket, or to stdout.
+
+# system includes
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import fred
+from fred_stream import fred_stream_header
+
+def replay_files(send_func, filenames, block_size, delay=0):
+    """Sends each file, preceded by its header line, using send_func.
+    Compressed FRED files are sent decompressed."""
+    for filename in filenames:
+        send_func(fred_stream_header + os.path.basename(filename).encode('utf-8') + b'\n')
+        last = b'\n'
+        with fred.open_fred(filename) as infile:
+            while True:
+                buf = infile.read(block_size)
+                if len(buf) == 0:
+                    break
+                send_func(buf)
+                last = buf[-1:]
+                if delay > 0:
+                    time.sleep(delay)
+
+        # ensure the next header starts on a new line
+        if last != b'\n':
+            send_func(b'\n')
+
+def connect(args):
+    """Opens a connection to the streaming service"""
+    if args.unix is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.unix)
+    else:
+        host, port = 'localhost', args.tcp
+        if ':' in args.tcp:
+            host, port = args.tcp.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+    return sock
+
+def replay_connection(args, filenames):
+    sock = connect(args)
+    try:
+        replay_files(sock.sendall, filenames, args.block_size, args.delay)
+    finally:
+        sock.close()
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Replays FRED files as FRED streams, see fred_stream.py')
+    parser.add_argument('input', nargs='+', help="FRED files to replay")
+    parser.add_argument('--tcp', default=None,
+                        help="Send to this local port (or host:port)")
+    parser.add_argument('--unix', default=None,
+                        help="Send to this Unix socket")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of concurrent connections (producers)")
+    parser.add_argument('--block-size', type=int, default=4096,
+                        help="Number of bytes sent at a time")
+    parser.add_argument('--delay', type=float, default=0,
+                        help="Seconds to wait after each block")
+
+    args = parser.parse_args()
+
+    # without a socket, write a single stream to stdout
+    if args.tcp is None and args.unix is None:
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        replay_files(stdout.write, args.input, args.block_size, args.delay)
+        stdout.flush()
+        return
+
+    # distribute the files over the connections
+    threads = []
+    for i in range(0, args.jobs):
+        filenames = args.input[i::args.jobs]
+        if len(filenames) == 0:
+            continue
+        thread = threading.Thread(target=replay_connection, args=(args, filenames))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#!/bin/python
+# Streaming ingest of FRED data.
+#
+# Accepts FRED formatted text from stdin and/or any number of concurrent
+# producers connected to a local TCP or Unix socket and routes the rows into
+# zone files with the same semantics as fred_to_zone.add_fred.
+#
+# A stream may carry several FRED files. Each file starts with a header line
+#
+#   #@fred <filename>
+#
+# which names the file (the night name is derived from it as for FRED files on
+# disk) followed by the file's lines. A file ends at the next header or when
+# the stream is closed. Rows sent before the first header belong to a file
+# named after the stream. Being a comment, the header is ignored by the FRED
+# parser, so FRED files may simply be concatenated with headers in between.
+#
+# Each stream is parsed incrementally by its own thread. Parsed batches are
+# passed to a single routing thread through a bounded queue. When the router
+# falls behind, producers block on the queue, stop reading from their stream
+# and, in turn, the producers' writes block.
+
+# system includes
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+import traceback
+import numpy as np
+
+try:
+    import SocketServer as socketserver
+    import Queue as queue
+except ImportError:
+    import socketserver
+    import queue
+
+# custom modules
+sys.path.append(os.path.join(sys.path[0],'modules', 'FileLock', 'filelock'))
+from filelock import FileLock
+
+# APASS-specific things
+import fred
+import fred_to_zone
+from fred_to_zone import build_data_dict, ZoneWriter
+
+# header line which starts a new FRED file within a stream
+fred_stream_header = b'#@fred '
+
+# number of bytes read from a stream at a time
+fred_stream_read_size = 1024 * 1024
+
+# default number of parsed batches queued for the router
+fred_stream_queue_size = 16
+
+class FredStreamParser(object):
+    """Incremental parser for a single FRED file received over a stream.
+    Lines are fed as they arrive and complete batches of batch_rows rows are
+    returned as soon as they are available."""
+
+    def __init__(self, filename, batch_rows):
+        self.filename = filename
+        self.batch_rows = batch_rows
+        self.night_name = fred.night_from_filename(filename)
+        self.report = fred.make_fred_report(filename)
+        self.dtype = {'names': fred.fredbin_col_names, 'formats': fred.fredbin_col_types}
+        self.batch = np.zeros(batch_rows, dtype=self.dtype)
+        self.num_rows = 0
+        self.line_number = 1
+        self.num_fred_data = 0
+
+        # hash of the file's lines (each terminated by a newline), this matches
+        # fred.content_hash for a file sent as-is
+        self.sha = hashlib.sha1()
+
+    def _finish_batch(self, num_rows):
+        batch = self.batch[0:num_rows]
+        batch['night_name'] = self.night_name
+        batch['use_data'] = True
+        self.num_fred_data += num_rows
+
+        self.batch = np.zeros(self.batch_rows, dtype=self.dtype)
+        self.num_rows = 0
+        return batch
+
+    def feed(self, lines):
+        """Parses lines (without line endings). Returns a list of complete
+        batches."""
+
+        for line in lines:
+            self.sha.update(line + b'\n')
+
+        batches = []
+        start = 0
+        while start < len(lines):
+            stop = start + self.batch_rows - self.num_rows
+            self.num_rows += fred._parse_fred_lines(self.line_number + start,
+                                                    lines[start:stop],
+                                                    self.batch[self.num_rows:],
+                                                    self.report)
+            start = stop
+
+            if self.num_rows == self.batch_rows:
+                batches.append(self._finish_batch(self.num_rows))
+
+        self.line_number += len(lines)
+        return batches
+
+    def finish(self):
+        """Returns a list containing the final (partial) batch, if any"""
+        if self.num_rows > 0:
+            return [self._finish_batch(self.num_rows)]
+        return []
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+def read_stream(read_func, route_queue, stream_name, batch_rows):
+    """Reads FRED files from a stream until read_func returns an empty string
+    and passes the parsed batches to the router. Messages put on route_queue
+    are ('data', key, filename, batch), ('end', key, filename, parser) and
+    ('abort', key, filename) where key identifies the file within this
+    process."""
+
+    state = {'parser': None, 'key': None, 'num_files': 0}
+
+    def start_file(filename):
+        state['parser'] = FredStreamParser(filename, batch_rows)
+        state['key'] = (stream_name, state['num_files'])
+        state['num_files'] += 1
+
+    def end_file():
+        parser = state['parser']
+        if parser is None:
+            return
+        for batch in parser.finish():
+            route_queue.put(('data', state['key'], parser.filename, batch))
+        route_queue.put(('end', state['key'], parser.filename, parser))
+        state['parser'] = None
+
+    def feed(lines):
+        if len(lines) == 0:
+            return
+        if state['parser'] is None:
+            start_file(stream_name)
+        parser = state['parser']
+        for batch in parser.feed(lines):
+            route_queue.put(('data', state['key'], parser.filename, batch))
+
+    def process_lines(lines):
+        headers = [i for i in range(0, len(lines)) if lines[i].startswith(fred_stream_header)]
+        start = 0
+        for i in headers:
+            feed(lines[start:i])
+            end_file()
+            start_file(lines[i][len(fred_stream_header):].strip().decode('utf-8'))
+            start = i + 1
+        feed(lines[start:])
+
+    remainder = b''
+    try:
+        while True:
+            buf = read_func()
+            if len(buf) == 0:
+                break
+
+            lines = (remainder + buf).split(b'\n')
+            remainder = lines.pop()
+            process_lines(lines)
+
+        if len(remainder) > 0:
+            process_lines([remainder])
+
+        end_file()
+    except:
+        if state['parser'] is not None:
+            route_queue.put(('abort', state['key'], state['parser'].filename))
+        raise
+
+def log_error(message):
+    """Prints an error message and records it, with the traceback, in the
+    error file"""
+
+    tb = traceback.format_exc()
+    print(message)
+    with FileLock(error_filename, timeout=100, delay=0.05):
+        with open(error_filename, 'a') as error_file:
+            error_file.write(message + "\n" + str(tb) + "\n")
+
+def route(save_dir, route_queue, writer, flush_interval, max_files=None):
+    """Routes parsed batches into the zones until a 'stop' message is received
+    or max_files files have been completed. Buffered data is written once a
+    file completes and the writer is full, or whenever no data has arrived for
+    flush_interval seconds. Routing stops if the zones cannot be written."""
+
+    try:
+        _route(save_dir, route_queue, writer, flush_interval, max_files)
+    except:
+        # zone data may have been written without provenance or manifest
+        # records, so nothing more is written
+        log_error("ERROR: Failed to write zone data. Stopping\n")
+        raise
+
+def _route(save_dir, route_queue, writer, flush_interval, max_files):
+    """Routes the messages of route_queue, see route"""
+
+    zone_counts = dict()
+    failed = set()
+    num_files = 0
+    while max_files is None or num_files < max_files:
+        try:
+            message = route_queue.get(timeout=flush_interval)
+        except queue.Empty:
+            writer.flush()
+            continue
+
+        kind = message[0]
+        if kind == 'stop':
+            break
+
+        key, filename = message[1], message[2]
+        if key in failed:
+            # the rest of a file which could not be routed
+            if kind != 'data':
+                failed.remove(key)
+                num_files += 1
+            continue
+
+        if kind == 'data':
+            batch = message[3]
+            counts = zone_counts.setdefault(key, dict())
+            try:
+                data_dict = build_data_dict(batch)
+                del data_dict['num_fred_data']
+
+                for zone_id, data in data_dict.items():
+                    if len(data) == 0:
+                        continue
+                    writer.add(filename, zone_id, data)
+                    counts[zone_id] = counts.get(zone_id, 0) + len(data)
+            except:
+                log_error("ERROR: Failed to import %s. Re-run in debug mode\n" % (filename))
+                writer.discard(filename)
+                zone_counts.pop(key, None)
+                failed.add(key)
+
+        elif kind == 'end':
+            parser = message[3]
+            fred.print_fred_report(parser.report)
+
+            # record the hash of the streamed contents in the ingest manifest
+            fred_to_zone.fred_hashes[os.path.abspath(filename)] = parser.hexdigest()
+            writer.complete(filename, parser.num_fred_data, zone_counts.pop(key, dict()))
+            print("Completed FRED stream " + filename)
+            num_files += 1
+
+            if writer.is_full():
+                writer.flush()
+
+        elif kind == 'abort':
+            writer.discard(filename)
+            zone_counts.pop(key, None)
+            num_files += 1
+
+    writer.flush()
+
+class FredStreamHandler(socketserver.BaseRequestHandler):
+    """Reads FRED files from a socket connection"""
+
+    def handle(self):
+        server = self.server
+        with server.stream_lock:
+            server.num_streams += 1
+            stream_name = "stream%05i" % (server.num_streams)
+        print("Accepted FRED stream %s" % (stream_name))
+
+        read_func = lambda: self.request.recv(fred_stream_read_size)
+        try:
+            read_stream(read_func, server.route_queue, stream_name, server.batch_rows)
+        except:
+            log_error("ERROR: Failed to read FRED stream %s. Re-run in debug mode\n" % (stream_name))
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+def start_server(server, route_queue, batch_rows):
+    """Configures a socket server and serves it from a background thread"""
+    server.route_queue = route_queue
+    server.batch_rows = batch_rows
+    server.stream_lock = threading.Lock()
+    server.num_streams = 0
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+
+    global error_filename
+
+    parser = argparse.ArgumentParser(description='Streams FRED data from stdin or local sockets into zone files')
+    parser.add_argument('save_dir', help="Directory to save the output files.")
+    parser.add_argument('--stdin', default=False, action='store_true',
+                        help="Read a FRED stream from stdin")
+    parser.add_argument('--stdin-name', default='stdin.fred',
+                        help="Filename of stdin rows which precede the first header")
+    parser.add_argument('--tcp', default=None,
+                        help="Accept producers on this local port (or host:port)")
+    parser.add_argument('--unix', default=None,
+                        help="Accept producers on this Unix socket")
+    parser.add_argument('--max-files', type=int, default=None,
+                        help="Exit after this many FRED files have been received")
+    parser.add_argument('--batch-rows', type=int, default=10000,
+                        help="Number of FRED rows parsed and routed at a time")
+    parser.add_argument('--queue-size', type=int, default=fred_stream_queue_size,
+                        help="Number of parsed batches that may wait for the router")
+    parser.add_argument('--buffer-size', type=float, default=fred_to_zone.zone_buffer_bytes / 1024**2,
+                        help="Zone data buffered before writing, in MB")
+    parser.add_argument('--flush-interval', type=float, default=10,
+                        help="Write buffered zone data after this many idle seconds")
+    parser.add_argument('--codec', default='none', choices=fred.fredbin_codecs,
+                        help="Compression used for new fredbin files")
+
+    args = parser.parse_args()
+    start = time.time()
+    fred.set_fredbin_codec(args.codec)
+
+    if not (args.stdin or args.tcp or args.unix):
+        print("Specify at least one of --stdin, --tcp, or --unix. See -h")
+        quit()
+
+    save_dir = args.save_dir
+    error_filename = save_dir + "/error_fred_stream.txt"
+    with open(error_filename, 'w') as error_file:
+        error_file.truncate()
+
+    route_queue = queue.Queue(maxsize=args.queue_size)
+    writer = ZoneWriter(save_dir, int(args.buffer_size * 1024**2))
+
+    # start the router
+    router = threading.Thread(target=route,
+                              args=(save_dir, route_queue, writer, args.flush_interval, args.max_files))
+    router.daemon = True
+    router.start()
+
+    # start the servers
+    servers = []
+    if args.tcp is not None:
+        host, port = 'localhost', args.tcp
+        if ':' in args.tcp:
+            host, port = args.tcp.rsplit(':', 1)
+        server = ThreadingTCPServer((host, int(port)), FredStreamHandler)
+        servers.append(start_server(server, route_queue, args.batch_rows))
+        print("Listening for FRED streams on %s:%s" % (host, port))
+
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = ThreadingUnixServer(args.unix, FredStreamHandler)
+        servers.append(start_server(server, route_queue, args.batch_rows))
+        print("Listening for FRED streams on %s" % (args.unix))
+
+    try:
+        if args.stdin:
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+            read_func = lambda: os.read(stdin.fileno(), fred_stream_read_size)
+            try:
+                read_stream(read_func, route_queue, args.stdin_name, args.batch_rows)
+            except:
+                log_error("ERROR: Failed to read FRED stream from stdin. Re-run in debug mode\n")
+
+            # without servers, the end of stdin is the end of the input
+            if len(servers) == 0:
+                route_queue.put(('stop',))
+
+        # wait for the router to finish, waking up to allow for interrupts
+        while router.is_alive():
+            router.join(1)
+    except KeyboardInterrupt:
+        print("Stopping, writing buffered data")
+        route_queue.put(('stop',))
+        router.join()
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    if args.unix is not None and os.path.exists(args.unix):
+        os.remove(args.unix)
+
+    end = time.time()
+    print("Time elapsed: %is" % (int(end - start)))
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ import time
 import traceback
 import datetime
 import traceback
+import json
 
 # parallel processing
 import multiprocessing as mp
@@ -19,173 +20,598 @@ import multiprocessing as mp
 # APASS-specific things
 from quadtree import *
 from quadtree_types import *
-from apass import name_zone_file, name_zone_contrib_file, name_zone_file
-from apass import get_coords, get_num_zones
+from apass import name_zone_file
+from apass import zone_ids_from_coords
+import provenance
+import dedup
 
 # File I/O
-from fred import read_fred, read_fredbin, compare_fred_data, write_fredbin
+from fred import iter_fred, read_fredbin, append_fredbin, fred_batch_rows, enable_fred_cache
+from fred import fredbin_codecs, set_fredbin_codec, content_hash
 
 import sys, os
 sys.path.append(os.path.join(sys.path[0],'modules', 'FileLock', 'filelock'))
 from filelock import FileLock
 
-def make_data_dict():
-    """Constructs a data dictionary consisting of the following fields:
-       num_fred_data - integer, number of values read in from FRED files
-       XXXXXX        - zone ID as key with data /mnt/astro/astro/home/welch/surveys/APASS/hphot_and_hepp/fixedk2_dtfred/s160201.fixedk2.dtfredto be inserted into that zone as value
-    """
+def build_data_dict(data):
+    """Creates a dictionary which maps zone IDs to the data in the specified
+    batch which belongs to that zone. The number of values in the batch is
+    stored under 'num_fred_data'."""
 
-    out = dict()
-    out['num_fred_data'] = 0
-    num_zones = get_num_zones()
-    for i in range(0, num_zones):
-        out[i] = list()
+    data_dict = dict()
 
-    return out
+    # update the number of data points read.
+    data_dict['num_fred_data'] = len(data)
 
-def build_data_dict(filename):
-    """Creates a dictionary which maps the data in the specified file to specific
-    zone IDs."""
+    # assign every data point to a zone at once, then update the data with
+    # the zone IDs
+    zone_ids = zone_ids_from_coords(data['ra'], data['dec'])
+    data['zone_id'] = zone_ids
 
-    global tree_file
-    global error_filename
+    # group the data by zone, preserving the order within each zone
+    order = np.argsort(zone_ids, kind='mergesort')
+    zone_ids = zone_ids[order]
+    data = data[order]
+
+    splits = np.flatnonzero(np.diff(zone_ids)) + 1
+    starts = np.concatenate([[0], splits])
+    for start, zone_data in zip(starts, np.split(data, splits)):
+        if len(zone_data) > 0:
+            data_dict[int(zone_ids[start])] = zone_data
+
+    return data_dict
+
+# Ingest manifest. Every ingested FRED file is recorded as one JSON line
+# keyed by the hash of its contents. Files whose data was purged from the
+# zones (see purge_night.py) are recorded again with 'purged' set, which
+# cancels their earlier entries.
+ingest_manifest_name = 'ingest_manifest.jsonl'
+
+# content hashes of the input files, computed by main()
+fred_hashes = dict()
+
+def read_ingest_manifest(save_dir):
+    """Reads the ingest manifest. Returns a dictionary of entries keyed by
+    content hash and a dictionary of the most recent entry for each (absolute)
+    FRED filename. Entries cancelled by a later purge are left out."""
+
+    by_hash = dict()
+    by_filename = dict()
+
+    manifest_filename = save_dir + '/' + ingest_manifest_name
+    if not os.path.isfile(manifest_filename):
+        return by_hash, by_filename
+
+    with open(manifest_filename, 'r') as infile:
+        for line in infile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            entry = json.loads(line)
+            if entry.get('purged', False):
+                by_hash.pop(entry['hash'], None)
+                if entry['filename'] in by_filename and \
+                   by_filename[entry['filename']]['hash'] == entry['hash']:
+                    del by_filename[entry['filename']]
+                continue
+
+            by_hash[entry['hash']] = entry
+            by_filename[entry['filename']] = entry
+
+    return by_hash, by_filename
+
+def record_ingest(save_dir, files):
+    """Records FRED files, given as a list of (filename, num_fred_data,
+    zone_counts) tuples, and the number of rows each contributed to each zone,
+    in the ingest manifest. The content hashes are taken from fred_hashes if
+    present."""
+
+    global fred_hashes
+
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    lines = []
+    for filename, num_fred_data, zone_counts in files:
+        abs_filename = os.path.abspath(filename)
+        file_hash = fred_hashes.get(abs_filename)
+        if file_hash is None:
+            file_hash = content_hash(filename)
+
+        entry = dict()
+        entry['hash'] = file_hash
+        entry['filename'] = filename
+        entry['size'] = None
+        entry['mtime'] = None
+
+        # streamed files (see fred_stream.py) need not exist on disk
+        if os.path.isfile(filename):
+            stat = os.stat(filename)
+            entry['filename'] = abs_filename
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+        entry['date'] = date
+        entry['num_fred_data'] = num_fred_data
+        entry['zones'] = dict([(str(k), int(v)) for k, v in zone_counts.items()])
+        lines.append(json.dumps(entry, sort_keys=True) + "\n")
+
+    if len(lines) == 0:
+        return
+
+    manifest_filename = save_dir + '/' + ingest_manifest_name
+    with FileLock(manifest_filename, timeout=100, delay=0.05):
+        with open(manifest_filename, 'a+') as outfile:
+            outfile.write(''.join(lines))
+
+def record_purge(save_dir, filenames):
+    """Records in the ingest manifest that the data of filenames (as named in
+    the manifest) was removed from the zones, so the files are ingested again
+    the next time they are passed to fred_to_zone. Files which are not in the
+    manifest are ignored."""
 
-    # create the data dictionary which will store data values.
-    data_dict = make_data_dict()
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    flag_read_error = False
+    manifest_filename = save_dir + '/' + ingest_manifest_name
+    with FileLock(manifest_filename, timeout=100, delay=0.05):
+        by_hash, by_filename = read_ingest_manifest(save_dir)
+        with open(manifest_filename, 'a+') as outfile:
+            for filename in filenames:
+                if filename not in by_filename:
+                    continue
+
+                entry = dict()
+                entry['hash'] = by_filename[filename]['hash']
+                entry['filename'] = filename
+                entry['date'] = date
+                entry['purged'] = True
+                outfile.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def write_ingest_info(save_dir, files):
+    """Records FRED files whose data has been written to the zones, given as a
+    list of (filename, num_fred_data, zone_counts) tuples, in the provenance
+    store and the ingest manifest."""
+    provenance.record_files(save_dir, [(filename, zone_counts)
+                                       for filename, num_fred_data, zone_counts in files])
+    record_ingest(save_dir, files)
+
+def select_new_freds(save_dir, filenames, jobs=1, force=False):
+    """Compares filenames against the ingest manifest. Returns the files that
+    need to be ingested, the files that were already ingested and the files
+    which have changed since they were ingested. Changed files are only
+    ingested if force is True. Unless the file size or modification time
+    differ from the manifest, files are not hashed again.
+
+    The content hashes are stored in fred_hashes."""
+
+    global fred_hashes
+
+    by_hash, by_filename = read_ingest_manifest(save_dir)
+
+    # hash files which are not known under the same name, size, and mtime
+    hashes = dict()
+    to_hash = list()
+    for filename in filenames:
+        abs_filename = os.path.abspath(filename)
+        entry = by_filename.get(abs_filename)
+        stat = os.stat(filename)
+        if entry is not None and entry['size'] == stat.st_size and \
+           entry['mtime'] == stat.st_mtime:
+            hashes[abs_filename] = entry['hash']
+        else:
+            to_hash.append(filename)
+
+    if jobs > 1 and len(to_hash) > 1:
+        pool = mp.Pool(jobs)
+        to_hash_results = pool.map(content_hash, to_hash)
+        pool.close()
+        pool.join()
+    else:
+        to_hash_results = [content_hash(filename) for filename in to_hash]
+
+    for filename, file_hash in zip(to_hash, to_hash_results):
+        hashes[os.path.abspath(filename)] = file_hash
+
+    # classify the input
+    new_files = list()
+    ingested_files = list()
+    changed_files = list()
+    seen = set()
+    for filename in filenames:
+        abs_filename = os.path.abspath(filename)
+        file_hash = hashes[abs_filename]
+        entry = by_filename.get(abs_filename)
+
+        if file_hash in seen:
+            # the same contents were passed twice
+            ingested_files.append(filename)
+        elif file_hash in by_hash and not force:
+            ingested_files.append(filename)
+        elif entry is not None and entry['hash'] != file_hash and not force:
+            changed_files.append(filename)
+        else:
+            new_files.append(filename)
+
+        seen.add(file_hash)
+
+    fred_hashes = hashes
+    return new_files, ingested_files, changed_files
+
+# Memory budget (in bytes) of the buffered zone writer used by each worker
+zone_buffer_bytes = 256 * 1024**2
+
+# Rows per batch read from the FRED files and the memory budget of the zone
+# writers, set from the command line in main()
+batch_rows = fred_batch_rows
+buffer_bytes = zone_buffer_bytes
+
+# Directory (within save_dir) holding the spill files of the shuffle mode
+spill_dir_name = 'spill'
+
+# Drop rows which duplicate rows already in the zone, see dedup.py
+drop_duplicates = True
+
+def subtract_duplicates(zone_counts, duplicates):
+    """Returns the number of rows written to each zone given the number of rows
+    read for each zone (zone_counts) and the number of duplicate rows dropped
+    from each zone (duplicates). Zones without rows are left out."""
+    counts = dict()
+    for zone_id, num_rows in zone_counts.items():
+        num_rows -= duplicates.get(zone_id, 0)
+        if num_rows > 0:
+            counts[zone_id] = num_rows
+    return counts
+
+def write_zone_data(save_dir, zone_id, data, sources):
+    """Appends data to a zone file. The caller must ensure no other process
+    writes to the zone. Returns the (num_within, num_existing) duplicate rows
+    dropped from each file in sources, see dedup.append_zone."""
+
+    global drop_duplicates
+
+    if drop_duplicates:
+        return dedup.append_zone(save_dir, zone_id, data, sources)
+
+    append_fredbin(save_dir + '/' + name_zone_file(zone_id), data)
+    return dict()
+
+class ZoneWriter(object):
+    """Write-combining buffer for zone data. Data assigned to the zones is
+    accumulated across many FRED files until the buffered data exceeds
+    max_bytes (see is_full), then each zone is appended (in zone order) as a
+    single block under a single lock. Only the data of completely read files
+    is written, so a file which fails part way never leaves rows in the zones.
+    FRED files are recorded in the provenance store and the ingest manifest
+    after their data has been written, less any duplicate rows which were
+    dropped.
+
+    The writer never flushes by itself. Callers flush it between files, so a
+    failure to write the zones is not mistaken for a failure to read a file."""
+
+    def __init__(self, save_dir, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = zone_buffer_bytes
+
+        self.save_dir = save_dir
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.reading = dict()     # filename -> {zone_id: list of data} for files being read
+        self.buffers = dict()     # zone_id -> list of (filename, data) for completed files
+        self.completed = list()   # (filename, num_fred_data, zone_counts)
+        self.duplicates = dict()  # filename -> {zone_id: rows dropped}
+
+    def add(self, filename, zone_id, data):
+        """Buffers data from filename for the specified zone. The data is held
+        until the file is completed."""
+        zones = self.reading.setdefault(filename, dict())
+        zones.setdefault(zone_id, []).append(data)
+        self.num_bytes += data.nbytes
+
+    def complete(self, filename, num_fred_data, zone_counts):
+        """Marks filename as completely read. Its data and zone mapping
+        information are written with the next flush."""
+        zones = self.reading.pop(filename, dict())
+        for zone_id in sorted(zones.keys()):
+            for data in zones[zone_id]:
+                self.buffers.setdefault(zone_id, []).append((filename, data))
+        self.completed.append((filename, num_fred_data, zone_counts))
+
+    def is_full(self):
+        """Returns True if the buffered data exceeds the memory budget"""
+        return self.num_bytes >= self.max_bytes
+
+    def discard(self, filename):
+        """Drops the buffered data from filename, which has not been completed"""
+        zones = self.reading.pop(filename, dict())
+        self.num_bytes -= sum([data.nbytes for entries in zones.values()
+                               for data in entries])
+        self.duplicates.pop(filename, None)
+
+    def flush(self):
+        """Writes the buffered data of the completed files to the zone files.
+        Data from files which are still being read stays buffered."""
+
+        for zone_id in sorted(self.buffers.keys()):
+            entries = self.buffers[zone_id]
+            data = np.concatenate([entry[1] for entry in entries])
+            sources = [(filename, len(d)) for filename, d in entries]
+            duplicates = self.write_zone(zone_id, data, sources)
+
+            for filename, (num_within, num_existing) in duplicates.items():
+                counts = self.duplicates.setdefault(filename, dict())
+                counts[zone_id] = counts.get(zone_id, 0) + num_within + num_existing
+
+        self.buffers = dict()
+        self.num_bytes = sum([data.nbytes for zones in self.reading.values()
+                              for entries in zones.values() for data in entries])
+
+        files = []
+        for filename, num_fred_data, zone_counts in self.completed:
+            duplicates = self.duplicates.pop(filename, dict())
+            zone_counts = subtract_duplicates(zone_counts, duplicates)
+            files.append((filename, num_fred_data, zone_counts))
+        self.write_mapping(files)
+        self.completed = list()
+
+    def write_zone(self, zone_id, data, sources):
+        """Appends data, read from the (filename, num_rows) sources, to a zone
+        file. Returns the duplicate rows dropped from each file."""
+        zone_filename = self.save_dir + '/' + name_zone_file(zone_id)
+        with FileLock(zone_filename, timeout=100, delay=0.05):
+            return write_zone_data(self.save_dir, zone_id, data, sources)
+
+    def write_mapping(self, files):
+        """Records the (filename, num_fred_data, zone_counts) files whose data
+        has been written"""
+        write_ingest_info(self.save_dir, files)
+
+class SpillWriter(ZoneWriter):
+    """Zone writer for the map phase of the shuffle mode. Zone data is written
+    to spill files in spill_dir which are private to the writer, so no locks
+    are needed. The zone mapping information, and the files from which the
+    rows in each spill file were read, are kept in memory and used in the
+    reduce phase."""
+
+    def __init__(self, save_dir, spill_dir, max_bytes=None):
+        ZoneWriter.__init__(self, save_dir, max_bytes)
+
+        self.spill_dir = spill_dir
+        self.sources = dict()   # zone_id -> list of (filename, num_rows) in the spill file
+        self.mapping = list()   # (filename, num_fred_data, zone_counts)
+
+        # spill files left behind by an aborted run are stale
+        if os.path.isdir(spill_dir):
+            for filename in os.listdir(spill_dir):
+                os.remove(spill_dir + '/' + filename)
+        else:
+            os.makedirs(spill_dir)
+
+    def write_zone(self, zone_id, data, sources):
+        """Appends data to this writer's spill file for the zone. Duplicates
+        are dropped in the reduce phase."""
+        spill_filename = self.spill_dir + '/' + name_zone_file(zone_id)
+        append_fredbin(spill_filename, data)
+        self.sources.setdefault(zone_id, []).extend(sources)
+        return dict()
+
+    def write_mapping(self, files):
+        self.mapping.extend(files)
+
+def add_fred(save_dir, filename, writer=None):
+    """Processes an APASS FRED file into zones following the zone layout of
+    make_zones.py (see apass.zone_ids_from_coords). The file is read in batches
+    of batch_rows rows which are passed to the (buffered) zone writer. If no
+    writer is specified, the data is written before this function returns."""
+    print("Processing FRED file " + filename)
+
+    global batch_rows
 
-    # restore the tree. make-zones.py writes out leaves of type IDLeaf
-    tree = QuadTreeNode.from_file(tree_file, leafClass=IDLeaf)
+    flush = writer is None
+    if writer is None:
+        writer = ZoneWriter(save_dir)
 
-    # read the fred file into a numpy array
-    data = None
+    num_fred_data = 0
+    zone_counts = dict()
     try:
-        data = read_fred(filename)
-    except ValueError:
-        print("ERROR: File %s has a bad value and was not parsed" % (filename))
-        flag_read_error = True
-    except IndexError:
-        print("ERROR: File %s is missing data and was not parsed" % (filename))
-        flag_read_error = True
+        for batch in iter_fred(filename, batch_rows=batch_rows):
+            num_fred_data += len(batch)
+            data_dict = build_data_dict(batch)
+
+            # remove any data that is not for a zone
+            del data_dict['num_fred_data']
+
+            for zone_id, data in data_dict.items():
+
+                # skip zones with no data
+                if len(data) == 0:
+                    continue
+
+                writer.add(filename, zone_id, data)
+                zone_counts[zone_id] = zone_counts.get(zone_id, 0) + len(data)
     except:
-        print("ERROR: File %s has an unknown error and was not parsed" % (filename))
-        flag_read_error = True
+        writer.discard(filename)
+        raise
 
-    if flag_read_error:
-        with FileLock(error_filename, timeout=100, delay=0.05):
-            with open(error_filename, 'a') as error_file:
-                message = "ERROR: Cannot parse %s" % (filename)
-                error_file.write(message)
-                print message
+    writer.complete(filename, num_fred_data, zone_counts)
+    if flush:
+        writer.flush()
 
-        return None
+    # if there wasn't any data, bail out early.
+    impacted_zones = sorted(zone_counts.keys())
+    if num_fred_data == 0:
+        return impacted_zones
 
-    # skip empty files
-    if data is None:
-        return None
-    if len(data) == 0:
-        return None
+    print("Completed FRED file " + filename)
 
-    # update the number of data points read.
-    data_dict['num_fred_data'] = len(data)
+    return impacted_zones
 
-    # Map each data point to a corresponding zone file by performing
-    # a mock-insert into the (local copy) of the global tree and storing
-    # the data point within
+def add_freds(save_dir, filenames, writer=None):
+    """Processes a group of FRED files into zones using a single buffered zone
+    writer. Returns the IDs of the zones impacted."""
 
-    open_files = set()
-    for datum in np.nditer(data):
-        # we are about to modify the datum, make a copy
-        datum = datum.copy()
+    global error_filename
+    global buffer_bytes
 
-        # pull out the RA and DEC and perform a mock insert into the global tree
-        [ra, dec] = get_coords(datum)
-        zone_id = tree.insert(ra, dec, None)
+    if writer is None:
+        writer = ZoneWriter(save_dir, buffer_bytes)
+    fred_func = partial(add_fred, writer=writer)
 
-        # update the datum with its new zone ID
-        datum['zone_id'] = zone_id
+    impacted_zones = set()
+    try:
+        for filename in filenames:
+            output = fred_to_zone(fred_func, save_dir, filename)
+            if output is not None:
+                impacted_zones.update(output)
 
-        # move the data into the dictionary
-        data_dict[zone_id].append(datum)
+            if writer.is_full():
+                writer.flush()
 
-    return data_dict
+        writer.flush()
+    except:
+        # Some zones may have been written without provenance or manifest
+        # records for their files, so the run must not carry on.
+        message = "ERROR: Failed to write zone data for %s. Re-run in debug mode\n" % (', '.join(filenames))
+        tb = traceback.format_exc()
 
-def write_mapping_info(save_dir, filename, data_dict, mode="add"):
-    """
-    Valid modes are "add" or "remove"
-    """
+        print(message)
+        with FileLock(error_filename, timeout=100, delay=0.05):
+            with open(error_filename, 'a') as error_file:
+                error_file.write(message + "\n" + str(tb) + "\n")
+        raise
 
-    num_zones = get_num_zones()
-    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return sorted(impacted_zones)
 
-    # sign to indicate addition or removal of data
-    sign = 1
-    if mode == "remove":
-        sign = -1
-
-    # write out the input to zone assignment information
-    mapping_data = list()
-    mapping_data.append(date)
-    mapping_data.append(filename)
-    mapping_data.append(data_dict['num_fred_data'])
-    for zone_id in range(0, num_zones):
-        num_data = 0
-        zone_data = data_dict[zone_id]
-        if zone_data is not None:
-            num_data = len(zone_data)
-
-        num_data *= sign
-        mapping_data.append(num_data)
-
-    # convert the data to strings
-    mapping_data = map(str, mapping_data)
-
-    # write the data to file
-    zone_mapping_file = save_dir + '/' + 'zone_mapping.log'
-    with FileLock(zone_mapping_file, timeout=100, delay=0.05):
-        with open(zone_mapping_file, 'a+') as outfile:
-            outfile.write(','.join(mapping_data) + "\n")
-
-def add_fred(save_dir, filename):
-    """Processes an APASS FRED file into zones using data contained in the tree"""
-    print("Processing FRED file " + filename)
+def name_spill_dir(save_dir, group_id):
+    """Produces the name of the spill directory for a group of FRED files"""
+    return save_dir + '/' + spill_dir_name + '/group' + str(group_id).zfill(5)
 
-    impacted_zones = []
-    data_dict = build_data_dict(filename)
+def map_freds(save_dir, group):
+    """Map phase of the shuffle mode. Processes a (group_id, filenames) group
+    of FRED files into per-zone spill files. Returns the spill directory, the
+    sources of the zones spilled (see SpillWriter) and the zone mapping
+    information."""
 
-    # if there isn't any data, bail out early.
-    if data_dict is None:
-        return impacted_zones
+    global buffer_bytes
 
-    # write the input data to zone mapping information to a file
-    write_mapping_info(save_dir, filename, data_dict, mode="add")
+    group_id, filenames = group
+    spill_dir = name_spill_dir(save_dir, group_id)
 
-    # remove any data that is not for a zone
-    del data_dict['num_fred_data']
+    writer = SpillWriter(save_dir, spill_dir, buffer_bytes)
+    add_freds(save_dir, filenames, writer=writer)
 
-    # Write out the data being sure to lock all related files prior to opening
-    for zone_id, data in data_dict.iteritems():
+    return spill_dir, writer.sources, writer.mapping
 
-        # skip zones with no data
-        if len(data) == 0:
-            continue
+def reduce_zone(save_dir, spill_dirs, zone):
+    """Reduce phase of the shuffle mode. zone is a (zone_id, sources) tuple
+    where sources lists the (filename, num_rows) read into the spill files of
+    the zone, in the order of spill_dirs. Concatenates the spill files of the
+    zone and appends them to the zone file as a single block. The zone must not
+    be written to by any other process.
 
-        zone_filename    = save_dir + '/' + name_zone_file(zone_id)
-        contrib_filename = save_dir + '/' + name_zone_contrib_file(zone_id)
+    Returns the zone ID and the duplicate rows dropped from each file, or None
+    if the zone could not be written."""
 
-        with FileLock(zone_filename, timeout=100, delay=0.05):
-            with open(zone_filename, 'a+b') as outfile:
-                write_fredbin(outfile, data)
+    global error_filename
 
-            with open(contrib_filename, 'a+') as outfile:
-                outfile.write(filename + "\n")
+    zone_id, sources = zone
 
-        impacted_zones.append(zone_id)
+    try:
+        spill_filenames = [spill_dir + '/' + name_zone_file(zone_id) for spill_dir in spill_dirs]
+        spill_filenames = [f for f in spill_filenames if os.path.isfile(f)]
+        if len(spill_filenames) == 0:
+            return None
 
-    print("Completed FRED file " + filename)
+        data = np.concatenate([read_fredbin(f) for f in spill_filenames])
+        duplicates = write_zone_data(save_dir, zone_id, data, sources)
 
-    return impacted_zones
+        for spill_filename in spill_filenames:
+            os.remove(spill_filename)
+    except:
+        message = "ERROR: Failed to reduce zone %i. Re-run in debug mode\n" % (zone_id)
+        tb = traceback.format_exc()
+
+        print(message)
+        with FileLock(error_filename, timeout=100, delay=0.05):
+            with open(error_filename, 'a') as error_file:
+                error_file.write(message + "\n" + str(tb) + "\n")
+        return None
+
+    return zone_id, duplicates
+
+def shuffle_freds(save_dir, groups, jobs, debug=False):
+    """Imports the groups of FRED files in two phases without any locking on
+    the zone files. In the map phase every group is written to its own spill
+    files, partitioned by zone. In the reduce phase every zone is assembled
+    from its spill files by a single job. Returns the IDs of the zones
+    impacted."""
+
+    map_func = partial(map_freds, save_dir)
+    groups = list(enumerate(groups))
+
+    # map phase
+    print("Mapping %i groups of FRED files" % (len(groups)))
+    if debug:
+        map_results = [map_func(group) for group in groups]
+    else:
+        pool = mp.Pool(jobs)
+        map_results = list(pool.imap(map_func, groups))
+        pool.close()
+        pool.join()
+
+    # collect the spilled zones and the zone mapping information
+    spill_dirs = list()
+    zone_sources = dict()
+    mapping = list()
+    for spill_dir, group_sources, group_mapping in map_results:
+        spill_dirs.append(spill_dir)
+        for zone_id, sources in group_sources.items():
+            zone_sources.setdefault(zone_id, []).extend(sources)
+        mapping.extend(group_mapping)
+
+    zones = sorted(zone_sources.items())
+    zone_ids = [zone_id for zone_id, sources in zones]
+
+    # reduce phase
+    print("Reducing %i zones" % (len(zones)))
+    reduce_func = partial(reduce_zone, save_dir, spill_dirs)
+    if debug:
+        reduce_results = [reduce_func(zone) for zone in zones]
+    else:
+        pool = mp.Pool(jobs)
+        reduce_results = list(pool.imap(reduce_func, zones))
+        pool.close()
+        pool.join()
+
+    # collect the duplicate rows dropped from each file
+    file_duplicates = dict()
+    for result in reduce_results:
+        if result is None:
+            continue
+        zone_id, duplicates = result
+        for filename, (num_within, num_existing) in duplicates.items():
+            file_duplicates.setdefault(filename, dict())[zone_id] = num_within + num_existing
+
+    # record the provenance now that the data is in the zones. Files with data
+    # in zones that failed to reduce are only recorded for the other zones and
+    # are not marked as ingested.
+    failed = set([zone_id for zone_id, result in zip(zone_ids, reduce_results)
+                  if result is None])
+    ingested = []
+    partial_counts = []
+    for filename, num_fred_data, zone_counts in mapping:
+        zone_counts = subtract_duplicates(zone_counts, file_duplicates.get(filename, dict()))
+        if len(failed.intersection(zone_counts.keys())) > 0:
+            zone_counts = dict([(k, v) for k, v in zone_counts.items() if k not in failed])
+            partial_counts.append((filename, zone_counts))
+        else:
+            ingested.append((filename, num_fred_data, zone_counts))
+    provenance.record_files(save_dir, partial_counts)
+    write_ingest_info(save_dir, ingested)
+
+    # remove the spill directories. Spill files of zones that failed to reduce
+    # are kept for inspection.
+    for spill_dir in spill_dirs + [save_dir + '/' + spill_dir_name]:
+        if os.path.isdir(spill_dir) and len(os.listdir(spill_dir)) == 0:
+            os.rmdir(spill_dir)
+
+    return [result[0] for result in reduce_results if result is not None]
 
 def fred_to_zone(proc_func, save_dir, filename):
     """Wrapper function for adding/removing FRED files that includes exception
@@ -211,14 +637,34 @@ def fred_to_zone(proc_func, save_dir, filename):
 def main():
 
     global error_filename
-    global tree_file
+    global batch_rows
+    global buffer_bytes
+    global drop_duplicates
 
     parser = argparse.ArgumentParser(description='Parses .fred files into zone .fredbin files')
     parser.add_argument('save_dir', help="Directory to save the output files.")
-    parser.add_argument('input', nargs='+', help="Input files which will be split into zonefiles")
+    parser.add_argument('input', nargs='+', help="Input files which will be split into zonefiles (.fred, optionally compressed as .fred.gz, .fred.bz2 or .fred.xz)")
     parser.add_argument('-j','--jobs', type=int, help="Parallel jobs", default=4)
     parser.add_argument('--debug', default=False, action='store_true',
                         help="Run in debug mode")
+    parser.add_argument('--batch-rows', type=int, default=fred_batch_rows,
+                        help="Number of FRED rows read and routed at a time")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Cache parsed FRED files in this directory")
+    parser.add_argument('--cache-size', type=float, default=100,
+                        help="Maximum size of the FRED cache in GB")
+    parser.add_argument('--codec', default='none', choices=fredbin_codecs,
+                        help="Compression used for new fredbin files")
+    parser.add_argument('--buffer-size', type=float, default=zone_buffer_bytes / 1024**2,
+                        help="Zone data buffered by each job before writing, in MB")
+    parser.add_argument('--group-size', type=int, default=None,
+                        help="FRED files processed by each job between flushes (default: spread the input over 4 groups per job)")
+    parser.add_argument('--force', default=False, action='store_true',
+                        help="Ingest files even if they are listed in the ingest manifest")
+    parser.add_argument('--shuffle', default=False, action='store_true',
+                        help="Import in two lock-free phases: per-job spill files, then one job per zone")
+    parser.add_argument('--keep-duplicates', default=False, action='store_true',
+                        help="Do not drop rows which duplicate rows already read (see dedup.py)")
     parser.set_defaults(jobs=1)
 
     # parse the command line arguments and start timing the script
@@ -227,42 +673,61 @@ def main():
 
     # load globals
     error_filename = args.save_dir + "/error_fred_to_zone.txt"
-    tree_file = args.save_dir + "/global.json"
+    batch_rows = args.batch_rows
+    buffer_bytes = int(args.buffer_size * 1024**2)
+    drop_duplicates = not args.keep_duplicates
+
+    if args.cache_dir is not None:
+        enable_fred_cache(args.cache_dir, int(args.cache_size * 1024**3))
+    set_fredbin_codec(args.codec)
 
     # truncate the error log file
     with open(error_filename, 'w') as error_file:
         error_file.truncate()
 
-    # ensure the zone mapping file exists and is populated with a header
-    zone_mapping_file = args.save_dir + '/' + 'zone_mapping.log'
-    if not os.path.isfile(zone_mapping_file):
-        num_zones = get_num_zones()
-        header = list()
-        header.append('date')
-        header.append('fred_filename')
-        header.append('fred_num_values')
-        for i in range(0, num_zones):
-            header.append(i)
-
-        header = map(str, header)
-        with open(zone_mapping_file, 'w') as outfile:
-            outfile.write(','.join(header) + "\n")
+    # skip files that were already ingested, report files that have changed
+    new_files, ingested_files, changed_files = \
+        select_new_freds(args.save_dir, args.input, jobs=args.jobs, force=args.force)
+    if len(ingested_files) > 0:
+        print("Skipping %i previously ingested FRED files" % (len(ingested_files)))
+    for filename in changed_files:
+        print("WARNING: %s has changed since it was ingested. Skipping it (see --force)" % (filename))
+
+    changed_file = args.save_dir + "/fred-to-zone-changed-files.txt"
+    with open(changed_file, 'w') as outfile:
+        for filename in changed_files:
+            outfile.write(filename + "\n")
+    if len(changed_files) > 0:
+        print("A list of changed files has been written to %s" % (changed_file))
+
+    # duplicates dropped by this run are appended to the duplicates report
+    report_offset = dedup.report_offset(args.save_dir)
+
+    # split the input into groups of files which share a buffered zone writer
+    group_size = args.group_size
+    if group_size is None:
+        num_groups = 4 * max(args.jobs, 1)
+        group_size = (len(new_files) + num_groups - 1) // num_groups
+    group_size = max(group_size, 1)
+    groups = [new_files[i:i + group_size] for i in range(0, len(new_files), group_size)]
 
     # Construct a partial to serve as the function to call in serial or
     # parallel mode below.
-    fred_func = partial(fred_to_zone, add_fred, args.save_dir)
+    fred_func = partial(add_freds, args.save_dir)
 
     # set up the pool and launch the function
     results = []
-    if args.debug:
-        for filename in args.input:
-            r = fred_func(filename)
+    if args.shuffle:
+        results = shuffle_freds(args.save_dir, groups, args.jobs, debug=args.debug)
+    elif args.debug:
+        for group in groups:
+            r = fred_func(group)
             results.extend(r)
     else:
         pool = mp.Pool(args.jobs)
 
         # farm out the jobs and wait for the result
-        pool_result = pool.imap(fred_func, args.input)
+        pool_result = pool.imap(fred_func, groups)
         pool.close()
         pool.join()
 
@@ -284,6 +749,13 @@ def main():
 
     print("A list of modified files has been written to %s" % (mod_file))
 
+    # summarize the duplicates which were dropped
+    duplicates = dedup.summarize_report(dedup.read_report(args.save_dir, report_offset))
+    if len(duplicates) > 0:
+        num_duplicates = sum([sum(counts) for counts in duplicates.values()])
+        print("Dropped %i duplicate rows from %i FRED files, see %s" %
+              (num_duplicates, len(duplicates), dedup.name_report_file(args.save_dir)))
+
     end = time.time()
     print("Time elapsed: %is" % (int(end - start)))
 
@@ -0,0 +1,319 @@
+# Vectorized clustering of zone data into containers.
+#
+# The legacy engine of zone_to_rects.py inserts the measurements of a zone one
+# at a time into the zone's quadtree (see RectLeaf.insert), merging the
+# container of each measurement with any containers it overlaps. This module
+# builds the containers of a zone from its ra/dec arrays all at once:
+#
+#  1. Every measurement is given the box of +/- container_radius around it
+#     that RectContainer uses.
+#  2. The measurements are bucketed into a grid of cells which are small
+#     enough that the boxes of all measurements in a cell overlap. Every
+#     occupied cell starts out as a group.
+#  3. Groups whose bounding rectangles overlap (see RectContainer.overlaps)
+#     are joined with a union-find until no two groups overlap.
+#
+# Each group becomes a container in the leaf which contains the center of its
+# rectangle. The result does not depend on the order of the measurements.
+
+# system includes
+import numpy as np
+from math import pi
+
+# local includes
+from quadtree import Rect
+from apass_types import RectContainer, ContainerIndex
+
+container_radius = 1. / (60 * 60) # 1 arcsecond in degrees, see RectContainer
+
+def union_find(num_items, a, b):
+    """Joins the sets containing the items a[k] and b[k] for every k. Returns
+    the root of the set containing each of the num_items items, which is the
+    smallest item in the set."""
+
+    roots = np.arange(num_items)
+    a = np.asarray(a, dtype='int64')
+    b = np.asarray(b, dtype='int64')
+
+    while len(a) > 0:
+        root_a = roots[a]
+        root_b = roots[b]
+
+        # drop pairs which are already in the same set
+        active = root_a != root_b
+        if not active.any():
+            break
+        a = a[active]
+        b = b[active]
+        root_a = root_a[active]
+        root_b = root_b[active]
+
+        # hook the larger root under the smaller one, then compress the paths
+        np.minimum.at(roots, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            parents = roots[roots]
+            if (parents == roots).all():
+                break
+            roots = parents
+
+    return roots
+
+def _group_rects(labels, num_groups, x_min, x_max, y_min, y_max):
+    """Returns the bounding rectangles of groups of rectangles as (x_min, x_max,
+    y_min, y_max) arrays. labels holds the group (0 ... num_groups - 1) of each
+    rectangle, every group must occur."""
+
+    order = np.argsort(labels, kind='mergesort')
+    starts = np.flatnonzero(np.diff(labels[order])) + 1
+    starts = np.concatenate([[0], starts])
+
+    g_x_min = np.minimum.reduceat(x_min[order], starts)
+    g_x_max = np.maximum.reduceat(x_max[order], starts)
+    g_y_min = np.minimum.reduceat(y_min[order], starts)
+    g_y_max = np.maximum.reduceat(y_max[order], starts)
+    return g_x_min, g_x_max, g_y_min, g_y_max
+
+# the largest number of cells along each axis of the grid of overlapping_pairs
+max_grid_cells = 4096
+
+def _cell_entries(x_min, x_max, y_min, y_max, cell_width, cell_height):
+    """Enters every rectangle in each cell of a grid of cell_width by
+    cell_height it spans. Returns the column and row of the lower left corner
+    of each rectangle, and the rectangle and cell of each entry."""
+
+    x0 = x_min.min()
+    y0 = y_min.min()
+    first_i = np.floor((x_min - x0) / cell_width).astype('int64')
+    first_j = np.floor((y_min - y0) / cell_height).astype('int64')
+    spans_i = np.floor((x_max - x0) / cell_width).astype('int64') - first_i + 1
+    spans_j = np.floor((y_max - y0) / cell_height).astype('int64') - first_j + 1
+    num_columns = first_i.max() + spans_i.max() + 1
+
+    spans = spans_i * spans_j
+    ids = np.repeat(np.arange(len(x_min)), spans)
+    offsets = np.arange(len(ids)) - np.repeat(np.cumsum(spans) - spans, spans)
+    i = first_i[ids] + offsets % spans_i[ids]
+    j = first_j[ids] + offsets // spans_i[ids]
+
+    return first_i, first_j, ids, j * num_columns + i, num_columns
+
+def overlapping_pairs(x_min, x_max, y_min, y_max, active=None):
+    """Returns the indices (a, b) of all pairs of overlapping rectangles (see
+    Rect.overlaps). Rectangles which both extend past the north (or south)
+    pole always overlap, see RectContainer.overlaps. If active (a boolean
+    array) is given, only pairs including an active rectangle are returned."""
+
+    # Enter the rectangles in a grid of cells which are about twice as large
+    # as the rectangles, then sweep along x within each cell. The number of
+    # candidates stays proportional to the number of rectangles.
+    widths = x_max - x_min
+    heights = y_max - y_min
+    cell_width = max(2 * np.median(widths), widths.max() / max_grid_cells,
+                     (x_max.max() - x_min.min()) / max_grid_cells)
+    cell_height = max(2 * np.median(heights), heights.max() / max_grid_cells,
+                      (y_max.max() - y_min.min()) / max_grid_cells)
+    if not cell_width > 0:
+        cell_width = 1.0
+    if not cell_height > 0:
+        cell_height = 1.0
+    first_i, first_j, ids, cells, num_columns = \
+        _cell_entries(x_min, x_max, y_min, y_max, cell_width, cell_height)
+
+    # only the cells of active rectangles can hold new pairs
+    if active is not None:
+        active_cells = np.unique(cells[active[ids]])
+        k = np.searchsorted(active_cells, cells)
+        keep = k < len(active_cells)
+        keep[keep] = active_cells[k[keep]] == cells[keep]
+        ids = ids[keep]
+        cells = cells[keep]
+    num_entries = len(ids)
+
+    order = np.lexsort((x_min[ids], cells))
+    ids = ids[order]
+    cells = cells[order]
+
+    # the candidates for entry k are the entries k+1 ... ends[k]-1, i.e. the
+    # entries of the same cell which start before entry k ends. Merging the
+    # starts and ends (by cell, x, starts first) counts them exactly.
+    is_end = np.concatenate([np.zeros(num_entries, dtype=bool),
+                             np.ones(num_entries, dtype=bool)])
+    merged = np.lexsort((is_end, np.concatenate([x_min[ids], x_max[ids]]),
+                         np.concatenate([cells, cells])))
+    ends = np.empty(num_entries, dtype='int64')
+    ends[merged[is_end[merged]] - num_entries] = \
+        np.cumsum(np.logical_not(is_end[merged]))[is_end[merged]]
+    counts = ends - np.arange(1, num_entries + 1)
+    counts[counts < 0] = 0
+
+    a = np.repeat(np.arange(num_entries), counts)
+    offsets = np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+    b = a + 1 + offsets
+
+    cell = cells[a]
+    a = ids[a]
+    b = ids[b]
+    keep = np.logical_not((y_max[b] < y_min[a]) | (y_min[b] > y_max[a]))
+
+    # report each pair only in the cell holding the lower left corner of
+    # their overlap
+    keep &= np.maximum(first_j[a], first_j[b]) * num_columns + \
+        np.maximum(first_i[a], first_i[b]) == cell
+    if active is not None:
+        keep &= active[a] | active[b]
+    a = a[keep]
+    b = b[keep]
+
+    # chain the rectangles extending past each pole together
+    pairs_a = [a]
+    pairs_b = [b]
+    for polar in [np.flatnonzero(y_max > 90), np.flatnonzero(y_min < -90)]:
+        if len(polar) > 1:
+            pairs_a.append(polar[:-1])
+            pairs_b.append(polar[1:])
+
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+def cluster(x, y):
+    """Groups the points (x,y) = (ra, dec) into containers. Returns the
+    container of each point, numbered 0 ... num_containers - 1 in the order of
+    the first point in each container, and the bounding rectangles of the
+    containers as (x_min, x_max, y_min, y_max) arrays."""
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+
+    # the box of each point, see RectContainer
+    dy = container_radius
+    dx = dy / np.cos(y * pi / 180)
+    x_min = x - dx
+    x_max = x + dx
+    y_min = y - dy
+    y_max = y + dy
+
+    # Bucket the points into cells of 2*min(dx) by 2*dy. The boxes of any two
+    # points in a cell overlap, so each cell starts out as one group.
+    cell_width = 2 * np.min(dx)
+    cell_height = 2 * dy
+    i = np.floor((x - x.min()) / cell_width).astype('int64')
+    j = np.floor((y - y.min()) / cell_height).astype('int64')
+    keys = i * (j.max() + 1) + j
+    keys, labels = np.unique(keys, return_inverse=True)
+    num_groups = len(keys)
+
+    # join overlapping groups until none overlap. Only groups which grew in
+    # the last pass can overlap other groups.
+    rects = _group_rects(labels, num_groups, x_min, x_max, y_min, y_max)
+    active = None
+    while True:
+        a, b = overlapping_pairs(*rects, active=active)
+        if len(a) == 0:
+            break
+
+        roots = union_find(num_groups, a, b)
+        roots, merged = np.unique(roots, return_inverse=True)
+        num_groups = len(roots)
+        labels = merged[labels]
+        rects = _group_rects(merged, num_groups, *rects)
+        active = np.bincount(merged, minlength=num_groups) > 1
+
+    # number the containers in the order of their first point
+    first = np.full(num_groups, len(x), dtype='int64')
+    np.minimum.at(first, labels, np.arange(len(x)))
+    order = np.argsort(first, kind='mergesort')
+    renumber = np.empty(num_groups, dtype='int64')
+    renumber[order] = np.arange(num_groups)
+
+    labels = renumber[labels]
+    rects = [r[order] for r in rects]
+
+    return labels, rects
+
+def _leaf_indices(leaves, x, y):
+    """Returns the index (into leaves) of the leaf containing each point (x,y)
+    of a zone tree, -1 for points outside of the tree. Leaves include their
+    lower and exclude their upper boundaries, see Rect.contains."""
+
+    x_bounds = np.unique([leaf.rect.x_min for leaf in leaves] +
+                         [leaf.rect.x_max for leaf in leaves])
+    y_bounds = np.unique([leaf.rect.y_min for leaf in leaves] +
+                         [leaf.rect.y_max for leaf in leaves])
+
+    lookup = -np.ones((len(y_bounds), len(x_bounds)), dtype='int64')
+    for index, leaf in enumerate(leaves):
+        # leaves of different depths span different numbers of cells
+        i_min, i_max = np.searchsorted(x_bounds, [leaf.rect.x_min, leaf.rect.x_max])
+        j_min, j_max = np.searchsorted(y_bounds, [leaf.rect.y_min, leaf.rect.y_max])
+        lookup[j_min:j_max, i_min:i_max] = index
+
+    i = np.searchsorted(x_bounds, x, side='right') - 1
+    j = np.searchsorted(y_bounds, y, side='right') - 1
+    outside = (i < 0) | (i >= len(x_bounds) - 1) | (j < 0) | (j >= len(y_bounds) - 1)
+    i[outside] = 0
+    j[outside] = 0
+
+    indices = lookup[j, i]
+    indices[outside] = -1
+    return indices
+
+def cluster_zone(zone_tree, data, zone_id):
+    """Groups the data of a zone into containers in the leaves (RectLeaf) of
+    zone_tree. The leaves and containers are numbered as number_containers in
+    zone_to_rects.py does and the zone_id, node_id and container_id columns of
+    data are set accordingly. The containers only hold metadata, their data
+    is returned in container order, i.e. sorted by (node_id, container_id).
+
+    Raises a RuntimeError if any data are outside of the zone."""
+
+    leaves = zone_tree.get_leaves()
+    for node_id, leaf in enumerate(leaves):
+        leaf.zone_id = zone_id
+        leaf.node_id = node_id
+        leaf.containers = ContainerIndex()
+
+    if len(data) == 0:
+        return data
+
+    point_leaves = _leaf_indices(leaves, data['ra'], data['dec'])
+    if (point_leaves < 0).any():
+        k = np.flatnonzero(point_leaves < 0)[0]
+        raise RuntimeError("Could not find a node containing the point (%f, %f)" %
+                           (data['ra'][k], data['dec'][k]))
+
+    labels, (x_min, x_max, y_min, y_max) = cluster(data['ra'], data['dec'])
+    num_containers = len(x_min)
+
+    # each container belongs to the leaf containing the center of its
+    # rectangle, or to the leaf of its first point if the center is outside
+    # of the zone
+    center_x = x_min + (x_max - x_min) / 2
+    center_y = y_min + (y_max - y_min) / 2
+    node_ids = _leaf_indices(leaves, center_x, center_y)
+    first = np.full(num_containers, len(data), dtype='int64')
+    np.minimum.at(first, labels, np.arange(len(data)))
+    outside = node_ids < 0
+    node_ids[outside] = point_leaves[first[outside]]
+
+    # number the containers within each leaf in order of their first point
+    order = np.argsort(node_ids, kind='mergesort')
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(node_ids[order])) + 1])
+    container_ids = np.empty(num_containers, dtype='int64')
+    container_ids[order] = np.arange(num_containers) - \
+        np.repeat(starts, np.diff(np.concatenate([starts, [num_containers]])))
+
+    num_data = np.bincount(labels, minlength=num_containers)
+
+    for k in order:
+        container = RectContainer(0, 0, None, zone_id=zone_id,
+                                  node_id=int(node_ids[k]),
+                                  container_id=int(container_ids[k]))
+        container.rect = Rect(x_min[k], x_max[k], y_min[k], y_max[k])
+        container.num_data = int(num_data[k])
+        leaves[node_ids[k]].containers.append(container)
+
+    data['zone_id'] = zone_id
+    data['node_id'] = node_ids[labels]
+    data['container_id'] = container_ids[labels]
+
+    order = np.lexsort((np.arange(len(data)), data['container_id'], data['node_id']))
+    return data[order]
@@ -17,6 +17,7 @@ from quadtree import *
 from quadtree_types import *
 
 import apass
+import zone_index
 
 def merge_polar_zones(root_node):
     """Replaces QuadTree nodes that reside completely within the polar zones
@@ -136,6 +137,9 @@ def main():
     # write the quadtree
     QuadTreeNode.to_file(tree, zonefile)
 
+    # write the binary index used for zone lookups
+    zone_index.write_zone_index(args.save_dir, tree)
+
     end = time.time()
     print("Time elapsed: %is" % (int(end - start)))
 
@@ -13,6 +13,7 @@ from quadtree_types import *
 
 # file I/O
 import fred
+import zone
 
 def plot_containers(leaf, axes):
     """Adds patches corresponding to container borders"""
@@ -45,15 +46,19 @@ def main():
         zone_name = apass.name_zone(zone_id)
         print "Plotting zone " + zone_name
 
+        # summarize the zone from the statistics kept with its files
+        zone_stats = zone.read_zone_stats(save_dir, zone_id, raw=True)
+        print("Zone file has " + str(zone_stats['num_rows']) + " entries")
+        container_stats = zone.read_zone_stats(save_dir, zone_id)
+        print("Zone container file has " + str(container_stats['num_rows']) + " entries")
+        print("Zone contains data from %i nights and %i filters" %
+              (len(zone_stats.get('nights', dict())), len(zone_stats.get('filters', dict()))))
+
         # load the original zone data. Note, we don't restore it to the tree
-        zone_data_file = save_dir + apass.name_zone_file(zone_id)
-        zone_data = fred.read_fredbin(zone_data_file)
-        print("Zone file has " + str(zone_data.size) + " entries")
+        zone_data = zone.read_zone_columns(save_dir, zone_id, ['ra', 'dec'], raw=True)
 
         # load the containerized zone data
-        zone_container_file = save_dir + apass.name_zone_container_file(zone_id)
-        zone_container_data = fred.read_fredbin(zone_container_file)
-        print("Zone container file has " + str(zone_container_data.size) + " entries")
+        zone_container_data = zone.read_zone_columns(save_dir, zone_id, ['ra', 'dec'])
 
         # load the zone's tree
         zone_json = save_dir + apass.name_zone_json_file(zone_id)
@@ -90,6 +95,12 @@ def main():
         ra  = zone_container_data['ra']
         plt.scatter(ra, dec, color="green")
 
+        # show all of the data
+        bounds = fred.merge_fredbin_stats(zone_stats, container_stats)
+        if 'ra' in bounds and 'dec' in bounds:
+            axes.set_xlim(bounds['ra'])
+            axes.set_ylim(bounds['dec'])
+
         plt.show()
 
 
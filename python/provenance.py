@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# Provenance of the zone data.
+#
+# Records which FRED files contributed data to which zones as a binary file of
+# (file_id, zone_id, num_rows) triples plus a dictionary mapping file IDs to
+# FRED filenames (one absolute filename per line, the line number is the file
+# ID).
+# Both files are only ever appended to. Data that is removed from a zone is
+# recorded as a triple with a negative number of rows, so the data currently
+# in a zone is given by the sum of the rows over all triples.
+
+# system includes
+import argparse
+import datetime
+import os
+import sys
+import numpy as np
+
+# custom modules
+sys.path.append(os.path.join(sys.path[0],'modules', 'FileLock', 'filelock'))
+from filelock import FileLock
+
+# local includes
+import apass
+
+provenance_triples_name = 'provenance.bin'
+provenance_files_name = 'provenance-files.txt'
+
+provenance_dtype = np.dtype([('file_id', '<i4'), ('zone_id', '<i4'), ('num_rows', '<i8')])
+
+# file ID dictionaries read so far, keyed by the absolute path of save_dir.
+# Each entry holds the filenames, their IDs and the number of bytes read.
+_file_ids = dict()
+
+def name_triples_file(save_dir):
+    """Returns the name of the provenance triples file in save_dir"""
+    return os.path.join(save_dir, provenance_triples_name)
+
+def name_files_file(save_dir):
+    """Returns the name of the provenance file ID dictionary in save_dir"""
+    return os.path.join(save_dir, provenance_files_name)
+
+def _read_file_ids(save_dir):
+    """Returns the file ID dictionary of save_dir, reading only the part of the
+    dictionary that was appended since the last call."""
+
+    key = os.path.abspath(save_dir)
+    if key not in _file_ids:
+        _file_ids[key] = {'names': [], 'ids': dict(), 'offset': 0}
+    entry = _file_ids[key]
+
+    filename = name_files_file(save_dir)
+    if not os.path.isfile(filename) or os.path.getsize(filename) == entry['offset']:
+        return entry
+
+    # the dictionary was rewritten (e.g. a new save_dir), start over
+    if os.path.getsize(filename) < entry['offset']:
+        entry['names'] = []
+        entry['ids'] = dict()
+        entry['offset'] = 0
+
+    with open(filename, 'r') as infile:
+        infile.seek(entry['offset'])
+        # only complete lines are consumed
+        for line in infile.read().splitlines(True):
+            if not line.endswith("\n"):
+                break
+            name = line.rstrip("\n")
+            entry['ids'][name] = len(entry['names'])
+            entry['names'].append(name)
+            entry['offset'] += len(line)
+
+    return entry
+
+def file_names(save_dir):
+    """Returns the list of FRED filenames, indexed by file ID"""
+    return list(_read_file_ids(save_dir)['names'])
+
+def file_id(save_dir, filename):
+    """Returns the ID of a FRED file or None if the file is unknown. Relative
+    filenames are taken relative to the current directory."""
+    ids = _read_file_ids(save_dir)['ids']
+    fid = ids.get(os.path.abspath(filename))
+    if fid is None:
+        # stores written before filenames were made absolute
+        fid = ids.get(filename)
+    return fid
+
+def record(save_dir, filename, zone_counts, sign=1):
+    """Records that filename contributed the number of rows given in
+    zone_counts (a dictionary keyed by zone ID) to the zones. Use sign=-1 to
+    record the removal of the rows."""
+    record_files(save_dir, [(filename, zone_counts)], sign)
+
+def record_files(save_dir, file_counts, sign=1):
+    """Records the contributions of several FRED files, given as a list of
+    (filename, zone_counts) tuples (see record), under a single lock. Files
+    without any rows are skipped."""
+
+    file_counts = [(os.path.abspath(filename), zone_counts)
+                   for filename, zone_counts in file_counts if len(zone_counts) > 0]
+    if len(file_counts) == 0:
+        return
+
+    triples_filename = name_triples_file(save_dir)
+    with FileLock(triples_filename, timeout=100, delay=0.05):
+        # look up (or assign) the file IDs while holding the lock
+        file_ids = _read_file_ids(save_dir)
+        new_names = []
+        for filename, zone_counts in file_counts:
+            if filename not in file_ids['ids'] and filename not in new_names:
+                new_names.append(filename)
+        if len(new_names) > 0:
+            with open(name_files_file(save_dir), 'a') as outfile:
+                outfile.write(''.join([name + "\n" for name in new_names]))
+            file_ids = _read_file_ids(save_dir)
+
+        triples = []
+        for filename, zone_counts in file_counts:
+            zone_ids = sorted(zone_counts.keys())
+            file_triples = np.zeros(len(zone_ids), dtype=provenance_dtype)
+            file_triples['file_id'] = file_ids['ids'][filename]
+            file_triples['zone_id'] = zone_ids
+            file_triples['num_rows'] = [sign * zone_counts[zone_id] for zone_id in zone_ids]
+            triples.append(file_triples)
+
+        with open(triples_filename, 'ab') as outfile:
+            outfile.write(np.concatenate(triples).tobytes())
+
+def read_triples(save_dir):
+    """Returns all (file_id, zone_id, num_rows) triples as recorded"""
+
+    triples_filename = name_triples_file(save_dir)
+    if not os.path.isfile(triples_filename):
+        return np.zeros(0, dtype=provenance_dtype)
+
+    # ignore a partially written triple at the end of the file
+    num_triples = os.path.getsize(triples_filename) // provenance_dtype.itemsize
+    return np.fromfile(triples_filename, dtype=provenance_dtype, count=num_triples)
+
+def read_provenance(save_dir):
+    """Returns the current provenance, that is the (file_id, zone_id, num_rows)
+    triples summed over all additions and removals, sorted by zone and file.
+    Triples without any remaining rows are dropped."""
+
+    triples = read_triples(save_dir)
+    if len(triples) == 0:
+        return triples
+
+    keys = triples['zone_id'].astype('int64') * 2**32 + triples['file_id']
+    keys, inverse = np.unique(keys, return_inverse=True)
+    num_rows = np.bincount(inverse, weights=triples['num_rows']).astype('int64')
+
+    output = np.zeros(len(keys), dtype=provenance_dtype)
+    output['zone_id'] = keys // 2**32
+    output['file_id'] = keys % 2**32
+    output['num_rows'] = num_rows
+
+    return output[output['num_rows'] > 0]
+
+def zones_for_file(save_dir, filename):
+    """Returns a dictionary with the number of rows filename contributed to
+    each zone, keyed by zone ID"""
+
+    fid = file_id(save_dir, filename)
+    if fid is None:
+        return dict()
+
+    triples = read_provenance(save_dir)
+    triples = triples[triples['file_id'] == fid]
+    return dict(zip(triples['zone_id'].tolist(), triples['num_rows'].tolist()))
+
+def files_for_zone(save_dir, zone_id):
+    """Returns a dictionary with the number of rows each FRED file contributed
+    to the zone, keyed by filename"""
+
+    names = file_names(save_dir)
+    triples = read_provenance(save_dir)
+    triples = triples[triples['zone_id'] == zone_id]
+    return dict([(names[fid], num_rows) for fid, num_rows in
+                 zip(triples['file_id'].tolist(), triples['num_rows'].tolist())])
+
+def import_zone_mapping_log(save_dir):
+    """Converts the zone_mapping.log written by older versions of
+    fred_to_zone.py into provenance triples"""
+
+    log_filename = save_dir + '/' + 'zone_mapping.log'
+    num_imported = 0
+    added_counts = []
+    removed_counts = []
+    with open(log_filename, 'r') as infile:
+        header = infile.readline().strip().split(',')
+        zone_ids = np.array([int(z) for z in header[3:]])
+        for line in infile:
+            values = line.strip().split(',')
+            if len(values) < 3:
+                continue
+            filename = values[1]
+            counts = np.array([int(v) for v in values[3:]])
+
+            # removals were logged with negative counts
+            added = counts > 0
+            removed = counts < 0
+            added_counts.append((filename, dict(zip(zone_ids[added].tolist(), counts[added].tolist()))))
+            removed_counts.append((filename, dict(zip(zone_ids[removed].tolist(), (-counts[removed]).tolist()))))
+            num_imported += 1
+
+    record_files(save_dir, added_counts)
+    record_files(save_dir, removed_counts, sign=-1)
+
+    return num_imported
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Queries the provenance of the zone data')
+    parser.add_argument('save_dir', help="Directory containing the zone files")
+    parser.add_argument('--zone', type=int, nargs='+', default=[],
+                        help="List the FRED files which contributed to these zones")
+    parser.add_argument('--file', nargs='+', default=[],
+                        help="List the zones to which these FRED files contributed")
+    parser.add_argument('--import-log', default=False, action='store_true',
+                        help="Import a zone_mapping.log written by older versions of the pipeline")
+
+    args = parser.parse_args()
+    save_dir = args.save_dir
+
+    if args.import_log:
+        num_imported = import_zone_mapping_log(save_dir)
+        print("Imported %i entries from the zone mapping log" % (num_imported))
+
+    for zone_id in args.zone:
+        print("%s:" % (apass.name_zone(zone_id)))
+        for filename, num_rows in sorted(files_for_zone(save_dir, zone_id).items()):
+            print(" %s %i" % (filename, num_rows))
+
+    for filename in args.file:
+        print("%s:" % (filename))
+        for zone_id, num_rows in sorted(zones_for_file(save_dir, filename).items()):
+            print(" %s %i" % (apass.name_zone(zone_id), num_rows))
+
+if __name__ == "__main__":
+    main()
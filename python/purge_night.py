@@ -13,65 +13,31 @@ import numpy.lib.recfunctions as nprf
 # project includes
 import apass
 import fred
+import fred_to_zone
+import provenance
 
-def read_contrib_file(filename):
-    """Reads in a contrib file. Returns it as a numpy structured array
-    with columns 'filename' and 'night_name'"""
-
-    # read in the file as-is.
-    data = []
-    with open(filename, 'r') as infile:
-        for line in infile:
-            line = line.strip()
-            night_name = find_night_name(line)
-            data.append((line, night_name))
-
-    num_rows = len(data)
-
-    # convert data into a structured numpy array
-    dtype = {'names': ['filename', 'night_name'], 'formats': ['S255', 'S7']}
-    data = np.array(data, dtype=dtype)
-
-    return data
-
-def write_contrib_file(filename, data):
-    """Writes a contrib file from a numpy structured array containing the
-    fields 'filename', and 'night_name'"""
-
-    # only the filename is written to disk
-    data = data['filename']
-
-    np.savetxt(filename, data, fmt=['%s'])
-
-def purge_nights(night_names, save_dir, filename):
-    """Loads a fredbin file, purges all data corresponding to night_name"""
+def purge_nights(night_names, save_dir, zone_info):
+    """Purges all data corresponding to night_names from a zone. zone_info is
+    a (zone_id, contributions) tuple where contributions is a dictionary with
+    the number of rows each FRED file of the nights contributed to the zone."""
 
     results = []
 
-    # load the zone contribution file
-    zone_id = apass.zone_from_name(filename)
-    contrib_filename = save_dir + '/' + apass.name_zone_contrib_file(zone_id)
-    contrib_data = read_contrib_file(contrib_filename)
-
-    # Find common nights between the contrib file and the nights to
-    # be purged. If none exist, return.
-    common_nights = np.intersect1d(contrib_data['night_name'], night_names)
-    if len(common_nights) == 0:
-        print("No purge-able nights for zone %i" % (zone_id))
-        return results
+    zone_id, contributions = zone_info
 
     # remove the data from the fredbin and containerized fredbin file
     fredbin_file   = save_dir + '/' + apass.name_zone_file(zone_id)
-    r = purge_nights_from_file(common_nights, fredbin_file)
+    r = purge_nights_from_file(night_names, fredbin_file)
     results.append(r)
     container_file = save_dir + '/' + apass.name_zone_container_file(zone_id)
-    r = purge_nights_from_file(common_nights, container_file)
+    r = purge_nights_from_file(night_names, container_file)
     results.append(r)
 
-    # now purge the nights from the contrib file
-    indices = np.nonzero(np.in1d(contrib_data['night_name'], common_nights))
-    contrib_data = np.delete(contrib_data, indices)
-    write_contrib_file(contrib_filename, contrib_data)
+    # record the removal of the files' data from the zone
+    provenance.record_files(save_dir, [(filename, {zone_id: num_rows}) for filename, num_rows
+                                       in sorted(contributions.items())], sign=-1)
+
+    return results
 
 def purge_nights_from_file(night_names, filename):
 
@@ -82,26 +48,20 @@ def purge_nights_from_file(night_names, filename):
 
     print("Processing %s" % (filename))
 
-    # At least one common night exists. Load the data.
-    data = fred.read_fredbin(filename)
+    # At least one common night exists. Load the data, leaving the night
+    # names encoded.
+    data = fred.read_fredbin(filename, decode=False)
     if data is None:
         return results
+    encoding = fred.read_fredbin_encoding(filename)
 
-    # first determine if this night has been stored in this data file
-    data = np.sort(data, order='night_name')
-
-    for night_name in night_names:
-
-        # find the upper and lower bounds for the night
-        l = np.searchsorted(data['night_name'], night_name, side='left')
-        r = np.searchsorted(data['night_name'], night_name, side='right')
-
-        # delete the entries
-        data = np.delete(data, slice(l, r), axis=0)
+    # delete the entries for the nights by comparing their codes
+    codes, purge_codes = fred.column_codes(data, encoding, 'night_name', night_names)
+    purge_codes = purge_codes[purge_codes >= 0]
+    data = data[np.logical_not(np.isin(codes, purge_codes))]
 
     # write the remaining data to disk
-    with open(filename, 'w') as outfile:
-        fred.write_fredbin(outfile, data)
+    fred.write_fredbin(filename, data, encoding=encoding)
 
     return results
 
@@ -140,23 +100,44 @@ def main():
         else:
             print("Skipping %s, could not determine night name" % (item))
 
-    # Find all of the fredbin files.
-    fredbin_files = glob.glob(args.save_dir + "*-raw.fredbin")
+    # Find the zones to which the FRED files of these nights contributed
+    names = provenance.file_names(args.save_dir)
+    triples = provenance.read_provenance(args.save_dir)
+    file_nights = np.array([str(find_night_name(name)) for name in names] + [''])
+    purge_files = np.isin(file_nights, night_names)
+    triples = triples[purge_files[triples['file_id']]]
+
+    zone_infos = dict()
+    for fid, zone_id, num_rows in triples.tolist():
+        zone_infos.setdefault(zone_id, dict())[names[fid]] = num_rows
+    zone_infos = sorted(zone_infos.items())
+
+    if len(zone_infos) == 0:
+        print("No purge-able nights found")
+        return
 
     # construct the purge function and run the deletion process
     purge_func = partial(purge_nights, night_names, args.save_dir)
     results = []
     if args.debug:
-        for filename in fredbin_files:
-            r = purge_func(filename)
+        for zone_info in zone_infos:
+            r = purge_func(zone_info)
             results.append(r)
     else:
         pool = mp.Pool(args.jobs)
 
-        # farm out the work and wait for the result
-        results = pool.imap(purge_func, fredbin_files)
+        # farm out the work and wait for the result. A failure in any zone
+        # is raised here, before the files are marked as purged below.
+        results = list(pool.imap(purge_func, zone_infos))
         pool.close()
         pool.join()
 
+    # allow the FRED files of the nights to be ingested again, now that every
+    # zone has been purged
+    by_hash, by_filename = fred_to_zone.read_ingest_manifest(args.save_dir)
+    purged_files = [filename for filename in sorted(by_filename.keys())
+                    if find_night_name(os.path.basename(filename)) in night_names]
+    fred_to_zone.record_purge(args.save_dir, purged_files)
+
 if __name__ == "__main__":
     main()
@@ -284,6 +284,32 @@ class QuadTreeNode(dict):
             for child in self.children:
                 child.split_until(depth, leafClass=leafClass)
 
+    @staticmethod
+    def split_by_count(rect, x, y, max_count, max_depth, depth=0, leafClass=None):
+        """Builds a quadtree over rect which is subdivided until each leaf
+        contains at most max_count of the points (x,y) (numpy arrays) or is
+        max_depth deep. Returns the root of the tree, which is a leaf if rect
+        contains max_count points or less. Leaf nodes will be of the type
+        QuadTreeNode unless leafClass is specified."""
+
+        inside = (x >= rect.x_min) & (x < rect.x_max) & (y >= rect.y_min) & (y < rect.y_max)
+        x = x[inside]
+        y = y[inside]
+
+        if len(x) <= max_count or depth >= max_depth:
+            if leafClass == None:
+                return QuadTreeNode(rect, depth)
+            return leafClass(rect, depth)
+
+        node = QuadTreeNode(rect, depth)
+        for child_rect in rect.splitIntoQuads():
+            child = QuadTreeNode.split_by_count(child_rect, x, y, max_count, max_depth,
+                                                depth=depth + 1, leafClass=leafClass)
+            child.parent = node
+            node.children.append(child)
+
+        return node
+
     def size(self):
         """Determine the total number of nodes in the tree"""
         size = 1
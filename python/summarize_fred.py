@@ -72,43 +72,33 @@ def summarize_fred(filename):
 
     output = []
 
-    data = None
+    # Collect the unique sets observed for each field in each filter. The file
+    # is read in batches, so only these sets are kept in memory.
+    field_sets = dict()
     try:
-        data = fred.read_fred(filename)
+        for data in fred.iter_fred(filename):
+            for field_id in set(data['field_id']):
+                indices = np.where(data['field_id'] == field_id)
+                field_data = data[indices]
+
+                filter_sets = field_sets.setdefault(field_id, dict())
+                for filter_id in apass_filter_ids:
+                    indices = np.where(field_data['filter_id'] == filter_id)
+                    filter_sets.setdefault(filter_id, set()).update(field_data['set'][indices])
     except:
         pass
 
-    # bipass empty files
-    if data is None:
-        return output
-
-    # find unique observations of fields in each filter
-    field_ids = set(data['field_id'])
-
     # for each field, summarize the number of observations in each filter
-    for field_id in field_ids:
+    for field_id, filter_sets in field_sets.items():
         # init a summary structure, start populating the data
         t_summary = init_summary_dict(filename)
         t_summary['field_id'] = field_id
 
-        # extract data for this field
-        indices = np.where(data['field_id'] == field_id)
-        field_data = data[indices]
-
-        # for each filter, determine the number of unique observations
+        # The number of unique sets in each filter is a proxy for the
+        # number of distinct observations.
         for filter_id in apass_filter_ids:
-
-            # extract the data for this filter
-            indices = np.where(field_data['filter_id'] == filter_id)
-            filter_data = field_data[indices]
-
-            # Get the unique JDs for this filter. This is a proxy for the
-            # number of distinct observations.
-            unique_sets = set(filter_data['set'])
-
-            # save the number of observations
             filter_name = apass.filter_name_from_id(filter_id)
-            t_summary[filter_name] = len(unique_sets)
+            t_summary[filter_name] = len(filter_sets[filter_id])
 
         output.append(t_summary)
 
@@ -215,12 +205,19 @@ def main():
     parser.add_argument('-j','--jobs', type=int, help="Parallel jobs", default=4)
     parser.add_argument('--debug', default=False, action='store_true',
                         help="Run in debug mode")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Cache parsed FRED files in this directory")
+    parser.add_argument('--cache-size', type=float, default=100,
+                        help="Maximum size of the FRED cache in GB")
     parser.set_defaults(jobs=1)
 
     # parse the command line arguments and start timing the script
     args = parser.parse_args()
     field_centers = read_field_centers(args.field_center_file)
 
+    if args.cache_dir is not None:
+        fred.enable_fred_cache(args.cache_dir, int(args.cache_size * 1024**3))
+
     run_func = partial(summarize_fred)
 
     results = []
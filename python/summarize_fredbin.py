@@ -1,7 +1,6 @@
 #!/usr/bin/python
 
 import argparse
-import numpy as np
 import multiprocessing as mp
 from functools import partial
 
@@ -14,40 +13,31 @@ def init_summary_dict(filename):
     output['filename'] = filename
     output['entries']  = 0
     output['nights']   = dict()
+    output['filters']  = dict()
+    output['fields']   = dict()
+    output['ra']       = None
+    output['dec']      = None
+    output['hjd']      = None
 
     return output
 
 def summarize_fredbin(filename):
-    """Reads in a fredbin file, prints out some basic statistics"""
+    """Reads the statistics of a fredbin file, prints out some basic statistics"""
 
     print("Processing %s" % (filename))
 
     output = init_summary_dict(filename)
 
-    data = None
+    # the statistics are kept in the trailer, so the records are not read
     try:
-        data = fred.read_fredbin(filename)
+        stats = fred.read_fredbin_stats(filename)
+        output['entries'] = stats['num_rows']
+        for key in ['nights', 'filters', 'fields', 'ra', 'dec', 'hjd']:
+            if key in stats:
+                output[key] = stats[key]
     except:
         pass
 
-    # bipass empty files
-    if data is None:
-        return output
-
-    # populate the dictionary with useful information
-    data = np.sort(data, order='night_name')
-    output['entries'] = len(data)
-
-    # find the unique named nights in the data
-    night_names = list(set(data['night_name']))
-    for night_name in night_names:
-
-        # find the upper and lower bounds for the night
-        l = np.searchsorted(data['night_name'], night_name, side='left')
-        r = np.searchsorted(data['night_name'], night_name, side='right')
-
-        output['nights'][night_name] = r - l
-
     return output
 
 def save_night_summary(filename, data):
@@ -81,7 +71,17 @@ def save_zone_summary(filename, data):
             filename = d['filename']
             entries  = d['entries']
 
-            outfile.write(filename + " " + str(entries) + "\n")
+            line = filename + " " + str(entries)
+
+            # bounds and filters, if known
+            for key in ['ra', 'dec', 'hjd']:
+                if d[key] is not None:
+                    line += " %s=[%f,%f]" % (key, d[key][0], d[key][1])
+            if len(d['filters']) > 0:
+                line += " filters=" + ",".join(["%s:%i" % (k, d['filters'][k])
+                                                for k in sorted(d['filters'].keys(), key=int)])
+
+            outfile.write(line + "\n")
 
 
 def main():
@@ -19,25 +19,43 @@ def read_old_fredbin(filename):
 
     return None
 
+def read_legacy_fredbin(filename):
+
+    # concatenated numpy.save chunks
+    try:
+        if fred.is_legacy_fredbin(filename):
+            return fred.read_legacy_fredbin(filename)
+    except:
+        pass
+
+    return None
+
 def upgrade_fredbin(filename):
 
-    # first try reading using standard methods
-    data = fred.read_fredbin(filename)
-    if data is not None:
-        print("%s is up to date" % (filename))
-        return None
+    # v2 files using the requested codec are up to date
+    data = None
+    try:
+        info = fred.read_fredbin_info(filename)
+        if info['codec'] == fred.fredbin_codec:
+            print("%s is up to date" % (filename))
+            return None
+        data = fred.read_fredbin(filename)
+    except IOError:
+        pass
 
     # read using other techniques
-    data = read_old_fredbin(filename)
+    if data is None:
+        data = read_legacy_fredbin(filename)
+    if data is None:
+        data = read_old_fredbin(filename)
 
     if data is None:
         print("Cannot read %s " % (filename))
         return None
 
     # save the file
-    with open(filename, 'wb') as outfile:
-        print("Upgrading %s" % (filename))
-        fred.write_fredbin(outfile, data)
+    print("Upgrading %s" % (filename))
+    fred.write_fredbin(filename, data)
 
     return filename
 
@@ -48,8 +66,11 @@ def main():
     parser.add_argument('-j','--jobs', type=int, help="Parallel jobs", default=4)
     parser.add_argument('--debug', default=False, action='store_true',
                         help="Run in debug mode")
+    parser.add_argument('--codec', default='none', choices=fred.fredbin_codecs,
+                        help="Compression used for the upgraded files")
 
     args = parser.parse_args()
+    fred.set_fredbin_codec(args.codec)
 
     if args.debug:
         for filename in args.input:
@@ -4,6 +4,8 @@
 import apass
 import sys
 import os
+import shutil
+import numpy as np
 
 # custom modules
 sys.path.append(os.path.join(sys.path[0],'modules', 'FileLock', 'filelock'))
@@ -15,8 +17,14 @@ from quadtree import QuadTreeNode
 from quadtree_types import *
 from apass_types import *
 from border_info import load_border_info, save_border_info
+from container_table import ContainerTable, pack_containers
 import fred
 
+# Write a column store (see fred.write_fredcols) next to each container file.
+# Off by default, read_zone_columns maps the container file and decodes only
+# the requested columns when there is no column store.
+zone_column_stores = False
+
 def load_zone_data(tree, save_dir):
     """Restores zone data from the specified save_dir to the tree."""
 
@@ -36,41 +44,129 @@ def load_zone_data(tree, save_dir):
 
         node_dict[node_id] = container_dict
 
-    # load the data
+    # map the data. Pages are copy-on-write as the containers modify their
+    # records in memory. Encoded columns stay encoded, the containers decode
+    # their own records.
     zone_id  = leaves[0].zone_id
     filename = save_dir + '/' + apass.name_zone_container_file(zone_id)
-    data     = fred.read_fredbin(filename)
+    data     = fred.open_fredbin(filename, mode='c', decode=False)
+    encoding = dict()
+
+    if data is None:
+        data = fred.to_fredbin([])
+    else:
+        encoding = fred.read_fredbin_encoding(filename)
 
-    # insert the data *directly* into the container, bipassing normal
-    # restoration methods.
-    for i in range(0, len(data)):
-        datum        = data[i]
-        node_id      = int(datum['node_id'])
-        container_id = int(datum['container_id'])
-        node_dict[node_id][container_id].append_data(datum)
+    # keep the data in a table shared by the containers of the zone
+    table = ContainerTable(data, encoding)
+    for leaf in leaves:
+        for container in leaf.containers:
+            container.attach(table, table.new_slot())
+
+    # the data is sorted by container, so each run of records with the same
+    # (node_id, container_id) is handed *directly* to its container,
+    # bypassing normal restoration methods.
+    node_ids      = data['node_id']
+    container_ids = data['container_id']
+    changes = (node_ids[1:] != node_ids[:-1]) | (container_ids[1:] != container_ids[:-1])
+    starts  = np.concatenate([[0], np.flatnonzero(changes) + 1]).astype('int64')
+    ends    = np.concatenate([starts[1:], [len(data)]]).astype('int64')
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if start == end:
+            continue
+        container = node_dict[int(node_ids[start])][int(container_ids[start])]
+        table.add_segment(container.slot, start, end - start)
+
+    for leaf in leaves:
+        for container in leaf.containers:
+            container.num_data = int(table.count[container.slot])
 
 def save_zone_data(tree, directory):
     """Saves zone data from the tree to the specified directory"""
 
     leaves = tree.get_leaves()
     zone_id = leaves[0].zone_id
-    filename = directory + '/' + apass.name_zone_container_file(zone_id)
 
-    # Extract the data from the tree
-    data = []
+    # Extract the data from the tree in container order
+    containers = []
     for leaf in leaves:
         # leaf is a RectTree instance
-        for container in leaf.containers:
-            # container is a RectContainer instance
-            temp = container.get_data()
-            container.clear_data()
+        containers.extend(leaf.containers)
+
+    data, encoding = pack_containers(containers)
+    for container in containers:
+        container.clear_data()
 
-            data.extend(temp)
+    # write the data to file
+    save_zone_array(directory, zone_id, data, encoding)
 
-    # convert the data to a fredbin and write to file
-    data = fred.to_fredbin(data)
+def save_zone_array(directory, zone_id, data, encoding=None):
+    """Saves the container data of a zone, given as a numpy structured array
+    in container order, to the specified directory. If encoding is given, the
+    data is already encoded (see fred.encode_fredbin). A column store is only
+    written if zone_column_stores is set."""
+
+    # data without encoded columns is encoded as it is written
+    if encoding is not None and len(encoding) == 0:
+        encoding = None
+
+    filename = directory + '/' + apass.name_zone_container_file(zone_id)
     with open(filename, 'wb') as outfile:
-        fred.write_fredbin(outfile, data)
+        fred.write_fredbin(outfile, data, encoding=encoding)
+
+    # optionally along with a column store for tools that only need a few
+    # columns. A column store from an earlier run is out of date.
+    columns_dir = directory + '/' + apass.name_zone_columns_dir(zone_id)
+    if zone_column_stores:
+        fred.write_fredcols(columns_dir, data, source_filename=filename,
+                            encoding=encoding or dict())
+    elif os.path.isdir(columns_dir):
+        shutil.rmtree(columns_dir)
+
+def read_zone_columns(save_dir, zone_id, columns=None, raw=False):
+    """Reads the specified columns (default: all) of a zone's container data
+    and returns them as a numpy structured array. Only the requested columns
+    are read from the zone's column store, if it has one (see
+    zone_column_stores). If the column store is missing or out of date, the
+    columns are extracted from the container file instead.
+
+    If raw is True, the columns are read from the zone's -raw.fredbin file."""
+
+    if raw:
+        filename = save_dir + '/' + apass.name_zone_file(zone_id)
+    else:
+        filename = save_dir + '/' + apass.name_zone_container_file(zone_id)
+        columns_dir = save_dir + '/' + apass.name_zone_columns_dir(zone_id)
+        data = fred.read_fredcols(columns_dir, columns, source_filename=filename)
+        if data is not None:
+            return data
+
+    # map the file and only decode the requested columns
+    data = fred.open_fredbin(filename, decode=False)
+    if data is None:
+        return None
+    encoding = fred.read_fredbin_encoding(filename)
+    if columns is None:
+        return np.array(fred.decode_fredbin(data, encoding))
+
+    return fred.project_fields(data, columns, encoding)
+
+def read_zone_stats(save_dir, zone_id, raw=False):
+    """Returns the statistics of a zone's container data (see
+    fred.fredbin_stats) without reading the records, or None if the zone has
+    no data.
+
+    If raw is True, the statistics of the zone's -raw.fredbin file are returned."""
+
+    if raw:
+        filename = save_dir + '/' + apass.name_zone_file(zone_id)
+    else:
+        filename = save_dir + '/' + apass.name_zone_container_file(zone_id)
+
+    if not os.path.isfile(filename):
+        return None
+
+    return fred.read_fredbin_stats(filename)
 
 def load_zone(save_dir, zone_id):
     """Loads the tree, data, and border info file for the specified zone.
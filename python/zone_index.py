@@ -0,0 +1,215 @@
+# Binary index of the global zone tree.
+#
+# make_zones.py writes the global zone tree to global.json. Rebuilding that
+# tree and walking it for every lookup is slow, so make_zones.py also writes a
+# compact index next to it consisting of
+#
+#  grid   - a (2**global_depth, 2**global_depth) array with the ID of the zone
+#           covering each cell of the global grid, indexed [dec index, ra index]
+#  bounds - a (max zone ID + 1, 4) array with the (x_min, x_max, y_min, y_max)
+#           bounds of each zone, NaN for unused IDs
+#
+# The index is loaded once per process and answers point, batch and neighbor
+# queries with simple array lookups.
+
+# system includes
+import os
+import numpy as np
+
+# local includes
+import apass
+from quadtree import QuadTreeNode, Rect
+from apass_types import IDLeaf
+
+zone_index_filename = 'global-index.npz'
+
+# loaded indexes, keyed by the absolute path of the save directory
+_zone_indexes = dict()
+
+def name_zone_index_file(save_dir):
+    """Returns the filename of the zone index in save_dir"""
+    return os.path.join(save_dir, zone_index_filename)
+
+def build_zone_index(tree):
+    """Builds a zone index from a global tree of IDLeaf nodes by sampling the
+    tree at the center of each cell of the global grid."""
+
+    num_cells = 2**apass.global_depth
+    dx = 360.0 / num_cells
+    dy = 180.0 / num_cells
+
+    grid = np.zeros((num_cells, num_cells), dtype='int32')
+    for j in range(0, num_cells):
+        y = -90.0 + (j + 0.5) * dy
+        for i in range(0, num_cells):
+            x = (i + 0.5) * dx
+            grid[j, i] = tree.find_leaf(x, y).node_id
+
+    # zones may consist of several leaves (e.g. the polar zones), use the
+    # union of their bounds
+    leaves = tree.get_leaves()
+    num_ids = max(int(grid.max()), max([leaf.node_id for leaf in leaves])) + 1
+    bounds = np.empty((num_ids, 4), dtype='float64')
+    bounds[:] = np.nan
+    for leaf in leaves:
+        rect = leaf.rect
+        b = bounds[leaf.node_id]
+        if np.isnan(b[0]):
+            b[:] = [rect.x_min, rect.x_max, rect.y_min, rect.y_max]
+        else:
+            b[:] = [min(b[0], rect.x_min), max(b[1], rect.x_max),
+                    min(b[2], rect.y_min), max(b[3], rect.y_max)]
+
+    return {'grid': grid, 'bounds': bounds}
+
+def write_zone_index(save_dir, tree):
+    """Builds the zone index for the global tree and writes it to save_dir"""
+    index = build_zone_index(tree)
+    np.savez(name_zone_index_file(save_dir),
+             grid=index['grid'], bounds=index['bounds'])
+    return index
+
+def read_zone_index(save_dir):
+    """Reads the zone index from save_dir. If the index is missing or older
+    than global.json, it is rebuilt from global.json (but not written)."""
+
+    index_filename = name_zone_index_file(save_dir)
+    tree_filename = os.path.join(save_dir, 'global.json')
+
+    if os.path.isfile(index_filename) and \
+       (not os.path.isfile(tree_filename) or
+        os.path.getmtime(index_filename) >= os.path.getmtime(tree_filename)):
+        npz = np.load(index_filename)
+        try:
+            index = {'grid': npz['grid'], 'bounds': npz['bounds']}
+        finally:
+            npz.close()
+        return index
+
+    tree = QuadTreeNode.from_file(tree_filename, leafClass=IDLeaf)
+    return build_zone_index(tree)
+
+def load_zone_index(save_dir):
+    """Returns the zone index for save_dir, reading it on the first call."""
+    key = os.path.abspath(save_dir)
+    if key not in _zone_indexes:
+        _zone_indexes[key] = read_zone_index(save_dir)
+    return _zone_indexes[key]
+
+def grid_indices(save_dir, x, y):
+    """Returns the (i,j) indices of the grid cells containing the points (x,y).
+    Points outside of the grid are assigned -1."""
+
+    grid = load_zone_index(save_dir)['grid']
+    height, width = grid.shape
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    i = apass._grid_index(x, 0, 360.0 / width, width)
+    j = apass._grid_index(y, -90, 180.0 / height, height)
+
+    return i, j
+
+def zone_id(save_dir, x, y):
+    """Returns the ID of the zone containing the point (x,y) or None if the
+    point is outside of the global tree (see QuadTreeNode.find_leaf)."""
+
+    i, j = grid_indices(save_dir, [x], [y])
+    if i[0] < 0 or j[0] < 0:
+        return None
+
+    grid = load_zone_index(save_dir)['grid']
+    return int(grid[j[0], i[0]])
+
+def zone_ids(save_dir, x, y):
+    """Returns the IDs of the zones containing each of the points (x,y)."""
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    i, j = grid_indices(save_dir, x, y)
+
+    invalid = np.flatnonzero((i < 0) | (j < 0))
+    if len(invalid) > 0:
+        k = invalid[0]
+        raise RuntimeError("Could not find a node containing the point (%f, %f)" % (x[k], y[k]))
+
+    grid = load_zone_index(save_dir)['grid']
+    return grid[j, i]
+
+def zone_ids_in_rect(save_dir, x_min, y_min, x_max, y_max):
+    """Returns the (sorted) IDs of all zones which overlap the specified
+    rectangle. The rectangle is clipped to the global grid."""
+
+    grid = load_zone_index(save_dir)['grid']
+    height, width = grid.shape
+
+    i = apass._grid_index(np.clip([x_min, x_max], 0, np.nextafter(360, 0)),
+                          0, 360.0 / width, width)
+    j = apass._grid_index(np.clip([y_min, y_max], -90, np.nextafter(90, 0)),
+                          -90, 180.0 / height, height)
+
+    cells = grid[j[0]:j[1] + 1, i[0]:i[1] + 1]
+    return [int(z) for z in np.unique(cells)]
+
+def zone_id_from_indices(save_dir, i, j):
+    """Returns the ID of the zone at the (i,j) indices of the global grid.
+    Indices wrap around at the edges of the grid."""
+
+    grid = load_zone_index(save_dir)['grid']
+    height, width = grid.shape
+
+    return int(grid[j % height, i % width])
+
+def zone_rect(save_dir, zone_id):
+    """Returns a Rect with the bounds of the specified zone or None if no such
+    zone exists."""
+
+    bounds = load_zone_index(save_dir)['bounds']
+    if zone_id < 0 or zone_id >= len(bounds) or np.isnan(bounds[zone_id][0]):
+        return None
+
+    x_min, x_max, y_min, y_max = [float(v) for v in bounds[zone_id]]
+    return Rect(x_min, x_max, y_min, y_max)
+
+def adjacent_zone_ids(save_dir, i, j):
+    """Returns zones that should be regarded as adjacent to the zone at the
+    (i,j) indices of the global grid.
+
+    This function behaves as follows:
+     * A polar zone: Returns the entire adjacent row
+     * First row before/after a polar zone: Six adjacent zones that are not the polar zone
+     * All others: The eight zones surrounding the zone of interest
+    """
+
+    grid = load_zone_index(save_dir)['grid']
+    height, width = grid.shape
+
+    # Southern polar zone
+    if j == 0:
+        return [int(z) for z in grid[1, :]]
+
+    # Northern polar zone
+    elif j == height - 1:
+        return [int(z) for z in grid[height - 2, :]]
+
+    # first row after a polar zone
+    elif j == 1:
+        rows = range(0, 2)
+
+    # first row before a polar zone
+    elif j == height - 2:
+        rows = range(-1, 1)
+
+    # all other cases
+    # return a the 3x3 block surrounding (i,j)
+    else:
+        rows = range(-1, 2)
+
+    adj_zone_ids = []
+    for k in range(-1, 2):
+        for l in rows:
+            if k == 0 and l == 0:
+                continue
+            adj_zone_ids.append(int(grid[(j + l) % height, (i + k) % width]))
+
+    return adj_zone_ids
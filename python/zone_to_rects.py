@@ -27,9 +27,18 @@ from quadtree import *
 from quadtree_types import *
 from apass_types import *
 import apass
-from fred import read_fredbin
+from fred import open_fredbin, read_fredbin_encoding, fredbin_codecs, set_fredbin_codec
 from border_info import make_border_info, save_border_info
 import zone
+import zone_index
+import grid_cluster
+from container_table import ContainerTable
+
+# Engines which build the containers of a zone. The grid engine clusters all
+# of the zone's data at once (see grid_cluster.py), the legacy engine inserts
+# the data into the zone's tree one datum at a time.
+zone_engines = ['grid', 'legacy']
+zone_engine = 'grid'
 
 def zone_to_rects_wrapper(proc_func, save_dir, filename):
     """Wrapper function that includes exception handling and logging"""
@@ -51,35 +60,78 @@ def zone_to_rects(save_dir, filename):
     """Processes and APASS zone file into overlapping rectangles"""
     zone_id = apass.zone_from_name(filename)
 
-    global tree_file
-
-    # read in the (binary) data file
-    data = read_fredbin(filename)
+    # map in the (binary) data file. Encoded columns are carried through to
+    # the container file without being decoded.
+    data = open_fredbin(filename, decode=False)
+    encoding = read_fredbin_encoding(filename)
     print "Processing '%s' which has %i data points " % (filename, data.size)
 
     # find the bounds of this zone using the first data point in the file
-    global_tree = QuadTreeNode.from_file(tree_file, leafClass=IDLeaf)
     datum = data[0]
     ra, dec = apass.get_coords(datum)
-    zone_node = global_tree.find_leaf(ra, dec)
-    zone_bounds = zone_node.rect
+    zone_bounds = zone_index.zone_rect(save_dir, zone_index.zone_id(save_dir, ra, dec))
 
     # build a tree for the zone
-    zone_tree = QuadTreeNode(zone_bounds, 0, parent=None)
-    zone_tree.split_until(apass.zone_depth, leafClass=RectLeaf)
+    zone_tree = build_zone_tree(zone_bounds, data)
 
-    # insert the data into the tree, building up containers (rectangles) in the
-    # process
-    for datum in np.nditer(data):
-        datum = datum.copy()
-        ra, dec = apass.get_coords(datum)
+    if zone_engine == 'grid':
         try:
-            zone_tree.insert(ra, dec, datum)
+            data = grid_cluster.cluster_zone(zone_tree, np.array(data), zone_id)
         except RuntimeError:
             print("ERROR: Potential data corruption in " + filename)
             print("ERROR: Check file, remove the zone directory, and re-run this program")
             return
 
+        # write out the containers that are on the border and the data
+        zone_border_info = find_border_containers(zone_tree)
+        border_filename = save_dir + '/' + apass.name_zone_border_file(zone_id)
+        save_border_info(border_filename, zone_border_info)
+
+        zone.save_zone_array(save_dir, zone_id, data, encoding)
+    elif not insert_zone_data(zone_tree, data, encoding, zone_id, save_dir, filename):
+        return
+
+    # save the zone -> container mapping
+    filename = save_dir + '/' + apass.name_zone_json_file(zone_id)
+    QuadTreeNode.to_file(zone_tree, filename)
+
+def build_zone_tree(zone_bounds, data):
+    """Builds the tree of a zone. The tree is split until each leaf contains
+    at most apass.zone_max_leaf_data of the data (up to apass.zone_max_depth)
+    or, if apass.zone_max_leaf_data is 0, to apass.zone_depth."""
+
+    if apass.zone_max_leaf_data <= 0:
+        zone_tree = QuadTreeNode(zone_bounds, 0, parent=None)
+        zone_tree.split_until(apass.zone_depth, leafClass=RectLeaf)
+        return zone_tree
+
+    return QuadTreeNode.split_by_count(zone_bounds, np.asarray(data['ra']),
+                                       np.asarray(data['dec']),
+                                       apass.zone_max_leaf_data, apass.zone_max_depth,
+                                       leafClass=RectLeaf)
+
+def insert_zone_data(zone_tree, data, encoding, zone_id, save_dir, filename):
+    """Builds the containers of a zone by inserting its data into the zone's
+    tree one datum at a time, then saves the border info and data"""
+
+    # insert the data into the tree, building up containers (rectangles) in the
+    # process. The data stays in a table shared by the containers.
+    table = ContainerTable(np.array(data), encoding)
+    ras = table.data['ra']
+    decs = table.data['dec']
+    for i in range(0, len(table.data)):
+        ra, dec = ras[i], decs[i]
+        # sparse zones are a single leaf, which find_leaf always returns
+        leaf = zone_tree.find_leaf(ra, dec)
+        if leaf is None or not leaf.contains(ra, dec):
+            print("ERROR: Potential data corruption in " + filename)
+            print("ERROR: Check file, remove the zone directory, and re-run this program")
+            return False
+
+        container = RectContainer(ra, dec, None)
+        container.attach(table, table.new_slot(i, 1))
+        leaf.insert_container(container)
+
 
     # prepare the save the data.
     # the zone file's name
@@ -97,9 +149,26 @@ def zone_to_rects(save_dir, filename):
 
     zone.save_zone_data(zone_tree, save_dir)
 
-    # save the zone -> container mapping
-    filename = save_dir + '/' + apass.name_zone_json_file(zone_id)
-    QuadTreeNode.to_file(zone_tree, filename)
+    return True
+
+def find_border_containers(zone_tree):
+    """Returns the border info of all containers which extend past the zone's
+    boundaries. Containers which extend past a pole are not included, see
+    merge_containers_on_borders."""
+
+    zone_border_rects = dict()
+
+    for leaf in zone_tree.get_leaves():
+        for container in leaf.containers:
+            if container.rect.y_min < -90 or container.rect.y_max > 90:
+                continue
+
+            for x, y in container.get_corners():
+                if not zone_tree.contains(x, y):
+                    zone_border_rects.update(make_border_info(container))
+                    break
+
+    return zone_border_rects
 
 def merge_containers_on_borders(zone_tree):
 
@@ -140,6 +209,8 @@ def merge_containers_on_borders(zone_tree):
                     for adj_container in adj_containers:
                         container.merge(adj_container)
                         adj_leaf.remove_container(adj_container)
+                    if len(adj_containers) > 0:
+                        leaf.update_container(container)
 
     return zone_border_rects
 
@@ -177,11 +248,7 @@ def number_containers(tree, zone_id=0):
             container.zone_id = zone_id
             container.node_id = node_id
             container.container_id = container_id
-
-            # number the data with the corresponding (node_id, container_id)
-            for datum in container.data:
-                datum['node_id'] = node_id
-                datum['container_id'] = container_id
+            # the data are numbered when the zone is saved, see pack_containers
 
             # increment the container ID
             container_id += 1
@@ -271,7 +338,7 @@ def plot_rects(tree):
 def main():
 
     global error_filename
-    global tree_file
+    global zone_engine
 
     parser = argparse.ArgumentParser(description='Inserts zone data into a quadtree data structure.')
     parser.add_argument('save_dir', help="Directory to which output files should be saved")
@@ -279,16 +346,27 @@ def main():
     parser.add_argument('-j','--jobs', type=int, help="Parallel jobs", default=4)
     parser.add_argument('--debug', default=False, action='store_true',
                         help="Run in debug mode")
+    parser.add_argument('--codec', default='none', choices=fredbin_codecs,
+                        help="Compression used for new fredbin files")
+    parser.add_argument('--engine', default=zone_engine, choices=zone_engines,
+                        help="Engine which builds the containers (legacy: insert one datum at a time)")
+    parser.add_argument('--max-leaf-data', type=int, default=apass.zone_max_leaf_data,
+                        help="Split zones until each leaf holds at most this many data (0: split to a fixed depth)")
+    parser.add_argument('--column-store', default=False, action='store_true',
+                        help="Also write a -columns directory for each container file")
     parser.set_defaults(jobs=1)
 
     args = parser.parse_args()
     start = time.time()
+    set_fredbin_codec(args.codec)
+    zone_engine = args.engine
+    apass.zone_max_leaf_data = args.max_leaf_data
+    zone.zone_column_stores = args.column_store
 
     save_dir = os.path.dirname(args.save_dir)
 
     # configure globals
     error_filename = save_dir + "/error_zone_to_rects.txt"
-    tree_file = save_dir + "/global.json"
 
     # Construct a partial to serve as the function to call in serial or
     # parallel mode below.
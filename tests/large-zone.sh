@@ -0,0 +1,69 @@
+#!/bin/bash
+
+# Filename: large-zone.sh
+# Purpose: Tests zone_to_rects.py against a single synthetic zone which is as
+#          crowded as the zones in the galactic plane.
+# Usage: Run the script (no arguments required). It'll stop if there is an error
+#        NUM_STARS and NUM_OBS set the size of the zone (default: 1 million
+#        measurements)
+
+
+####
+# Large zone test
+####
+export SAVE_DIR=../data/test-output/
+export CODE_DIR=../python/
+export NUM_STARS=${NUM_STARS:-50000}
+export NUM_OBS=${NUM_OBS:-20}
+
+# clear out the save directory
+rm ${SAVE_DIR}/*
+
+# instruct bash to stop on the first non-true exit code
+set -e -x
+START=$(date +%s)
+
+python ${CODE_DIR}/make_zones.py ${SAVE_DIR}
+
+# write NUM_OBS measurements, scattered by 0.3 arcseconds, of NUM_STARS stars
+# in the zone at (ra, dec) = (280, -5)
+SAVE_PATH=$(cd ${SAVE_DIR} && pwd)
+(cd ${CODE_DIR} && python - ${SAVE_PATH} <<EOF
+import sys
+import numpy as np
+import apass, fred, zone_index
+
+save_dir = sys.argv[1]
+num_stars = ${NUM_STARS}
+num_obs = ${NUM_OBS}
+
+zone_id = zone_index.zone_id(save_dir, 280, -5)
+rect = zone_index.zone_rect(save_dir, zone_id)
+
+rng = np.random.RandomState(0)
+star_ra = rng.uniform(rect.x_min, rect.x_max, num_stars)
+star_dec = rng.uniform(rect.y_min, rect.y_max, num_stars)
+
+data = np.zeros(num_stars * num_obs,
+                dtype={'names': fred.fredbin_col_names, 'formats': fred.fredbin_col_types})
+scatter = 0.3 / 3600
+data['ra'] = np.clip(np.repeat(star_ra, num_obs) + rng.normal(0, scatter, len(data)),
+                     rect.x_min, np.nextafter(rect.x_max, rect.x_min))
+data['dec'] = np.clip(np.repeat(star_dec, num_obs) + rng.normal(0, scatter, len(data)),
+                      rect.y_min, np.nextafter(rect.y_max, rect.y_min))
+data['hjd'] = 56000 + np.arange(len(data)) * 1e-3
+data['zone_id'] = zone_id
+data = data[rng.permutation(len(data))]
+
+fred.write_fredbin(save_dir + '/' + apass.name_zone_file(zone_id), data)
+EOF
+)
+
+# build the containers, any failure is recorded in the error file
+python ${CODE_DIR}/zone_to_rects.py ${SAVE_DIR} ${SAVE_DIR}/*-raw.fredbin
+test ! -e ${SAVE_DIR}/error_zone_to_rects.txt
+
+# print out timing statistics
+END=$(date +%s)
+DIFF=$(( $END - $START ))
+echo "Large zone test took $DIFF seconds"
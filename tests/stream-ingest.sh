@@ -0,0 +1,42 @@
+#!/bin/bash
+
+# Filename: stream-ingest.sh
+# Purpose: Tests the streaming FRED ingest service against a subset of the SRO data
+# Usage: Run the script (no arguments required). It'll stop if there is an error
+
+
+####
+# Streaming ingest test for SRO data
+####
+export DATA_DIR=../data/sro-test-data/
+export SAVE_DIR=../data/test-output/
+export CODE_DIR=../python/
+export SOCKET=${SAVE_DIR}/fred_stream.sock
+export NUM_FILES=$(ls ${DATA_DIR}/*.fred | wc -l)
+
+# clear out the save directory
+rm ${SAVE_DIR}/*
+
+# instruct bash to stop on the first non-true exit code
+set -e -x
+START=$(date +%s)
+
+python ${CODE_DIR}/make_zones.py ${SAVE_DIR}
+
+# start the service, then replay the FRED files from several producers at once
+python ${CODE_DIR}/fred_stream.py ${SAVE_DIR} --unix ${SOCKET} --max-files ${NUM_FILES} &
+SERVICE=$!
+sleep 2
+python ${CODE_DIR}/fred_replay.py --unix ${SOCKET} -j 4 ${DATA_DIR}/*.fred
+wait ${SERVICE}
+
+# replaying the files through fred_to_zone should find nothing new to ingest
+python ${CODE_DIR}/fred_to_zone.py ${SAVE_DIR} ${DATA_DIR}/*.fred
+
+# the streamed zones should go through the rest of the pipeline as usual
+python ${CODE_DIR}/zone_to_rects.py ${SAVE_DIR} ${SAVE_DIR}/*-raw.fredbin
+
+# print out timing statistics
+END=$(date +%s)
+DIFF=$(( $END - $START ))
+echo "Streaming ingest took $DIFF seconds"